@@ -0,0 +1,178 @@
+import time
+import asyncio
+import concurrent.futures
+
+from pynetdicom.apps.common import ElementPath
+
+import scu
+from scu import SCU, create_dataset
+from pool import AssociationError
+
+# Bounds in seconds of the interval between two checks of the DIMSE message queue of an association
+POLL_MIN = 0.0005
+POLL_MAX = 0.01
+# Threads establishing associations (pool.acquire blocks during the A-ASSOCIATE negotiation)
+SETUP_THREADS = 4
+
+
+class AsyncSCU(SCU):
+    """ AsyncSCU class
+    asyncio execution engine for C-FIND (request.engine: asyncio). A single SCU drives up to
+    request.threads concurrent requests from one event loop instead of one SCU thread per request.
+    The C-FIND responses are not waited for on a thread: the event loop polls the DIMSE message queue of
+    each association and only reads a response once it has arrived, so that the number of requests in
+    flight is only bounded by request.threads and pool.max_associations. pynetdicom still runs its own
+    threads for each association (about two), and associations are established by SETUP_THREADS threads.
+    Requests are pulled from the queue (merged, checked against the schedule window and paced by the rate
+    controller) by a single dispatcher thread.
+    """
+
+    def __init__(self, config, pool=None, planner=None, journal=None, sink=None):
+        super().__init__(config, pool, planner, journal, sink)
+        self.concurrency = int(config['request']['threads'])
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=min(self.concurrency, SETUP_THREADS),
+            thread_name_prefix='pydicombatch-setup')
+        self.dispatcher = concurrent.futures.ThreadPoolExecutor(max_workers=1,
+            thread_name_prefix='pydicombatch-dispatch')
+
+    def next_request(self):
+        """
+        Return the next request to send, or None once the queue is exhausted or the extraction is stopped.
+        Runs on the dispatcher thread since it may block (queue, schedule window, rate).
+        """
+        request = self.queue.get()
+        if request is None:
+            return None
+        request = self.merge(request, self.queue)
+        if not scu.continue_extraction or not self.wait_until_scheduled_time(request):
+            self.queue.task_done()
+            return None
+        if self.rate:
+            self.rate.acquire()
+        return request
+
+    async def process_requests(self, queue):
+        self.queue = queue
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(self.concurrency)
+        tasks = set()
+        try:
+            while scu.continue_extraction:
+                await slots.acquire()
+                request = await loop.run_in_executor(self.dispatcher, self.next_request)
+                if request is None:
+                    slots.release()
+                    break
+                self.update_postfix()
+                task = asyncio.create_task(self.process_request(request))
+                tasks.add(task)
+                task.add_done_callback(lambda task : self.request_done(task, slots, tasks))
+                if not self.rate and request['throttle_time']:
+                    await asyncio.sleep(request['throttle_time'])
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            for task in tasks:
+                task.cancel()
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.dispatcher.shutdown(wait=False, cancel_futures=True)
+
+    def request_done(self, task, slots, tasks):
+        tasks.discard(task)
+        if self.rate:
+            self.rate.release()
+        self.queue.task_done()
+        slots.release()
+        if not task.cancelled() and task.exception():
+            print('\nError processing C-FIND: {}'.format(task.exception()))
+
+    async def process_request(self, request):
+        loop = asyncio.get_running_loop()
+        for part in request.get('_parts', [request]):
+            self.journal.start(part)
+        time_start = time.time()
+        try:
+            pooled = await loop.run_in_executor(self.executor, self.pool.acquire)
+        except AssociationError as exc:
+            print('\n{}'.format(exc))
+            self.record_outcome(None, False)
+            for part in request.get('_parts', [request]):
+                self.request_failed(part)
+            return
+        healthy = True
+        try:
+            await self.send_find(request, pooled.assoc)
+        except BaseException:
+            healthy = False
+            raise
+        finally:
+            self.pool.release(pooled, healthy)
+        if self.window:
+            self.window.record((time.time() - time_start) / len(request.get('_parts', [request])))
+
+    async def send_find(self, request, association):
+        identifier = create_dataset(request)
+        keywords = [ElementPath(path).keyword for path in request['elements']]
+
+        if not association.is_established:
+            for part in request.get('_parts', [request]):
+                self.request_failed(part)
+            return
+
+        time_start = time.perf_counter()
+        responses = association.send_c_find(identifier, self.query_model)
+        response_count = 0
+        # Responses are kept until the request completes so that truncated results are not saved
+        saved_responses = []
+        async for status, rsp_identifier in self.receive(association, responses):
+            if status and status.Status in [0xFF00, 0xFF01]:
+                # Status pending
+                response_count += 1
+                if self.should_save(rsp_identifier, request):
+                    saved_responses.append(rsp_identifier)
+            else:
+                # Status Success, Warning, Cancel, Failure
+                # An empty status means the association was aborted or timed out
+                self.find_completed(request, status, response_count, saved_responses, keywords,
+                    time.perf_counter() - time_start)
+
+    async def receive(self, association, responses):
+        """
+        Yield the (status, identifier) responses of a request sent on an association without blocking the
+        event loop: next(responses) is only called once a message is in the DIMSE queue, where it does not
+        wait. Without a message for dimse_timeout seconds, the request is ended as pynetdicom would.
+        """
+        msg_queue = association.dimse.msg_queue
+        timeout = association.dimse.dimse_timeout
+        while True:
+            deadline = time.monotonic() + timeout if timeout else None
+            delay = POLL_MIN
+            while msg_queue.empty():
+                if deadline and time.monotonic() > deadline:
+                    # Read as a DIMSE timeout by pynetdicom, which aborts the association
+                    msg_queue.put((None, None))
+                    break
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, POLL_MAX)
+            response = next(responses, None)
+            if response is None:
+                return
+            yield response
+            status = response[0]
+            if not (status and status.Status in [0xFF00, 0xFF01]):
+                # Final response
+                return
+
+
+def run_async(config, pool, planner, coalescer, journal, sink, scp, rate, window, queue, pbar, pbar_lock):
+    """
+    Process the requests of a queue with the asyncio engine
+    """
+    async_scu = AsyncSCU(config, pool, planner, journal, sink)
+    async_scu.scp = scp
+    async_scu.rate = rate
+    async_scu.window = window
+    async_scu.coalescer = coalescer
+    async_scu.pbar = pbar
+    async_scu.pbar_lock = pbar_lock
+    asyncio.run(async_scu.process_requests(queue))
@@ -0,0 +1,452 @@
+import re
+import datetime
+import hashlib
+import xml.etree.ElementTree as ET
+
+from pydicom.datadict import dictionary_VR, keyword_dict
+from pydicom.multival import MultiValue
+
+
+KEEP = 'keep'
+REMOVE = 'remove'
+EMPTY = 'empty'
+REQUIRE = 'require'
+
+FUNCTION_RE = re.compile(r'@([a-zA-Z]+)\(')
+BINARY_NUMERIC_VRS = ['US', 'SS', 'UL', 'SL', 'FL', 'FD', 'UV', 'SV']
+BULK_VRS = ['SQ', 'OB', 'OW', 'OF', 'OD', 'OL', 'OV', 'UN']
+
+
+class AnonymizationError(Exception):
+    """Raised when a data set cannot be anonymized, e.g. a missing look-up table entry"""
+
+
+def md5_decimal(text):
+    """
+    Return the MD5 digest of a string as a base-10 integer string
+    """
+    return str(int.from_bytes(hashlib.md5(text.encode('utf-8')).digest(), 'big'))
+
+def hash_string(text, max_chars=0):
+    result = md5_decimal(text)
+    return result[:max_chars] if max_chars else result
+
+def hash_uid(prefix, uid):
+    uid = uid.strip(' \x00')
+    if not uid:
+        return ''
+    prefix = prefix.strip()
+    if prefix and not prefix.endswith('.'):
+        prefix += '.'
+    return (prefix + md5_decimal(uid))[:64]
+
+def increment_date(value, days):
+    """
+    Offset a DA (or the date part of a DT) value by a number of days
+    """
+    value = value.strip()
+    try:
+        date = datetime.datetime.strptime(value[:8], '%Y%m%d') + datetime.timedelta(days=days)
+    except ValueError:
+        return ''
+    return date.strftime('%Y%m%d') + value[8:]
+
+def element_string(elem):
+    if elem.value is None:
+        return ''
+    if isinstance(elem.value, MultiValue):
+        return '\\'.join(str(x) for x in elem.value)
+    if isinstance(elem.value, bytes):
+        return elem.value.decode('latin-1').strip(' \x00')
+    return str(elem.value)
+
+def split_args(text):
+    """
+    Split function arguments on commas that are not quoted or nested
+    """
+    args = []
+    depth = 0
+    quote = None
+    current = ''
+    for c in text:
+        if quote:
+            if c == quote:
+                quote = None
+            current += c
+        elif c in '"\'':
+            quote = c
+            current += c
+        elif c == '(':
+            depth += 1
+            current += c
+        elif c == ')':
+            depth -= 1
+            current += c
+        elif c == ',' and depth == 0:
+            args.append(current.strip())
+            current = ''
+        else:
+            current += c
+    if current.strip() or args:
+        args.append(current.strip())
+    return args
+
+def matching(text, start, open_char, close_char):
+    """
+    Return the index following the character closing the one at text[start]
+    """
+    depth = 0
+    quote = None
+    for i in range(start, len(text)):
+        c = text[i]
+        if quote:
+            if c == quote:
+                quote = None
+        elif c == '"' and open_char == '(':
+            quote = c
+        elif c == open_char:
+            depth += 1
+        elif c == close_char:
+            depth -= 1
+            if depth == 0:
+                return i + 1
+    raise AnonymizationError('Unbalanced script: {}'.format(text))
+
+def parse_script(text):
+    """
+    Split an element script into literal text and (name, args, blocks) function calls
+    """
+    tokens = []
+    literal = ''
+    i = 0
+    while i < len(text):
+        m = FUNCTION_RE.match(text, i)
+        if not m:
+            literal += text[i]
+            i += 1
+            continue
+        if literal:
+            tokens.append(literal)
+            literal = ''
+        end = matching(text, m.end() - 1, '(', ')')
+        args = split_args(text[m.end():end - 1])
+        blocks = []
+        while end < len(text) and text[end] == '{':
+            block_end = matching(text, end, '{', '}')
+            blocks.append(text[end + 1:block_end - 1])
+            end = block_end
+        tokens.append((m.group(1).lower(), args, blocks))
+        i = end
+    if literal:
+        tokens.append(literal)
+    return tokens
+
+def unquote(text):
+    if len(text) >= 2 and text[0] == text[-1] and text[0] in '"\'':
+        return text[1:-1]
+    return text
+
+def parse_tag(name):
+    """
+    Return the tag of an element given by keyword, (gggg,eeee) or ggggeeee
+    """
+    name = name.strip().strip('[]()')
+    if name in keyword_dict:
+        return keyword_dict[name]
+    hex_str = name.replace(',', '')
+    if re.fullmatch(r'[0-9a-fA-F]{8}', hex_str):
+        return int(hex_str, 16)
+    return None
+
+def load_lookup_table(filepath):
+    """
+    Load a Java properties look-up table (KeyType/value=replacement)
+    """
+    lut = {}
+    with open(filepath, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line[0] in '#!':
+                continue
+            key, sep, value = line.partition('=')
+            if sep:
+                lut[key.strip()] = value.strip()
+    return lut
+
+
+class Anonymizer(object):
+    """ Anonymizer class
+    In-process implementation of the RSNA CTP / DicomAnonymizerTool script format (dicom-anonymizer.script)
+    applied to in-memory Datasets. It supports the parameters (e.g. UIDROOT, DATEINC), the keep group
+    (<k>) and remove (<r>: privategroups, curves, overlays, unspecifiedelements) options, and the element
+    functions @keep, @remove, @empty, @require, @always, @append, @if, @param, @hash, @hashuid, @hashname,
+    @hashptid, @hashdate, @incrementdate, @date, @time, @lookup, @initials and @contents. Functions are
+    evaluated against the values of the data set before anonymization. Scripts are applied recursively to
+    sequence items, where missing elements are not created.
+    """
+
+    def __init__(self, script, lookup_table=None):
+        self.params = {}
+        self.scripts = {}
+        self.keep_groups = set()
+        self.remove = set()
+        root = ET.parse(script).getroot()
+        for node in root:
+            if node.tag == 'p':
+                self.params[node.get('t')] = (node.text or '').strip()
+            elif node.get('en') != 'T':
+                continue
+            elif node.tag == 'e':
+                self.scripts[int(node.get('t'), 16)] = (node.text or '').strip()
+            elif node.tag == 'k':
+                self.keep_groups.add(int(node.get('t'), 16))
+            elif node.tag == 'r':
+                self.remove.add(node.get('t'))
+        self.lut = load_lookup_table(lookup_table) if lookup_table else {}
+        self.tokens = {tag: parse_script(script) for tag, script in self.scripts.items()}
+
+    def anonymize(self, ds):
+        """
+        Anonymize a Dataset in place and return it
+        """
+        self.anonymize_dataset(ds, {}, True)
+        if hasattr(ds, 'file_meta') and 'SOPInstanceUID' in ds:
+            ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+        return ds
+
+    def snapshot(self, ds):
+        return {int(elem.tag): element_string(elem) for elem in ds if elem.VR not in BULK_VRS}
+
+    def anonymize_dataset(self, ds, parent_values, root=False):
+        values = self.snapshot(ds)
+        context = {'values': values, 'parent_values': parent_values}
+
+        for elem in list(ds):
+            tag = int(elem.tag)
+            group = tag >> 16
+            if tag in self.scripts:
+                continue
+            if elem.VR == 'SQ':
+                for item in elem.value:
+                    self.anonymize_dataset(item, {**parent_values, **values})
+            if elem.tag.is_private and 'privategroups' in self.remove:
+                del ds[elem.tag]
+            elif 0x5000 <= group <= 0x50FF and 'curves' in self.remove:
+                del ds[elem.tag]
+            elif 0x6000 <= group <= 0x60FF and 'overlays' in self.remove:
+                del ds[elem.tag]
+            elif ('unspecifiedelements' in self.remove and group not in self.keep_groups
+                and group > 0x0002 and tag != 0x7FE00010):
+                del ds[elem.tag]
+
+        for tag, tokens in self.tokens.items():
+            exists = tag in ds
+            context['tag'] = tag
+            context['always'] = False
+            context['append'] = False
+            action, value = self.evaluate(tokens, context)
+            # Missing elements are only created at the top level of the data set
+            if not exists and not (root and (context['always'] or context['append'] or action == REQUIRE)):
+                continue
+            if action == REMOVE:
+                if exists:
+                    del ds[tag]
+            elif action == KEEP:
+                if exists and ds[tag].VR == 'SQ':
+                    for item in ds[tag].value:
+                        self.anonymize_dataset(item, {**parent_values, **values})
+            elif action in [EMPTY, REQUIRE]:
+                if not exists or action == EMPTY:
+                    self.set_value(ds, tag, '')
+            elif context['append'] and exists and values.get(tag):
+                self.set_value(ds, tag, values[tag] + '\\' + value)
+            else:
+                self.set_value(ds, tag, value)
+
+    def set_value(self, ds, tag, value):
+        if tag in ds:
+            vr = ds[tag].VR
+        else:
+            try:
+                vr = dictionary_VR(tag).split(' or ')[0]
+            except KeyError:
+                vr = 'LO'
+        if vr == 'SQ':
+            if value == '':
+                ds[tag].value = []
+            return
+        if vr in BINARY_NUMERIC_VRS:
+            value = None if value == '' else (float(value) if vr in ['FL', 'FD'] else int(value))
+        if tag in ds:
+            ds[tag].value = value
+        else:
+            ds.add_new(tag, vr, value)
+
+    def evaluate(self, tokens, context):
+        """
+        Evaluate script tokens, returning (action, value) where action is None when the value is set
+        """
+        action = None
+        value = ''
+        for token in tokens:
+            if isinstance(token, str):
+                value += token
+                continue
+            name, args, blocks = token
+            function = getattr(self, 'function_' + name, None)
+            if function is None:
+                raise AnonymizationError('Unsupported anonymizer function: @{}'.format(name))
+            result = function(args, blocks, context)
+            if isinstance(result, tuple):
+                action = action or result[0]
+                value += result[1]
+            elif result in [KEEP, REMOVE, EMPTY, REQUIRE]:
+                action = action or result
+            else:
+                value += result
+        return action, value
+
+    def argument(self, arg, context):
+        """
+        Resolve a function argument: a parameter (@NAME), 'this', an element name or a literal
+        """
+        arg = arg.strip()
+        if arg.startswith('@'):
+            return self.params.get(arg[1:], '')
+        if arg == 'this':
+            return context['values'].get(context['tag'], '')
+        tag = parse_tag(arg)
+        if tag is not None:
+            if tag in context['values']:
+                return context['values'][tag]
+            return context['parent_values'].get(tag, '')
+        return unquote(arg)
+
+    def exists(self, arg, context):
+        """
+        Return True if an element argument ('this' or an element name) is in the data set or its parents
+        """
+        arg = arg.strip()
+        tag = context['tag'] if arg == 'this' else parse_tag(arg)
+        return tag is None or tag in context['values'] or tag in context['parent_values']
+
+    def function_keep(self, args, blocks, context):
+        return KEEP
+
+    def function_remove(self, args, blocks, context):
+        return REMOVE
+
+    def function_empty(self, args, blocks, context):
+        return EMPTY
+
+    def function_require(self, args, blocks, context):
+        return REQUIRE
+
+    def function_always(self, args, blocks, context):
+        context['always'] = True
+        return ''
+
+    def function_append(self, args, blocks, context):
+        context['append'] = True
+        return self.evaluate(parse_script(blocks[0]), context) if blocks else ''
+
+    def function_param(self, args, blocks, context):
+        return self.argument(args[0], context)
+
+    def function_date(self, args, blocks, context):
+        separator = unquote(args[0]) if args and args[0] else ''
+        return datetime.datetime.now().strftime(separator.join(['%Y', '%m', '%d']))
+
+    def function_time(self, args, blocks, context):
+        separator = unquote(args[0]) if args and args[0] else ''
+        return datetime.datetime.now().strftime(separator.join(['%H', '%M', '%S']))
+
+    def function_hash(self, args, blocks, context):
+        max_chars = int(args[1]) if len(args) > 1 else 0
+        return hash_string(self.argument(args[0], context).strip(), max_chars)
+
+    def function_hashuid(self, args, blocks, context):
+        return hash_uid(self.argument(args[0], context), self.argument(args[1], context))
+
+    def function_hashptid(self, args, blocks, context):
+        site_id = self.argument(args[0], context).strip()
+        patient_id = self.argument(args[1], context).strip()
+        max_chars = int(args[2]) if len(args) > 2 else 0
+        return hash_string('[{}]{}'.format(site_id, patient_id), max_chars)
+
+    def function_hashname(self, args, blocks, context):
+        name = self.argument(args[0], context).upper().replace('^', ' ')
+        name = re.sub(r'[^A-Z ]', '', name)
+        words = name.split()
+        if len(args) > 2:
+            words = words[:int(args[2])]
+        max_chars = int(args[1]) if len(args) > 1 else 0
+        return hash_string(' '.join(words), max_chars)
+
+    def function_hashdate(self, args, blocks, context):
+        # As DAT.jar: each value is offset by up to 10 years back, the last 4 digits of the hash of the second
+        #   element modulo 3650 days. Removed if either element is missing, emptied if the date is too short.
+        if not (self.exists(args[0], context) and self.exists(args[1], context)):
+            return REMOVE
+        date = self.argument(args[0], context)
+        if len(date) < 8:
+            return EMPTY
+        offset = int(md5_decimal(self.argument(args[1], context).strip())[-4:]) % 3650
+        return '\\'.join(increment_date(x, -offset) for x in date.split('\\'))
+
+    def function_incrementdate(self, args, blocks, context):
+        date = self.argument(args[0], context)
+        return increment_date(date, int(self.argument(args[1], context) or 0))
+
+    def function_initials(self, args, blocks, context):
+        parts = self.argument(args[0], context).split('^')
+        # Given names first, then the family name
+        ordered = parts[1:] + parts[:1]
+        return ''.join(x.strip()[0] for x in ordered if x.strip()).upper()
+
+    def function_contents(self, args, blocks, context):
+        value = self.argument(args[0], context)
+        if len(args) > 1:
+            value = re.sub(unquote(args[1]), unquote(args[2]) if len(args) > 2 else '', value)
+        return value
+
+    def function_lookup(self, args, blocks, context):
+        value = self.argument(args[0], context).strip()
+        key = '{}/{}'.format(args[1].strip(), value)
+        if key in self.lut:
+            return self.lut[key]
+        action = unquote(args[2]).lower() if len(args) > 2 else ''
+        if action in ['keep', 'ignore']:
+            return KEEP
+        if action == 'remove':
+            return REMOVE
+        if action == 'empty':
+            return EMPTY
+        if action == 'default' and len(args) > 3:
+            return unquote(args[3])
+        raise AnonymizationError('Missing look-up table entry: {}'.format(key))
+
+    def function_if(self, args, blocks, context):
+        value = self.argument(args[0], context)
+        condition = args[1].strip()
+        name, _, condition_arg = condition.partition('(')
+        condition_arg = unquote(condition_arg.rstrip(')'))
+        name = name.lower()
+        if name == 'isblank':
+            result = not value.strip()
+        elif name == 'exists':
+            result = context['tag'] in context['values'] if args[0].strip() == 'this' else bool(value)
+        elif name == 'equals':
+            result = value == condition_arg
+        elif name == 'contains':
+            result = condition_arg in value
+        elif name == 'startswith':
+            result = value.startswith(condition_arg)
+        elif name == 'endswith':
+            result = value.endswith(condition_arg)
+        elif name == 'matches':
+            result = re.fullmatch(condition_arg, value) is not None
+        else:
+            raise AnonymizationError('Unsupported @if condition: {}'.format(condition))
+        block = blocks[0] if result else (blocks[1] if len(blocks) > 1 else '')
+        return self.evaluate(parse_script(block), context)
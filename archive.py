@@ -0,0 +1,152 @@
+import os
+import csv
+import time
+import tarfile
+import threading
+import collections
+
+from pynetdicom.apps.common import ElementPath
+
+
+INDEX_FIELDS = ['SOPInstanceUID', 'name', 'offset', 'size']
+
+
+def read_instance(shard, offset, size):
+    """
+    Return the bytes of an instance stored in a shard at the offset and size given by the shard index
+    """
+    with open(shard, 'rb') as f:
+        f.seek(offset)
+        return f.read(size)
+
+
+class Shard(object):
+    """ Shard class
+    A tar file being written and its index (<shard>.index.csv)
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.tar = tarfile.open(path, 'x', format=tarfile.PAX_FORMAT)
+        self.index_file = open(path[:-len('.tar')] + '.index.csv', 'w', newline='')
+        self.index = csv.DictWriter(self.index_file, fieldnames=INDEX_FIELDS, dialect='excel')
+        self.index.writeheader()
+        self.size = 0
+
+    def add(self, src, name, sop_instance_uid):
+        """
+        Append a file to the shard and return the offset of its data in the tar file
+        """
+        info = tarfile.TarInfo(name)
+        info.size = os.path.getsize(src)
+        info.mtime = time.time()
+        info.mode = 0o644
+        with open(src, 'rb') as f:
+            self.tar.addfile(info, f)
+        # The data of a member is padded to a multiple of the tar block size
+        blocks, remainder = divmod(info.size, tarfile.BLOCKSIZE)
+        offset = self.tar.offset - (blocks + (remainder > 0)) * tarfile.BLOCKSIZE
+        self.index.writerow({'SOPInstanceUID': sop_instance_uid, 'name': name, 'offset': offset, 'size': info.size})
+        self.tar.fileobj.flush()
+        self.index_file.flush()
+        self.size = self.tar.offset
+        return offset, info.size
+
+    def close(self):
+        self.tar.close()
+        self.index_file.close()
+
+
+class ShardedArchive(object):
+    """ ShardedArchive class
+    Output sink appending the received instances to size-capped tar shards (WebDataset style) instead of
+    writing one file per instance. Instances are grouped in shards per study or per series (group_by), and
+    are named in the tar file after their path in the output directory_structure. A CSV index next to each
+    shard gives the offset and size of every instance so that single instances can be read back without
+    reading the tar file (see read_instance).
+    Shards are named <group>-<n>.tar and created exclusively, so that several worker processes can write to
+    the same directory. At most max_open shards are kept open, the least recently used one is closed first.
+    """
+
+    def __init__(self, directory, output_directory, group_by='series', max_bytes=1 << 30, max_open=16):
+        self.directory = directory
+        self.output_directory = output_directory
+        self.group_by = group_by
+        self.max_bytes = max_bytes
+        self.max_open = max_open
+        self.shards = collections.OrderedDict()
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Return a ShardedArchive if output.sink is tar, or None to write one file per instance (files)
+        """
+        output = config['output']
+        sink = str(output.get('sink', 'files')).lower()
+        if sink == 'files':
+            return None
+        if sink != 'tar':
+            raise ValueError('Unknown output sink: {}'.format(sink))
+        archive = output.get('archive') or {}
+        group_by = str(archive.get('group_by', 'series')).lower()
+        if group_by not in ['study', 'series', 'none']:
+            raise ValueError('Unknown archive grouping: {}'.format(group_by))
+        return cls(os.path.join(output['directory'], archive.get('directory', 'shards')), output['directory'],
+            group_by=group_by,
+            max_bytes=int(archive.get('max_bytes', 1 << 30)),
+            max_open=int(archive.get('max_open', 16)))
+
+    def tags(self):
+        """
+        Return the tags of the header elements needed to add an instance to the archive
+        """
+        keywords = ['SOPInstanceUID']
+        if self.group_by == 'study':
+            keywords.append('StudyInstanceUID')
+        elif self.group_by == 'series':
+            keywords.append('SeriesInstanceUID')
+        return [ElementPath(keyword).tag for keyword in keywords]
+
+    def group(self, ds):
+        if self.group_by == 'study':
+            return str(ds.StudyInstanceUID)
+        if self.group_by == 'series':
+            return str(ds.SeriesInstanceUID)
+        return 'shard'
+
+    def open_shard(self, group):
+        n = 0
+        while True:
+            try:
+                return Shard(os.path.join(self.directory, '{}-{:05d}.tar'.format(group, n)))
+            except FileExistsError:
+                n += 1
+
+    def add(self, src, filepath, ds):
+        """
+        Move the file src to the shard of its group, named after its path in the output directory (filepath).
+        Returns (shard path, offset, size).
+        """
+        group = self.group(ds)
+        name = os.path.relpath(filepath, self.output_directory)
+        with self.lock:
+            shard = self.shards.pop(group, None)
+            if shard is not None and shard.size and shard.size + os.path.getsize(src) > self.max_bytes:
+                shard.close()
+                shard = None
+            if shard is None:
+                shard = self.open_shard(group)
+            self.shards[group] = shard
+            while len(self.shards) > self.max_open:
+                self.shards.popitem(last=False)[1].close()
+            offset, size = shard.add(src, name, str(ds.SOPInstanceUID))
+        os.remove(src)
+        return shard.path, offset, size
+
+    def close(self):
+        with self.lock:
+            for shard in self.shards.values():
+                shard.close()
+            self.shards.clear()
@@ -0,0 +1,370 @@
+import os
+import sys
+import time
+import random
+import fnmatch
+import datetime
+import argparse
+
+import numpy as np
+import yaml
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import (
+    generate_uid,
+    ImplicitVRLittleEndian,
+    ExplicitVRLittleEndian,
+    DeflatedExplicitVRLittleEndian,
+    CTImageStorage,
+    MRImageStorage,
+    ComprehensiveSRStorage,
+    KeyObjectSelectionDocumentStorage
+)
+from pynetdicom import AE, evt, QueryRetrievePresentationContexts
+from pynetdicom.sop_class import Verification
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pool import requeue_stolen_responses
+
+
+TRANSFER_SYNTAXES = {
+    'implicit': ImplicitVRLittleEndian,
+    'explicit': ExplicitVRLittleEndian,
+    'deflated': DeflatedExplicitVRLittleEndian,
+}
+
+MODALITIES = {
+    # Modality: (SOP Class, Rows, Columns), documents without pixel data
+    'CT': (CTImageStorage, 512, 512),
+    'MR': (MRImageStorage, 256, 256),
+    'SR': (ComprehensiveSRStorage, None, None),
+    'KO': (KeyObjectSelectionDocumentStorage, None, None),
+}
+
+DEFAULT_CATALOG = {
+    'seed': 1,
+    'patients': 20,
+    'studies_per_patient': 2,
+    'series_per_study': 3,
+    'instances_per_series': 20,
+    'start_date': '20240101',
+    'days': 30,
+    'modalities': ['CT', 'MR'],
+    'transfer_syntaxes': ['explicit', 'implicit'],
+    'frames': 1,
+    'study_descriptions': [],   # Descriptions picked at random, MOCK STUDY <n> / MOCK SERIES <n> by default
+    'series_descriptions': [],
+}
+
+
+def element_value(ds, keyword):
+    """
+    Return the value of an element as a string, with multiple values (e.g. UID lists) separated by backslashes
+    """
+    value = ds[keyword].value
+    if value is None:
+        return ''
+    if isinstance(value, (list, tuple)) or type(value).__name__ == 'MultiValue':
+        return '\\'.join(str(v) for v in value)
+    return str(value)
+
+
+def match(value, pattern):
+    """
+    Match a value against a C-FIND matching key: universal, wildcard, range or single value matching
+    """
+    if pattern in (None, '', '*'):
+        return True
+    value = str(value)
+    if '-' in pattern and pattern.replace('-', '').isdigit():
+        start, _, end = pattern.partition('-')
+        return (not start or value >= start) and (not end or value <= end)
+    if '\\' in pattern:
+        return value in pattern.split('\\')
+    if '*' in pattern or '?' in pattern:
+        return fnmatch.fnmatchcase(value, pattern)
+    return value == pattern
+
+
+class Catalog(object):
+    """ Catalog class
+    Synthetic, deterministic catalog of patients / studies / series / instances. Instances are not kept in
+    memory: their data sets are built on request from a pixel data template per modality.
+    """
+
+    def __init__(self, config):
+        self.config = {**DEFAULT_CATALOG, **(config or {})}
+        rng = random.Random(self.config['seed'])
+        start_date = datetime.datetime.strptime(str(self.config['start_date']), '%Y%m%d')
+        self.studies = []
+        self.series = []
+        for p in range(self.config['patients']):
+            patient_id = 'PAT{:06d}'.format(p)
+            for s in range(self.config['studies_per_patient']):
+                study_date = start_date + datetime.timedelta(days=rng.randrange(self.config['days']))
+                study = {
+                    'PatientID': patient_id,
+                    'PatientName': 'MOCK^{}'.format(patient_id),
+                    'StudyInstanceUID': generate_uid(entropy_srcs=[str(self.config['seed']), patient_id, str(s)]),
+                    'StudyDate': study_date.strftime('%Y%m%d'),
+                    'StudyTime': '{:02d}{:02d}00'.format(rng.randrange(24), rng.randrange(60)),
+                    'AccessionNumber': 'ACC{:06d}{:02d}'.format(p, s),
+                    'StudyDescription': (rng.choice(self.config['study_descriptions'])
+                        if self.config['study_descriptions'] else 'MOCK STUDY {}'.format(s)),
+                    'ModalitiesInStudy': '',
+                }
+                modalities = set()
+                for n in range(self.config['series_per_study']):
+                    modality = self.config['modalities'][(p + s + n) % len(self.config['modalities'])]
+                    modalities.add(modality)
+                    self.series.append({
+                        'study': study,
+                        'SeriesInstanceUID': generate_uid(entropy_srcs=[study['StudyInstanceUID'], str(n)]),
+                        'SeriesNumber': n + 1,
+                        'SeriesDescription': (rng.choice(self.config['series_descriptions'])
+                            if self.config['series_descriptions'] else 'MOCK SERIES {}'.format(n + 1)),
+                        'Modality': modality,
+                        'transfer_syntax': TRANSFER_SYNTAXES[
+                            self.config['transfer_syntaxes'][n % len(self.config['transfer_syntaxes'])]],
+                    })
+                study['ModalitiesInStudy'] = '\\'.join(sorted(modalities))
+                self.studies.append(study)
+        self.templates = {}
+        for modality, (_, rows, columns) in MODALITIES.items():
+            if rows is None:
+                continue
+            pixels = np.random.default_rng(self.config['seed']).integers(0, 4096, (rows, columns), dtype=np.uint16)
+            # Multi-frame instances (frames > 1) repeat the frame, e.g. to benchmark large objects
+            self.templates[modality] = pixels.tobytes() * int(self.config['frames'])
+
+    def instances(self, series):
+        for i in range(self.config['instances_per_series']):
+            yield {
+                'SOPInstanceUID': generate_uid(entropy_srcs=[series['SeriesInstanceUID'], str(i)]),
+                'InstanceNumber': i + 1,
+            }
+
+    def instance_count(self):
+        return len(self.series) * self.config['instances_per_series']
+
+    def records(self, level):
+        """
+        Return the records (dicts of element values) of a query level
+        """
+        if level == 'PATIENT':
+            patients = {}
+            for study in self.studies:
+                patients.setdefault(study['PatientID'], study)
+            return list(patients.values())
+        if level == 'STUDY':
+            return self.studies
+        if level == 'SERIES':
+            return [{**series['study'], **series} for series in self.series]
+        return [{**series['study'], **series, **instance, 'SOPClassUID': MODALITIES[series['Modality']][0]}
+            for series in self.series for instance in self.instances(series)]
+
+    def find(self, identifier):
+        level = identifier.QueryRetrieveLevel if 'QueryRetrieveLevel' in identifier else 'STUDY'
+        keys = [elem.keyword for elem in identifier if elem.keyword and elem.keyword != 'QueryRetrieveLevel']
+        for record in self.records(level):
+            if all(match(record.get(key), element_value(identifier, key)) for key in keys if key in record):
+                yield level, record, keys
+
+    def dataset(self, series, instance):
+        sop_class, rows, columns = MODALITIES[series['Modality']]
+        study = series['study']
+        ds = Dataset()
+        ds.SOPClassUID = sop_class
+        ds.SOPInstanceUID = instance['SOPInstanceUID']
+        for keyword in ['PatientID', 'PatientName', 'StudyInstanceUID', 'StudyDate', 'StudyTime',
+                'AccessionNumber', 'StudyDescription']:
+            setattr(ds, keyword, study[keyword])
+        for keyword in ['SeriesInstanceUID', 'SeriesNumber', 'SeriesDescription', 'Modality']:
+            setattr(ds, keyword, series[keyword])
+        ds.InstanceNumber = instance['InstanceNumber']
+        ds.file_meta = FileMetaDataset()
+        ds.file_meta.TransferSyntaxUID = series['transfer_syntax']
+        ds.is_little_endian = True
+        ds.is_implicit_VR = series['transfer_syntax'] == ImplicitVRLittleEndian
+        if rows is None:
+            ds.ValueType = 'CONTAINER'
+            ds.CompletionFlag = 'COMPLETE'
+            ds.VerificationFlag = 'UNVERIFIED'
+            return ds
+        ds.ImagePositionPatient = [0, 0, instance['InstanceNumber']]
+        ds.Rows = rows
+        ds.Columns = columns
+        ds.BitsAllocated = 16
+        ds.BitsStored = 12
+        ds.HighBit = 11
+        ds.PixelRepresentation = 0
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = 'MONOCHROME2'
+        if self.config['frames'] > 1:
+            ds.NumberOfFrames = self.config['frames']
+        ds.PixelData = self.templates[series['Modality']]
+        return ds
+
+    def move(self, identifier):
+        """
+        Return (series, instance) pairs matching a C-MOVE identifier
+        """
+        level = identifier.QueryRetrieveLevel if 'QueryRetrieveLevel' in identifier else 'STUDY'
+        uids = {keyword: element_value(identifier, keyword) for keyword in
+            ['PatientID', 'StudyInstanceUID', 'SeriesInstanceUID', 'SOPInstanceUID']
+            if keyword in identifier and identifier[keyword].value}
+        matches = []
+        for series in self.series:
+            if 'PatientID' in uids and not match(series['study']['PatientID'], uids['PatientID']):
+                continue
+            if 'StudyInstanceUID' in uids and not match(series['study']['StudyInstanceUID'], uids['StudyInstanceUID']):
+                continue
+            if 'SeriesInstanceUID' in uids and not match(series['SeriesInstanceUID'], uids['SeriesInstanceUID']):
+                continue
+            for instance in self.instances(series):
+                if level == 'IMAGE' and 'SOPInstanceUID' in uids and not match(instance['SOPInstanceUID'], uids['SOPInstanceUID']):
+                    continue
+                matches.append((series, instance))
+        return matches
+
+
+class MockPACS(object):
+    """ MockPACS class
+    pynetdicom based Query/Retrieve SCP serving a synthetic catalog. C-FIND results are capped at
+    result_limit (a truncated response ends with Success, like most PACS), C-MOVE sub-operations are
+    C-STOREd to the known move destinations and C-GET sub-operations on the C-GET association. Latency (seconds per C-FIND response / C-STORE) and
+    failures (fraction of C-MOVE / C-GET requests and sub-operations that fail) can be injected.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.catalog = Catalog(config.get('catalog'))
+        self.result_limit = int(config.get('result_limit', 0))
+        self.find_latency = float(config.get('find_latency', 0))
+        self.store_latency = float(config.get('store_latency', 0))
+        self.move_failure_rate = float(config.get('move_failure_rate', 0))
+        self.store_failure_rate = float(config.get('store_failure_rate', 0))
+        self.destinations = config.get('destinations') or {}
+        # PACS without UID list matching reject identifiers with multiple values
+        self.list_matching = bool(config.get('list_matching', True))
+        self.random = random.Random(self.catalog.config['seed'])
+        self.server = None
+        # C-MOVE sub-operations are sent on associations opened by the PACS
+        requeue_stolen_responses()
+
+    def create_ae(self):
+        ae = AE(ae_title=self.config.get('aet', 'MOCKPACS'))
+        ae.maximum_pdu_size = 0
+        ae.maximum_associations = int(self.config.get('max_associations', 10))
+        ae.add_supported_context(Verification)
+        for cx in QueryRetrievePresentationContexts:
+            ae.add_supported_context(cx.abstract_syntax)
+        transfer_syntaxes = list(TRANSFER_SYNTAXES.values())
+        for sop_class, _, _ in MODALITIES.values():
+            ae.add_requested_context(sop_class, transfer_syntaxes)
+            # C-GET sub-operations are sent on the requestor's association (SCP role selection)
+            ae.add_supported_context(sop_class, transfer_syntaxes, scu_role=True, scp_role=True)
+        return ae
+
+    def rejects(self, identifier):
+        return not self.list_matching and any('\\' in element_value(identifier, elem.keyword)
+            for elem in identifier if elem.keyword)
+
+    def handle_find(self, event):
+        if self.rejects(event.identifier):
+            # Unable to process
+            yield 0xC000, None
+            return
+        count = 0
+        for level, record, keys in self.catalog.find(event.identifier):
+            if event.is_cancelled:
+                yield 0xFE00, None
+                return
+            if self.result_limit and count >= self.result_limit:
+                break
+            ds = Dataset()
+            ds.QueryRetrieveLevel = level
+            for key in keys:
+                setattr(ds, key, record.get(key, ''))
+            if self.find_latency:
+                time.sleep(self.find_latency)
+            count += 1
+            yield 0xFF00, ds
+        yield 0x0000, None
+
+    def handle_move(self, event):
+        move_destination = event.move_destination
+        if isinstance(move_destination, bytes):
+            move_destination = move_destination.decode('ascii')
+        destination = self.destinations.get(move_destination.strip())
+        if destination is None:
+            # Move Destination unknown
+            yield None, None
+            return
+        yield destination[0], int(destination[1])
+        yield from self.sub_operations(event)
+
+    def handle_get(self, event):
+        yield from self.sub_operations(event)
+
+    def sub_operations(self, event):
+        """
+        Yield the number of sub-operations of a C-MOVE / C-GET request, then the (status, data set) of each
+        """
+        if self.rejects(event.identifier) or (self.move_failure_rate and self.random.random() < self.move_failure_rate):
+            # Unable to process
+            yield 0
+            yield 0xC000, None
+            return
+
+        matches = self.catalog.move(event.identifier)
+        yield len(matches)
+        for series, instance in matches:
+            if event.is_cancelled:
+                yield 0xFE00, None
+                return
+            if self.store_failure_rate and self.random.random() < self.store_failure_rate:
+                # pynetdicom counts a pending response without a valid data set as a failed sub-operation
+                yield 0xFF00, 'failed'
+                continue
+            if self.store_latency:
+                time.sleep(self.store_latency)
+            yield 0xFF00, self.catalog.dataset(series, instance)
+
+    def start(self, block=False):
+        ae = self.create_ae()
+        handlers = [(evt.EVT_C_FIND, self.handle_find), (evt.EVT_C_MOVE, self.handle_move),
+            (evt.EVT_C_GET, self.handle_get)]
+        address = (self.config.get('hostname', '127.0.0.1'), int(self.config.get('port', 11112)))
+        self.server = ae.start_server(address, block=block, evt_handlers=handlers)
+        return self.server
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+
+
+def serve(config):
+    """
+    Run a mock PACS until the process is terminated, e.g. in a multiprocessing.Process
+    """
+    MockPACS(config).start(block=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Mock PACS serving a synthetic catalog')
+    parser.add_argument('-c', '--config', help='YAML file with the mock PACS settings (see benchmarks/scenarios.yml)')
+    parser.add_argument('-p', '--port', type=int, default=11112)
+    args = parser.parse_args()
+    config = {'port': args.port}
+    if args.config:
+        with open(args.config) as file:
+            config.update(yaml.load(file, Loader=yaml.FullLoader).get('pacs', {}))
+    pacs = MockPACS(config)
+    print('Mock PACS {} serving {} studies / {} instances on port {}'.format(
+        config.get('aet', 'MOCKPACS'), len(pacs.catalog.studies), pacs.catalog.instance_count(), config['port']))
+    pacs.start(block=True)
+
+
+if __name__ == '__main__':
+    main()
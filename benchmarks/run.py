@@ -0,0 +1,202 @@
+import os
+import sys
+import csv
+import json
+import time
+import shutil
+import socket
+import argparse
+import tempfile
+import resource
+import threading
+import multiprocessing
+
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from mock_pacs import Catalog, serve
+
+
+PACS_PORT = 11112
+LOCAL_PORT = 11113
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError('Mock PACS did not start on port {}'.format(port))
+
+
+def extraction_config(scenario, directory):
+    """
+    Return the extraction config of a scenario, in the format of config/dicom-template.yml
+    """
+    operation = scenario['operation']
+    config = {
+        'common': {
+            'pacs': {'hostname': '127.0.0.1', 'port': PACS_PORT, 'aet': 'MOCKPACS'},
+            'local': {'port': LOCAL_PORT, 'aet': 'BENCHMARK'},
+            'schedule': {'enabled': False},
+            'output': {'directory': directory, 'database_file': 'database.csv'},
+            **(scenario.get('common') or {}),
+        },
+        operation: dict(scenario[operation]),
+    }
+    if operation in ['c-move', 'c-get']:
+        # Retrieve every study of the catalog
+        batch_file = os.path.join(directory, 'studies.csv')
+        os.makedirs(directory, exist_ok=True)
+        with open(batch_file, 'w', newline='') as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=['StudyInstanceUID'], dialect='excel')
+            writer.writeheader()
+            for study in Catalog(scenario['pacs'].get('catalog')).studies:
+                writer.writerow({'StudyInstanceUID': study['StudyInstanceUID']})
+        config[operation]['elements_batch_file'] = batch_file
+    return config
+
+
+def run_extraction(scenario, directory, results):
+    """
+    Run the extraction of a scenario. Runs in its own process so that the peak RSS and the metrics
+    only account for this scenario.
+    """
+    from common import merge_configs
+    from scu import process_request_batch
+    from scp import SCP
+    from journal import Journal, COMPLETED, FAILED
+    from metrics import metrics
+
+    operation = scenario['operation']
+    config = merge_configs(extraction_config(scenario, directory), operation)
+    # Highest number of threads of the extraction process, sampled while it runs
+    peak_threads = [threading.active_count()]
+    running = threading.Event()
+    running.set()
+
+    def sample_threads():
+        while running.is_set():
+            peak_threads[0] = max(peak_threads[0], threading.active_count())
+            time.sleep(0.05)
+    threading.Thread(target=sample_threads, daemon=True).start()
+    time_start = time.time()
+    scp = None
+    if operation in ['c-move', 'c-get']:
+        scp = SCP(config)
+        scp.start_server()
+    process_request_batch(config, scp)
+    if scp:
+        scp.stop_server()
+    elapsed = time.time() - time_start
+    running.clear()
+
+    journal = Journal(directory)
+    summary = metrics.summary()
+    if scp:
+        instances = scp.file_count
+    else:
+        responses = summary['histograms'].get('pydicombatch_responses_per_request')
+        instances = responses['sum'] if responses else 0
+    self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    mb = summary['counters'].get('pydicombatch_bytes_received_total', 0) / 1e6
+    results.put({
+        'seconds': round(elapsed, 2),
+        'requests': journal.count(COMPLETED, FAILED),
+        'failed': journal.count(FAILED),
+        'requests/s': round(journal.count(COMPLETED, FAILED) / elapsed, 2),
+        'instances': instances,
+        'instances/s': round(instances / elapsed, 2),
+        'MB': round(mb, 1),
+        'MB/s': round(mb / elapsed, 2),
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_MB': round(self_rss / 1024, 1),
+        'peak_rss_children_MB': round(children_rss / 1024, 1),
+        'peak_threads': peak_threads[0],
+    })
+    journal.close()
+
+
+def run_scenario(name, scenario, workdir):
+    directory = os.path.join(workdir, name)
+    shutil.rmtree(directory, ignore_errors=True)
+    pacs_config = {'port': PACS_PORT, 'aet': 'MOCKPACS', **scenario['pacs'],
+        'destinations': {'BENCHMARK': ['127.0.0.1', LOCAL_PORT]}}
+    pacs = multiprocessing.Process(target=serve, args=(pacs_config,), daemon=True)
+    pacs.start()
+    try:
+        wait_for_port(PACS_PORT)
+        results = multiprocessing.Queue()
+        extraction = multiprocessing.Process(target=run_extraction, args=(scenario, directory, results))
+        extraction.start()
+        result = results.get()
+        extraction.join()
+    finally:
+        pacs.terminate()
+        pacs.join()
+    return result
+
+
+def check_result(name, scenario, result):
+    """
+    Return the problems of a scenario run without failure injection: failed requests, or for C-MOVE / C-GET
+    a number of received instances that differs from the size of the catalog
+    """
+    pacs = scenario['pacs']
+    if pacs.get('move_failure_rate') or pacs.get('store_failure_rate'):
+        return []
+    problems = []
+    if result['failed']:
+        problems.append('{}: {} failed requests'.format(name, result['failed']))
+    if scenario['operation'] in ['c-move', 'c-get']:
+        expected = Catalog(pacs.get('catalog')).instance_count()
+        if result['instances'] != expected:
+            problems.append('{}: {} instances received, {} expected'.format(name, result['instances'], expected))
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark extractions against a local mock PACS')
+    parser.add_argument('-c', '--config', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scenarios.yml'),
+        help='YAML file with the benchmark scenarios (default: benchmarks/scenarios.yml)')
+    parser.add_argument('-s', '--scenario', action='append', help='Scenario to run (default: all scenarios)')
+    parser.add_argument('-d', '--directory', help='Working directory (default: a temporary directory)')
+    parser.add_argument('-o', '--output', help='Write the results to a JSON file')
+    args = parser.parse_args()
+
+    with open(args.config) as file:
+        scenarios = yaml.load(file, Loader=yaml.FullLoader)
+    names = args.scenario or list(scenarios)
+    workdir = args.directory or tempfile.mkdtemp(prefix='pydicombatch-benchmark-')
+
+    results = {}
+    for name in names:
+        print('\n=== {} ==='.format(name))
+        results[name] = run_scenario(name, scenarios[name], workdir)
+
+    columns = ['seconds', 'requests', 'failed', 'requests/s', 'instances', 'instances/s', 'MB/s', 'peak_rss_MB',
+        'peak_threads']
+    print('\n{:<24}'.format('scenario') + ''.join('{:>14}'.format(c) for c in columns))
+    for name, result in results.items():
+        print('{:<24}'.format(name) + ''.join('{:>14}'.format(result[c]) for c in columns))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if not args.directory:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    problems = [problem for name, result in results.items() for problem in check_result(name, scenarios[name], result)]
+    if problems:
+        print('\n' + '\n'.join(problems))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
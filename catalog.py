@@ -0,0 +1,142 @@
+import os
+import re
+import time
+import sqlite3
+import threading
+
+from pynetdicom.apps.common import ElementPath
+
+
+COLUMNS = ['sop_instance_uid', 'received_sop_instance_uid', 'study_instance_uid', 'series_instance_uid',
+    'path', 'size', 'transfer_syntax', 'stored_at', 'offset']
+
+
+def column_name(keyword):
+    """
+    Return the catalog column of an extra header element, e.g. PatientID -> patient_id
+    """
+    return re.sub(r'(?<!^)(?=[A-Z])', '_', keyword).lower()
+
+
+class InstanceCatalog(object):
+    """ InstanceCatalog class
+    SQLite (WAL) index of the instances written to the output: SOP / Study / Series Instance UIDs, final
+    path (and offset in its shard for archived instances), size, transfer syntax and the extra header
+    elements of output.catalog.columns. Instances are also indexed by the SOP Instance UID they were
+    received with (before anonymization), so that instances sent again by the PACS can be acknowledged
+    without being decoded or written.
+    Rows are buffered and written in batches of batch_size rows (or every flush_interval seconds).
+    """
+
+    def __init__(self, directory, columns=None, batch_size=500, flush_interval=5.0):
+        self.path = os.path.join(directory, 'catalog.db')
+        os.makedirs(directory, exist_ok=True)
+        self.keywords = [ElementPath(x).keyword for x in (columns or [])]
+        self.extra_columns = [column_name(keyword) for keyword in self.keywords]
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.last_flush = time.time()
+        # The catalog may be shared by several worker processes of the same host (WAL mode)
+        self.connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=60)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS instances (
+            sop_instance_uid TEXT PRIMARY KEY,
+            received_sop_instance_uid TEXT NOT NULL,
+            study_instance_uid TEXT,
+            series_instance_uid TEXT,
+            path TEXT NOT NULL,
+            size INTEGER,
+            transfer_syntax TEXT,
+            stored_at REAL NOT NULL,
+            offset INTEGER)''')
+        self.connection.execute('CREATE UNIQUE INDEX IF NOT EXISTS instances_received ON instances (received_sop_instance_uid)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS instances_series ON instances (study_instance_uid, series_instance_uid)')
+        existing = [row[1] for row in self.connection.execute('PRAGMA table_info(instances)')]
+        # offset was added with the tar output sink, catalogs created before lack it
+        if 'offset' not in existing:
+            self.connection.execute('ALTER TABLE instances ADD COLUMN offset INTEGER')
+        for column in self.extra_columns:
+            if column not in existing:
+                self.connection.execute('ALTER TABLE instances ADD COLUMN {} TEXT'.format(column))
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Return an InstanceCatalog for output.catalog, or None if the catalog is disabled
+        """
+        catalog = config['output'].get('catalog') or {}
+        if not catalog.get('enabled'):
+            return None
+        return cls(config['output']['directory'], catalog.get('columns'),
+            batch_size=int(catalog.get('batch_size', 500)),
+            flush_interval=float(catalog.get('flush_interval', 5.0)))
+
+    def tags(self):
+        """
+        Return the tags of the header elements stored in the catalog
+        """
+        return [ElementPath(keyword).tag for keyword in
+            ['SOPInstanceUID', 'StudyInstanceUID', 'SeriesInstanceUID'] + self.keywords]
+
+    def add(self, ds, received_uid, path, size, transfer_syntax, offset=None):
+        """
+        Add an instance written to path (at offset for instances in a tar shard). ds holds (at least) the
+        header elements of the written file.
+        """
+        received_uid = str(received_uid)
+
+        def value(keyword):
+            return str(ds[keyword].value) if keyword in ds else None
+        row = [value('SOPInstanceUID') or received_uid, received_uid, value('StudyInstanceUID'),
+            value('SeriesInstanceUID'), path, size, str(transfer_syntax), time.time(), offset]
+        row += [value(keyword) for keyword in self.keywords]
+        with self.lock:
+            self.pending[received_uid] = row
+            flush = len(self.pending) >= self.batch_size or time.time() - self.last_flush >= self.flush_interval
+        if flush:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            rows = list(self.pending.values())
+            columns = COLUMNS + self.extra_columns
+            query = 'INSERT OR REPLACE INTO instances ({}) VALUES ({})'.format(
+                ','.join(columns), ','.join('?' * len(columns)))
+            with self.connection:
+                self.connection.execute('BEGIN')
+                self.connection.executemany(query, rows)
+            self.pending = {}
+            self.last_flush = time.time()
+
+    def contains(self, received_uid):
+        """
+        Return True if the instance received with this SOP Instance UID is in the catalog and its file exists
+        """
+        received_uid = str(received_uid)
+        with self.lock:
+            if received_uid in self.pending:
+                return True
+            row = self.connection.execute('SELECT path FROM instances WHERE received_sop_instance_uid = ?',
+                (received_uid,)).fetchone()
+        return row is not None and os.path.isfile(row[0])
+
+    def series_instances(self, study_uid, series_uid):
+        """
+        Return the (path, offset, size) of the instances of a series
+        """
+        with self.lock:
+            rows = self.connection.execute('SELECT path, offset, size FROM instances '
+                'WHERE study_instance_uid = ? AND series_instance_uid = ?', (study_uid, series_uid)).fetchall()
+        return [tuple(row) for row in rows]
+
+    def count(self):
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM instances').fetchone()[0] + len(self.pending)
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            self.connection.close()
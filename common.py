@@ -1,18 +1,28 @@
 import yaml
 from scu import process_request_batch
 from scp import SCP
+from journal import Journal, FAILED
+from metrics import metrics
+from coordinator import coordinate, run_worker
 import os
 import sys
 
 def merge_configs(config, operation):
     """Merge common config with operation-specific config"""
+    section = operation
+    if operation == 'c-get' and operation not in config:
+        # C-GET retrieves the requests of the c-move section unless the config has a c-get section
+        section = 'c-move'
     merged = {
         'pacs': config['common']['pacs'],
         'local': config['common']['local'],
         'schedule': config['common']['schedule'],
+        'pool': config['common'].get('pool', {}),
+        'metrics': config['common'].get('metrics', {}),
+        'workers': config['common'].get('workers', {}),
         'request': {
             'type': operation,
-            **config[operation]
+            **config[section]
         }
     }
     
@@ -22,16 +32,16 @@ def merge_configs(config, operation):
     if 'output' in config['common']:
         merged['output'].update(config['common']['output'])
     # Override/add operation-specific output settings
-    if 'output' in config[operation]:
-        merged['output'].update(config[operation]['output'])
+    if 'output' in config[section]:
+        merged['output'].update(config[section]['output'])
         
-    # Add anonymization settings for c-move if they exist
-    if operation == 'c-move' and 'anonymization' in config[operation]:
-        merged['anonymization'] = config[operation]['anonymization']
+    # Add anonymization settings for c-move / c-get if they exist
+    if operation in ['c-move', 'c-get'] and 'anonymization' in config[section]:
+        merged['anonymization'] = config[section]['anonymization']
         
     return merged
 
-def pydicombatch(config_file, operation):
+def pydicombatch(config_file, operation, workers=0, worker=None):
     with open(config_file) as file:
         config = yaml.load(file, Loader=yaml.FullLoader)
         
@@ -40,25 +50,35 @@ def pydicombatch(config_file, operation):
         
         print('Running {} extraction defined in: {}'.format(operation, config_file))
 
-        if operation == 'c-move':
-            scp = SCP(merged_config)
-            scp.start_server()
+        if worker is not None:
+            # Worker joining an extraction prepared by a coordinator (main.py --workers)
+            run_worker(merged_config, worker)
+            return
+
+        scp = None
+        if not workers:
+            metrics.start(merged_config)
+            if operation in ['c-move', 'c-get']:
+                scp = SCP(merged_config)
+                scp.start_server()
         try:
-            process_request_batch(merged_config)
+            if workers:
+                coordinate(merged_config, workers)
+            else:
+                process_request_batch(merged_config, scp)
+            if scp:
+                # Wait for the received files to be post-processed and written
+                scp.stop_server()
         except KeyboardInterrupt:
             print('\b\b\r')
             print('\nExtraction stopped. To resume extraction, please re-execute the script.')
-            if operation == 'c-move':
+            if scp:
                 scp.stop_server()
 
-            # For c-move, use the output directory for failed requests
-            # For c-find, use the directory of the database file
-            if operation == 'c-move':
-                failed_dir = merged_config['output']['directory']
-            else:
-                failed_dir = os.path.dirname(merged_config['output']['database_file'])
-                
-            filepath_requests_failed = os.path.join(failed_dir, 'requests.failed')
-            if os.path.exists(filepath_requests_failed):
+            journal = Journal(merged_config['output']['directory'])
+            if journal.count(FAILED):
                 print('Failed requests detected. To re-try failed request, re-run batch request.')
-            sys.exit(0)
\ No newline at end of file
+            journal.close()
+            sys.exit(0)
+        finally:
+            metrics.stop(merged_config['output']['directory'])
\ No newline at end of file
@@ -0,0 +1,112 @@
+import os
+import copy
+import time
+import multiprocessing
+import tqdm
+
+from scu import process_worker, load_requests
+from scp import SCP
+from journal import Journal, COMPLETED, FAILED, SPLIT, CANCELLED
+from metrics import metrics
+
+
+def worker_config(config, worker):
+    """
+    Return the config of a worker process: its own local AE (workers.local[worker], or local.port + worker),
+    temporary directory, result database file, series export table and metrics files.
+    C-MOVE sub-operations are sent to the host / port the PACS registered for the move destination AE
+    title, so with C-MOVE each worker must have its own AE title in workers.local.
+    """
+    config = copy.deepcopy(config)
+    workers = config.get('workers') or {}
+    local = workers.get('local') or []
+    if config['request']['type'].lower() == 'c-move':
+        if worker >= len(local) or not local[worker].get('aet'):
+            raise ValueError('C-MOVE worker {} needs its own AE title, registered with the PACS, in '
+                'workers.local'.format(worker))
+        titles = [x.get('aet') for x in local]
+        if titles.count(local[worker]['aet']) > 1:
+            raise ValueError('The AE title of C-MOVE worker {} is used by another worker: {}'.format(
+                worker, local[worker]['aet']))
+    if worker < len(local):
+        config['local'] = {**config['local'], **local[worker]}
+    else:
+        config['local']['port'] = int(config['local']['port']) + worker
+    config['output']['tmp_directory'] = 'tmp-{}'.format(worker)
+    stem, ext = os.path.splitext(config['output']['database_file'])
+    config['output']['database_file'] = '{}-{}{}'.format(stem, worker, ext)
+    export = config['output'].get('export') or {}
+    if export.get('enabled'):
+        stem, ext = os.path.splitext(export.get('table_file', 'series.{}'.format(export.get('table_format', 'csv'))))
+        export['table_file'] = '{}-{}{}'.format(stem, worker, ext)
+
+    metrics_config = config.get('metrics') or {}
+    if metrics_config.get('textfile'):
+        stem, ext = os.path.splitext(metrics_config['textfile'])
+        metrics_config['textfile'] = '{}-{}{}'.format(stem, worker, ext)
+    if metrics_config.get('http_port'):
+        metrics_config['http_port'] = int(metrics_config['http_port']) + worker
+    metrics_config['summary_file'] = os.path.join(config['output']['directory'], 'metrics-{}.json'.format(worker))
+    config['metrics'] = metrics_config
+    return config
+
+
+def run_worker(config, worker):
+    """
+    Run a worker process: claim requests from the shared journal until none is left. With C-MOVE, the
+    worker runs its own storage SCP (with C-GET, its own post-processing pipeline).
+    """
+    config = worker_config(config, worker)
+    metrics.start(config)
+    scp = None
+    if config['request']['type'].lower() in ['c-move', 'c-get']:
+        scp = SCP(config)
+        scp.start_server()
+    try:
+        process_worker(config, 'worker-{}@{}'.format(worker, os.uname().nodename), scp)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if scp:
+            scp.stop_server()
+        metrics.stop()
+
+
+def coordinate(config, workers):
+    """
+    Prepare the requests of an extraction and process them with several local worker processes.
+    More workers can join with main.py --worker, on the same host: the journal is a SQLite WAL database,
+    which cannot be shared through a network file system.
+    """
+    # Check the local AE of each worker before preparing the requests
+    for worker in range(workers):
+        worker_config(config, worker)
+    journal = Journal(config['output']['directory'])
+    # New requests are generated into the journal before the workers start claiming them
+    if not sum(1 for _ in load_requests(config, journal)):
+        print('No further requests pending')
+        journal.close()
+        return
+
+    print('To stop extraction, press CTRL-C. Extraction can be resumed at a later time.')
+    # Workers are started with spawn since the coordinator may already run threads
+    context = multiprocessing.get_context('spawn')
+    processes = [context.Process(target=run_worker, args=(config, worker)) for worker in range(workers)]
+    for process in processes:
+        process.start()
+
+    pbar = tqdm.tqdm(desc='Sending {} requests ({} workers) '.format(config['request']['type'], workers), unit='rqst')
+    try:
+        while any(process.is_alive() for process in processes):
+            pbar.total = journal.count() - journal.count(CANCELLED)
+            pbar.n = journal.count(COMPLETED, FAILED, SPLIT)
+            pbar.refresh()
+            time.sleep(1)
+    except KeyboardInterrupt:
+        # Workers receive the interrupt too and stop on their own
+        for process in processes:
+            process.join()
+        raise
+    finally:
+        pbar.close()
+        journal.close()
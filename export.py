@@ -0,0 +1,237 @@
+import os
+import time
+import shutil
+import threading
+import collections
+import multiprocessing
+from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import tqdm
+from pydicom import dcmread
+from pynetdicom.apps.common import ElementPath
+
+from archive import read_instance
+from sink import ResultWriter
+from metrics import metrics
+
+try:
+    import zarr
+except ImportError:
+    zarr = None
+
+
+def open_instance(location, stop_before_pixels=False):
+    """
+    Read an instance from its (path, offset, size) location: a file, or a member of a tar shard
+    """
+    path, offset, size = location
+    if offset is None:
+        return dcmread(path, stop_before_pixels=stop_before_pixels)
+    return dcmread(BytesIO(read_instance(path, offset, size)), stop_before_pixels=stop_before_pixels)
+
+def rescale(ds):
+    """
+    Return the (slope, intercept) of an instance, from the shared functional groups of enhanced objects
+    """
+    if 'RescaleSlope' in ds or 'RescaleIntercept' in ds:
+        return float(ds.get('RescaleSlope', 1) or 1), float(ds.get('RescaleIntercept', 0) or 0)
+    try:
+        transformation = ds.SharedFunctionalGroupsSequence[0].PixelValueTransformationSequence[0]
+        return float(transformation.RescaleSlope), float(transformation.RescaleIntercept)
+    except (AttributeError, IndexError, KeyError):
+        return 1.0, 0.0
+
+def trim_npy(path, shape, dtype):
+    """
+    Keep the first shape[0] frames of a .npy array, copied one frame at a time to a new file
+    """
+    source = np.load(path, mmap_mode='r')
+    trimmed_path = path + '.tmp'
+    trimmed = np.lib.format.open_memmap(trimmed_path, mode='w+', dtype=dtype, shape=shape)
+    for i in range(shape[0]):
+        trimmed[i] = source[i]
+    trimmed.flush()
+    del trimmed, source
+    os.replace(trimmed_path, path)
+
+def export_series(directory, format, dtype, locations):
+    """
+    Write the instances of a series as a single (frames, rows, columns[, samples]) array and return its
+    metadata row, or None if no frame could be exported. Runs in a worker process. Instances are ordered by
+    InstanceNumber and decoded one at a time, so that the series is never held in memory as a whole.
+    """
+    headers = []
+    for location in locations:
+        try:
+            headers.append((open_instance(location, stop_before_pixels=True), location))
+        except Exception:
+            pass
+    headers = [(ds, location) for ds, location in headers if 'Rows' in ds and 'Columns' in ds]
+    if not headers:
+        return None
+    headers.sort(key=lambda x : (int(x[0].get('InstanceNumber', 0) or 0), str(x[0].SOPInstanceUID)))
+
+    # Instances that do not match the most common frame shape are left out
+    shape_of = lambda ds : (int(ds.Rows), int(ds.Columns), int(ds.get('SamplesPerPixel', 1)))
+    frame_shape = collections.Counter(shape_of(ds) for ds, _ in headers).most_common(1)[0][0]
+    selected = [(ds, location) for ds, location in headers if shape_of(ds) == frame_shape]
+    frames = sum(int(ds.get('NumberOfFrames', 1) or 1) for ds, _ in selected)
+    shape = (frames,) + frame_shape[:2] + (frame_shape[2:] if frame_shape[2] > 1 else ())
+
+    first = selected[0][0]
+    series_dir = os.path.join(directory, str(first.StudyInstanceUID))
+    os.makedirs(series_dir, exist_ok=True)
+    path = os.path.join(series_dir, '{}.{}'.format(first.SeriesInstanceUID, format))
+    if format == 'zarr':
+        array = zarr.open_array(path, mode='w', shape=shape, chunks=(1,) + shape[1:], dtype=dtype)
+    else:
+        # Written through a memory map, in the .npy format so that loaders can map it with np.load(mmap_mode='r')
+        array = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+
+    index = 0
+    failed = 0
+    rescales = set()
+    for ds, location in selected:
+        try:
+            ds = open_instance(location)
+            pixels = ds.pixel_array.reshape((-1,) + shape[1:])
+        except Exception:
+            failed += 1
+            continue
+        slope, intercept = rescale(ds)
+        rescales.add((slope, intercept))
+        if slope != 1 or intercept != 0:
+            pixels = pixels.astype(np.float32) * slope + intercept
+        array[index:index + len(pixels)] = pixels.astype(dtype, copy=False)
+        index += len(pixels)
+    if format == 'npy':
+        array.flush()
+        del array
+
+    if not index:
+        # No instance could be decoded
+        if format == 'zarr':
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            os.remove(path)
+        return None
+    if index < frames:
+        # Frames of the instances that could not be decoded are left out of the array
+        shape = (index,) + shape[1:]
+        if format == 'zarr':
+            array.resize(shape)
+        else:
+            trim_npy(path, shape, dtype)
+
+    # The array is rescaled per instance: the slope / intercept are only reported if they are the same for
+    #   all the exported instances
+    slope, intercept = rescales.pop() if len(rescales) == 1 else ('', '')
+
+    return {
+        'StudyInstanceUID': str(first.StudyInstanceUID),
+        'SeriesInstanceUID': str(first.SeriesInstanceUID),
+        'PatientID': str(first.get('PatientID', '')),
+        'Modality': str(first.get('Modality', '')),
+        'SeriesDescription': str(first.get('SeriesDescription', '')),
+        'PixelSpacing': '\\'.join(str(x) for x in first.get('PixelSpacing', [])),
+        'SliceThickness': str(first.get('SliceThickness', '')),
+        'RescaleSlope': str(slope),
+        'RescaleIntercept': str(intercept),
+        'Path': os.path.relpath(path, directory),
+        'Format': format,
+        'DType': str(np.dtype(dtype)),
+        'Shape': 'x'.join(str(x) for x in shape),
+        'Instances': str(len(selected)),
+        # Instances left out because of their shape or because their pixel data could not be decoded
+        'SkippedInstances': str(len(headers) - len(selected) + failed),
+        'ExportedFrames': str(index),
+    }
+
+
+class SeriesExporter(object):
+    """ SeriesExporter class
+    Exports each series received during the extraction as an array ready to be memory-mapped by training
+    loaders (.npy, or Zarr with one chunk per frame), with the rescale slope / intercept applied and a
+    normalized dtype, and writes one metadata row per series to a table (CSV, Parquet or Arrow).
+    Series are exported once the received files are written, on a pool of worker processes. With the
+    catalog, all the instances of a series in the output are exported, including those of previous runs.
+    """
+
+    def __init__(self, directory, format='npy', dtype='float32', table_file='series.csv', table_format='csv',
+            workers=None):
+        if format == 'zarr' and zarr is None:
+            raise ImportError('zarr is required to export series in zarr format')
+        self.directory = directory
+        self.format = format
+        self.dtype = dtype
+        self.table_file = table_file
+        self.table_format = table_format
+        self.workers = workers
+        self.series = collections.defaultdict(set)
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Return a SeriesExporter for output.export, or None if the export is disabled
+        """
+        export = config['output'].get('export') or {}
+        if not export.get('enabled'):
+            return None
+        format = str(export.get('format', 'npy')).lower()
+        if format not in ['npy', 'zarr']:
+            raise ValueError('Unknown export format: {}'.format(format))
+        table_format = str(export.get('table_format', 'csv')).lower()
+        return cls(os.path.join(config['output']['directory'], export.get('directory', 'export')),
+            format=format,
+            dtype=str(export.get('dtype', 'float32')),
+            table_file=export.get('table_file', 'series.{}'.format(table_format)),
+            table_format=table_format,
+            workers=export.get('workers'))
+
+    def tags(self):
+        return [ElementPath(keyword).tag for keyword in ['StudyInstanceUID', 'SeriesInstanceUID']]
+
+    def add(self, ds, location):
+        """
+        Record an instance written to the output at location (path, offset, size)
+        """
+        with self.lock:
+            self.series[(str(ds.StudyInstanceUID), str(ds.SeriesInstanceUID))].add(location)
+
+    def run(self, catalog=None):
+        """
+        Export the series received during the extraction
+        """
+        with self.lock:
+            series = dict(self.series)
+            self.series.clear()
+        if not series:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        table = ResultWriter(os.path.join(self.directory, self.table_file), format=self.table_format)
+        pbar = tqdm.tqdm(total=len(series), desc='Exporting series ', unit='series')
+        # Workers are started with spawn since the SCP threads may still be running
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+            futures = []
+            time_start = time.perf_counter()
+            for (study_uid, series_uid), locations in series.items():
+                if catalog:
+                    locations = set(locations) | set(catalog.series_instances(study_uid, series_uid))
+                futures.append(executor.submit(export_series, self.directory, self.format, self.dtype,
+                    sorted(locations, key=lambda x : (x[0], x[1] or 0))))
+            for future in as_completed(futures):
+                # Includes the time spent waiting for a worker process
+                metrics.observe('pydicombatch_postprocess_duration_seconds', time.perf_counter() - time_start,
+                    step='export')
+                try:
+                    row = future.result()
+                    if row:
+                        table.write([row])
+                except Exception as exc:
+                    print('\nSeries export failed: {}'.format(exc))
+                pbar.update(1)
+        pbar.close()
+        table.close()
@@ -0,0 +1,268 @@
+import os
+import ast
+import csv
+import json
+import time
+import hashlib
+import collections
+import sqlite3
+import threading
+
+
+PENDING = 'pending'
+RUNNING = 'running'
+COMPLETED = 'completed'
+FAILED = 'failed'
+SPLIT = 'split'
+CANCELLED = 'cancelled'
+
+
+def request_to_json(request):
+    """
+    Serialize a request, leaving out private keys (e.g. '_parts' of merged requests)
+    """
+    if isinstance(request, collections.ChainMap):
+        # Requests generated from a batch file hold their own elements on top of the shared template
+        merged = {}
+        for mapping in reversed(request.maps):
+            merged.update(mapping)
+        request = merged
+    return json.dumps({k: v for k, v in request.items() if not k.startswith('_')}, sort_keys=True, default=str)
+
+def request_key(request):
+    return hashlib.sha1(request_to_json(request).encode('utf-8')).hexdigest()
+
+def journal_rows(requests, now):
+    rows = []
+    for request in requests:
+        serialized = request_to_json(request)
+        rows.append((hashlib.sha1(serialized.encode('utf-8')).hexdigest(), serialized, now))
+    return rows
+
+def parse_csv_value(value):
+    """
+    Parse a value of a CSV journal back into its Python type
+    """
+    try:
+        return ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        return value
+
+
+class Journal(object):
+    """ Journal class
+    Transactional SQLite (WAL) journal holding the state of every request of an extraction:
+    pending, running, completed, failed, split (re-issued as smaller requests) or cancelled.
+    It replaces the requests.whole / requests.completed / requests.failed CSV files and can import them.
+    Several worker processes of the same host can share a journal: they claim requests with a lease (see
+    claim). WAL mode relies on shared memory, the journal must not be shared between hosts.
+    New requests are added in batches while they are generated; the number of requests generated so far
+    is kept with them so that an interrupted generation can be resumed (see generation).
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = os.path.join(directory, 'requests.db')
+        os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        # Other worker processes may hold the write lock for a short time
+        self.connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=60)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS requests (
+            id INTEGER PRIMARY KEY,
+            key TEXT NOT NULL UNIQUE,
+            request TEXT NOT NULL,
+            state TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            result_count INTEGER,
+            created_at REAL NOT NULL,
+            started_at REAL,
+            finished_at REAL)''')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS requests_state ON requests (state)')
+        # Lease columns, added to journals created before worker processes were supported
+        existing = [row[1] for row in self.connection.execute('PRAGMA table_info(requests)')]
+        for column, column_type in [('worker', 'TEXT'), ('lease_expires', 'REAL')]:
+            if column not in existing:
+                self.connection.execute('ALTER TABLE requests ADD COLUMN {} {}'.format(column, column_type))
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS generation (
+            id INTEGER PRIMARY KEY CHECK (id = 0),
+            generated INTEGER NOT NULL,
+            complete INTEGER NOT NULL)''')
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def add(self, requests, generated=None, complete=False):
+        """
+        Add requests in a single transaction. Requests already in the journal are left unchanged.
+        generated is the number of requests generated so far, including these, and complete is True once
+        the generation is done.
+        """
+        rows = journal_rows(requests, time.time())
+        with self.lock:
+            with self.connection:
+                self.connection.execute('BEGIN')
+                self.connection.executemany(
+                    'INSERT OR IGNORE INTO requests (key, request, created_at) VALUES (?, ?, ?)', rows)
+                if generated is not None:
+                    self.connection.execute('INSERT OR REPLACE INTO generation (id, generated, complete) '
+                        'VALUES (0, ?, ?)', (generated, int(complete)))
+
+    def generation(self):
+        """
+        Return (number of requests generated, complete). Journals without generation progress (created
+        before it was recorded, or imported) are complete.
+        """
+        with self.lock:
+            row = self.connection.execute('SELECT generated, complete FROM generation').fetchone()
+        return (row[0], bool(row[1])) if row else (self.count(), True)
+
+    def reset(self):
+        with self.lock:
+            with self.connection:
+                self.connection.execute('BEGIN')
+                self.connection.execute('DELETE FROM requests')
+                self.connection.execute('INSERT OR REPLACE INTO generation (id, generated, complete) VALUES (0, 0, 0)')
+
+    def count(self, *states):
+        with self.lock:
+            if states:
+                query = 'SELECT COUNT(*) FROM requests WHERE state IN ({})'.format(','.join('?' * len(states)))
+                return self.connection.execute(query, states).fetchone()[0]
+            return self.connection.execute('SELECT COUNT(*) FROM requests').fetchone()[0]
+
+    def requests(self, *states):
+        """
+        Return the requests in any of the given states, in insertion order
+        """
+        query = 'SELECT request FROM requests WHERE state IN ({}) ORDER BY id'.format(','.join('?' * len(states)))
+        with self.lock:
+            rows = self.connection.execute(query, states).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def durations(self, limit=200):
+        """
+        Return the durations in seconds of the last completed requests
+        """
+        with self.lock:
+            rows = self.connection.execute('SELECT finished_at - started_at FROM requests WHERE state = ? '
+                'AND started_at IS NOT NULL AND finished_at >= started_at ORDER BY finished_at DESC LIMIT ?',
+                (COMPLETED, limit)).fetchall()
+        return [row[0] for row in reversed(rows)]
+
+    def transition(self, request, state, from_states, result_count=None):
+        """
+        Atomically move a request to a new state. Returns False if the request was not in from_states.
+        """
+        now = time.time()
+        query = 'UPDATE requests SET state = ?, {} WHERE key = ? AND state IN ({})'.format(
+            'attempts = attempts + 1, started_at = ?' if state == RUNNING else 'result_count = ?, finished_at = ?',
+            ','.join('?' * len(from_states)))
+        params = [state] + ([now] if state == RUNNING else [result_count, now]) + [request_key(request)] + list(from_states)
+        with self.lock:
+            return self.connection.execute(query, params).rowcount > 0
+
+    def start(self, request):
+        return self.transition(request, RUNNING, (PENDING, RUNNING, FAILED))
+
+    def complete(self, request, result_count=None):
+        return self.transition(request, COMPLETED, (PENDING, RUNNING), result_count)
+
+    def fail(self, request):
+        return self.transition(request, FAILED, (PENDING, RUNNING))
+
+    def split(self, request, children, result_count=None):
+        """
+        Replace a request by smaller requests in a single transaction
+        """
+        now = time.time()
+        rows = journal_rows(children, now)
+        with self.lock:
+            with self.connection:
+                self.connection.execute('BEGIN')
+                self.connection.executemany(
+                    'INSERT OR IGNORE INTO requests (key, request, created_at) VALUES (?, ?, ?)', rows)
+                self.connection.execute(
+                    'UPDATE requests SET state = ?, result_count = ?, finished_at = ? WHERE key = ?',
+                    (SPLIT, result_count, now, request_key(request)))
+
+    def claim(self, worker, lease_time, predicate=None):
+        """
+        Claim the next pending request (or running request whose lease expired) for a worker and
+        return it, or None. With a predicate, the request is only claimed if predicate(request) is True.
+        """
+        now = time.time()
+        with self.lock:
+            with self.connection:
+                self.connection.execute('BEGIN IMMEDIATE')
+                row = self.connection.execute(
+                    'SELECT id, request FROM requests WHERE state = ? OR (state = ? AND '
+                    '(lease_expires IS NULL OR lease_expires < ?)) ORDER BY id LIMIT 1',
+                    (PENDING, RUNNING, now)).fetchone()
+                if row is None:
+                    return None
+                request = json.loads(row[1])
+                if predicate and not predicate(request):
+                    return None
+                self.connection.execute(
+                    'UPDATE requests SET state = ?, worker = ?, lease_expires = ?, started_at = ? WHERE id = ?',
+                    (RUNNING, worker, now + lease_time, now, row[0]))
+        return request
+
+    def renew(self, worker, lease_time):
+        """
+        Extend the leases of the requests a worker is running
+        """
+        with self.lock:
+            self.connection.execute('UPDATE requests SET lease_expires = ? WHERE worker = ? AND state = ?',
+                (time.time() + lease_time, worker, RUNNING))
+
+    def release(self, request):
+        """
+        Return a claimed request to the pending requests (e.g. a part of a merged request)
+        """
+        with self.lock:
+            self.connection.execute(
+                'UPDATE requests SET state = ?, worker = NULL, lease_expires = NULL WHERE key = ? AND state = ?',
+                (PENDING, request_key(request), RUNNING))
+
+    def set_state(self, from_state, to_state):
+        """
+        Move all requests from one state to another, e.g. to re-try failed requests
+        """
+        with self.lock:
+            self.connection.execute('UPDATE requests SET state = ? WHERE state = ?', (to_state, from_state))
+
+    def import_csv(self):
+        """
+        Import the requests.whole / requests.completed / requests.failed files of a previous extraction.
+        Returns False if no CSV journal was found.
+        """
+        filepath_requests = os.path.join(self.directory, 'requests.whole')
+        if not os.path.isfile(filepath_requests):
+            return False
+
+        def read(filename):
+            filepath = os.path.join(self.directory, filename)
+            if not os.path.isfile(filepath):
+                return []
+            with open(filepath, 'r', newline='') as csvfile:
+                rows = [{k: parse_csv_value(v) for k, v in row.items()} for row in csv.DictReader(csvfile)]
+            # Elements were not always written in the same order, resuming used to sort them
+            for row in rows:
+                row['elements'] = sorted(row['elements'])
+            return rows
+
+        self.add(read('requests.whole'))
+        with self.lock:
+            self.connection.execute('DELETE FROM generation')
+        for state, filename in [(COMPLETED, 'requests.completed'), (FAILED, 'requests.failed')]:
+            keys = [(state, time.time(), request_key(request)) for request in read(filename)]
+            with self.lock:
+                with self.connection:
+                    self.connection.execute('BEGIN')
+                    self.connection.executemany(
+                        'UPDATE requests SET state = ?, finished_at = ? WHERE key = ?', keys)
+        return True
@@ -1,5 +1,6 @@
 import argparse
 from common import pydicombatch
+from service import serve
 
 def parse_arguments():
     parser = argparse.ArgumentParser(description='PYDICOM Batch Processing Tool')
@@ -10,17 +11,36 @@ def parse_arguments():
     )
     parser.add_argument(
         '-o', '--operation',
-        choices=['c-find', 'c-move'],
+        choices=['c-find', 'c-move', 'c-get'],
         default='c-find',
         help='Operation to perform (default: c-find)'
     )
+    parser.add_argument(
+        '-w', '--workers',
+        type=int,
+        default=0,
+        help='Number of worker processes claiming requests from the shared journal (default: single process)'
+    )
+    parser.add_argument(
+        '--worker',
+        type=int,
+        help='Run a single worker with this index, joining the workers of an extraction on this host'
+    )
+    parser.add_argument(
+        '--serve',
+        action='store_true',
+        help='Run as a service accepting C-FIND / C-MOVE jobs through a local HTTP API (common.service)'
+    )
     return parser.parse_args()
 
 print("\n█▀█ █▄█ █▀▄ █ █▀▀ █▀█ █▀▄▀█   █▄▄ ▄▀█ ▀█▀ █▀▀ █░█\n█▀▀ ░█░ █▄▀ █ █▄▄ █▄█ █░▀░█   █▄█ █▀█ ░█░ █▄▄ █▀█\n")
 
 def main():
     args = parse_arguments()
-    pydicombatch(args.config, args.operation.lower())
+    if args.serve:
+        serve(args.config)
+        return
+    pydicombatch(args.config, args.operation.lower(), args.workers, args.worker)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,305 @@
+import os
+import json
+import time
+import bisect
+import threading
+import contextlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Latency buckets in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+# Buckets for the number of responses / instances per request
+COUNT_BUCKETS = (0, 1, 5, 10, 50, 100, 500, 1000, 5000, 10000)
+
+DESCRIPTIONS = {
+    'pydicombatch_request_duration_seconds': 'Duration of C-FIND / C-MOVE requests, from sending to the last response',
+    'pydicombatch_responses_per_request': 'Number of C-FIND responses per request',
+    'pydicombatch_instances_per_request': 'Number of instances retrieved per C-MOVE request',
+    'pydicombatch_requests_total': 'Requests processed, by operation and outcome',
+    'pydicombatch_association_failures_total': 'Failed association attempts with the PACS',
+    'pydicombatch_store_duration_seconds': 'Time spent handling a received C-STORE request',
+    'pydicombatch_postprocess_duration_seconds': 'Time spent anonymizing or transcoding a received file, or exporting a series',
+    'pydicombatch_instances_received_total': 'C-STORE requests received, by status',
+    'pydicombatch_bytes_received_total': 'Bytes of received data sets',
+    'pydicombatch_duplicates_total': 'Received instances already in the catalog, acknowledged without being written',
+    'pydicombatch_request_queue_depth': 'Requests waiting to be sent',
+    'pydicombatch_rate_limit': 'Request rate (requests/s) chosen by the rate controller',
+    'pydicombatch_concurrency_limit': 'Concurrent requests allowed by the rate controller',
+    'pydicombatch_schedule_paused': '1 while the extraction waits for the schedule window',
+    'pydicombatch_writer_queue_depth': 'Result batches waiting for the database writer',
+    'pydicombatch_pipeline_pending_files': 'Received files waiting for post-processing',
+    'pydicombatch_pipeline_pending_bytes': 'Size of the received files waiting for post-processing',
+    'pydicombatch_transcoding_pending_files': 'Received files waiting for transcoding',
+    'pydicombatch_jobs_queued': 'Service jobs waiting to be run',
+    'pydicombatch_jobs_total': 'Service jobs finished, by operation and state',
+}
+
+
+def format_labels(labels, extra=None):
+    items = list(labels) + ([extra] if extra else [])
+    if not items:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in items) + '}'
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram(object):
+    """ Histogram class
+    Cumulative histogram in the Prometheus sense: counts of observations less than or equal to each bucket
+    """
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def copy(self):
+        histogram = Histogram(self.buckets)
+        histogram.counts = list(self.counts)
+        histogram.sum = self.sum
+        histogram.count = self.count
+        return histogram
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            yield bound, total
+
+    def quantile(self, q):
+        """
+        Estimate a quantile by linear interpolation within its bucket
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        lower = 0
+        previous = 0
+        for bound, total in self.cumulative():
+            if total >= rank:
+                if bound == float('inf'):
+                    return self.buckets[-1] if self.buckets else None
+                count = total - previous
+                return lower + (bound - lower) * ((rank - previous) / count if count else 0)
+            lower, previous = bound, total
+        return None
+
+
+class Metrics(object):
+    """ Metrics class
+    Registry of the counters, gauges and histograms of an extraction run. It is updated by the SCU workers
+    and the SCP handlers, and exported in the Prometheus text format to a file (for the node exporter's
+    textfile collector) and/or a local HTTP endpoint. A JSON summary is written when the run ends.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.callbacks = {}
+        self.histograms = {}
+        self.time_start = time.time()
+        self.config = {}
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.server = None
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = value
+
+    def gauge(self, name, callback, **labels):
+        """
+        Register a gauge whose value is read from callback() when the metrics are exported
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.callbacks[key] = callback
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def snapshot(self):
+        """
+        Return copies of the counters, gauges and histograms, with the callback gauges evaluated
+        """
+        with self.lock:
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+            callbacks = dict(self.callbacks)
+            histograms = {key: histogram.copy() for key, histogram in self.histograms.items()}
+        for key, callback in callbacks.items():
+            try:
+                gauges[key] = callback()
+            except Exception:
+                pass
+        return counters, gauges, histograms
+
+    def render(self):
+        """
+        Return the metrics in the Prometheus text exposition format
+        """
+        counters, gauges, histograms = self.snapshot()
+        lines = []
+
+        def header(name, kind, written):
+            if name not in written:
+                written.add(name)
+                if name in DESCRIPTIONS:
+                    lines.append('# HELP {} {}'.format(name, DESCRIPTIONS[name]))
+                lines.append('# TYPE {} {}'.format(name, kind))
+
+        written = set()
+        for (name, labels), value in sorted(counters.items()):
+            header(name, 'counter', written)
+            lines.append('{}{} {}'.format(name, format_labels(labels), format_value(value)))
+        for (name, labels), value in sorted(gauges.items()):
+            header(name, 'gauge', written)
+            lines.append('{}{} {}'.format(name, format_labels(labels), format_value(value)))
+        for (name, labels), histogram in sorted(histograms.items(), key=lambda x: x[0]):
+            header(name, 'histogram', written)
+            for bound, bucket_count in histogram.cumulative():
+                lines.append('{}_bucket{} {}'.format(name, format_labels(labels, ('le', format_value(bound))), bucket_count))
+            lines.append('{}_sum{} {}'.format(name, format_labels(labels), format_value(float(histogram.sum))))
+            lines.append('{}_count{} {}'.format(name, format_labels(labels), histogram.count))
+        header('pydicombatch_uptime_seconds', 'gauge', written)
+        lines.append('pydicombatch_uptime_seconds {}'.format(format_value(time.time() - self.time_start)))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """
+        Return a summary of the run: counter and gauge values, and count / mean / p50 / p95 / p99 / sum
+        of each histogram
+        """
+        counters, gauges, histograms = self.snapshot()
+
+        def name_with_labels(name, labels):
+            return name + format_labels(labels)
+
+        result = {
+            'duration_seconds': round(time.time() - self.time_start, 3),
+            'counters': {name_with_labels(*key): value for key, value in sorted(counters.items())},
+            'gauges': {name_with_labels(*key): value for key, value in sorted(gauges.items())},
+            'histograms': {},
+        }
+        for key, histogram in sorted(histograms.items(), key=lambda x: x[0]):
+            result['histograms'][name_with_labels(*key)] = {
+                'count': histogram.count,
+                'sum': histogram.sum,
+                'mean': histogram.sum / histogram.count if histogram.count else None,
+                'p50': histogram.quantile(0.5),
+                'p95': histogram.quantile(0.95),
+                'p99': histogram.quantile(0.99),
+            }
+        return result
+
+    def write_textfile(self, filepath):
+        # Write to a temporary file first so that a collector never reads a partial file
+        tmp_filepath = filepath + '.tmp'
+        with open(tmp_filepath, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp_filepath, filepath)
+
+    def export(self):
+        while not self.stop_event.wait(self.config.get('interval', 10)):
+            try:
+                self.write_textfile(self.config['textfile'])
+            except OSError as exc:
+                print('\nUnable to write metrics to {}: {}'.format(self.config['textfile'], exc))
+
+    def start(self, config):
+        """
+        Start exporting the metrics according to the metrics settings: textfile (written every interval
+        seconds) and/or http_port (served on http_host, localhost by default)
+        """
+        self.config = dict(config.get('metrics') or {})
+        if not self.config.get('enabled'):
+            return
+        self.config['interval'] = float(self.config.get('interval', 10))
+        if self.config.get('textfile'):
+            os.makedirs(os.path.dirname(os.path.abspath(self.config['textfile'])), exist_ok=True)
+            self.stop_event.clear()
+            self.thread = threading.Thread(target=self.export, daemon=True)
+            self.thread.start()
+        if self.config.get('http_port'):
+            registry = self
+
+            class MetricsHandler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    if self.path.rstrip('/') == '/metrics':
+                        body, content_type = registry.render(), 'text/plain; version=0.0.4'
+                    elif self.path.rstrip('/') == '/metrics.json':
+                        body, content_type = json.dumps(registry.summary(), indent=2), 'application/json'
+                    else:
+                        self.send_error(404)
+                        return
+                    body = body.encode('utf-8')
+                    self.send_response(200)
+                    self.send_header('Content-Type', content_type)
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, format, *args):
+                    pass
+
+            address = (self.config.get('http_host', '127.0.0.1'), int(self.config['http_port']))
+            self.server = ThreadingHTTPServer(address, MetricsHandler)
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+            print('Serving metrics on http://{}:{}/metrics'.format(*address))
+
+    def stop(self, directory=None):
+        """
+        Stop exporting, write the textfile a last time and the JSON summary (summary_file, or
+        metrics.json in directory)
+        """
+        if not self.config.get('enabled'):
+            return
+        if self.thread:
+            self.stop_event.set()
+            self.thread.join()
+            self.thread = None
+            self.write_textfile(self.config['textfile'])
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        summary_file = self.config.get('summary_file') or (os.path.join(directory, 'metrics.json') if directory else None)
+        if summary_file:
+            with open(summary_file, 'w') as f:
+                json.dump(self.summary(), f, indent=2)
+            print('Metrics summary written to {}'.format(summary_file))
+
+
+# Registry shared by the SCU workers and the SCP of the running extraction
+metrics = Metrics()
@@ -0,0 +1,420 @@
+import bisect
+import datetime
+import threading
+
+from pydicom.datadict import dictionary_VR
+from pynetdicom.apps.common import ElementPath
+
+from scheduler import element_value
+
+
+# Study level keys of the Study Root query model (and the Patient level keys that it includes)
+STUDY_KEYWORDS = ['QueryRetrieveLevel', 'SpecificCharacterSet', 'TimezoneOffsetFromUTC', 'PatientName', 'PatientID',
+    'IssuerOfPatientID', 'OtherPatientIDsSequence', 'PatientBirthDate', 'PatientSex', 'PatientAge',
+    'StudyDate', 'StudyTime', 'AccessionNumber', 'StudyID', 'StudyInstanceUID', 'ReferringPhysicianName',
+    'StudyDescription', 'ModalitiesInStudy', 'SOPClassesInStudy', 'NumberOfStudyRelatedSeries',
+    'NumberOfStudyRelatedInstances', 'AdmittingDiagnosesDescription']
+
+
+def parse_date_range(value):
+    """
+    Return (start, end) dates for a YYYYMMDD or YYYYMMDD-YYYYMMDD value, or None for open ranges
+    """
+    if not value:
+        return None
+    start_str, _, end_str = value.partition('-')
+    if not end_str:
+        end_str = start_str if '-' not in value else ''
+    try:
+        start = datetime.datetime.strptime(start_str, '%Y%m%d').date()
+        end = datetime.datetime.strptime(end_str, '%Y%m%d').date()
+    except ValueError:
+        return None
+    return (start, end) if start <= end else None
+
+def format_date_range(start, end):
+    return '{}-{}'.format(start.strftime('%Y%m%d'), end.strftime('%Y%m%d'))
+
+def parse_time_range(value):
+    """
+    Return (start, end) seconds of the day for a HHMMSS-HHMMSS value (or the whole day for *)
+    """
+    if value in (None, '', '*'):
+        return (0, 24 * 3600 - 1)
+    start_str, _, end_str = value.partition('-')
+    try:
+        start_str = start_str.split('.')[0] or '000000'
+        end_str = end_str.split('.')[0] or '235959'
+        start = int(start_str[0:2]) * 3600 + int(start_str[2:4] or 0) * 60 + int(start_str[4:6] or 0)
+        end = int(end_str[0:2]) * 3600 + int(end_str[2:4] or 59) * 60 + int(end_str[4:6] or 59)
+    except ValueError:
+        return None
+    return (start, end) if start <= end else None
+
+def format_time_range(start, end):
+    fmt = lambda x : '{:02d}{:02d}{:02d}'.format(x // 3600, x % 3600 // 60, x % 60)
+    return '{}-{}'.format(fmt(start), fmt(end))
+
+def replace_element(request, keyword, value):
+    """
+    Return a copy of the request with the value of an element replaced
+    """
+    new_request = request.copy()
+    new_request['elements'] = [
+        f'{keyword}={value}' if ElementPath(e.partition('=')[0]).keyword == keyword else e
+        for e in request['elements']
+    ]
+    return new_request
+
+def set_element(request, keyword, value):
+    """
+    Return a copy of the request with the value of an element replaced, or added if the request lacks it
+    """
+    if element_value(request, keyword) is None:
+        new_request = request.copy()
+        new_request['elements'] = list(request['elements']) + [f'{keyword}={value}']
+        return new_request
+    return replace_element(request, keyword, value)
+
+def keyword_of(element):
+    return ElementPath(element.partition('=')[0]).keyword
+
+
+class DateRangePlanner(object):
+    """ DateRangePlanner class
+    Adapts C-FIND StudyDate windows to the PACS result limit. Windows whose response count reaches
+    result_limit are bisected and re-queried, while neighbouring windows that are expected to be
+    sparse (based on the response density observed for the closest completed window) are merged
+    into a single query.
+    """
+
+    def __init__(self, config):
+        date_split = config['request'].get('date_split') or {}
+        self.result_limit = int(date_split.get('result_limit', 5000))
+        self.merge_enabled = bool(date_split.get('merge', True))
+        self.target_fill = float(date_split.get('target_fill', 0.5))
+        self.max_days = int(date_split.get('max_days', 366))
+        # Sorted (window start, responses per day) observations
+        self.density = []
+        self.lock = threading.Lock()
+
+    def is_capped(self, response_count):
+        return response_count >= self.result_limit
+
+    def bisect(self, request):
+        """
+        Return two requests covering the StudyDate window (or the StudyTime window of a single day)
+        of the request, or an empty list when the request cannot be split further
+        """
+        window = parse_date_range(element_value(request, 'StudyDate'))
+        if window is None:
+            return []
+        start, end = window
+        if start < end:
+            middle = start + (end - start) // 2
+            return [replace_element(request, 'StudyDate', format_date_range(start, middle)),
+                replace_element(request, 'StudyDate', format_date_range(middle + datetime.timedelta(days=1), end))]
+
+        # Single day: split on StudyTime when the request carries that element
+        study_time = element_value(request, 'StudyTime')
+        if study_time is None:
+            return []
+        time_window = parse_time_range(study_time)
+        if time_window is None or time_window[1] - time_window[0] < 60:
+            return []
+        time_start, time_end = time_window
+        time_middle = time_start + (time_end - time_start) // 2
+        return [replace_element(request, 'StudyTime', format_time_range(time_start, time_middle)),
+            replace_element(request, 'StudyTime', format_time_range(time_middle + 1, time_end))]
+
+    def record(self, request, response_count):
+        """
+        Record the response density of a completed (or capped) window
+        """
+        window = parse_date_range(element_value(request, 'StudyDate'))
+        if window is None:
+            return
+        start, end = window
+        days = (end - start).days + 1
+        with self.lock:
+            bisect.insort(self.density, (start.toordinal(), response_count / days))
+
+    def expected_count(self, start, end):
+        """
+        Estimate the number of responses of a window from the closest observed window, or None
+        """
+        with self.lock:
+            if not self.density:
+                return None
+            i = bisect.bisect_left(self.density, (start.toordinal(),))
+            neighbours = self.density[max(i - 1, 0):i + 1]
+        closest = min(neighbours, key=lambda x : abs(x[0] - start.toordinal()))
+        return closest[1] * ((end - start).days + 1)
+
+    def merge(self, request, queue):
+        """
+        Merge the request with adjacent pending windows at the head of the queue while the merged
+        window is expected to stay below target_fill * result_limit. Returns the request unchanged
+        or a merged request whose '_parts' lists the original requests.
+        """
+        if not self.merge_enabled or request['type'].lower() != 'c-find':
+            return request
+        window = parse_date_range(element_value(request, 'StudyDate'))
+        if window is None or element_value(request, 'StudyTime') not in (None, '', '*'):
+            return request
+
+        start, end = window
+        others = [e for e in request['elements'] if ElementPath(e.partition('=')[0]).keyword != 'StudyDate']
+        parts = [request]
+        budget = self.target_fill * self.result_limit
+
+        def adjacent(candidate):
+            candidate_window = parse_date_range(element_value(candidate, 'StudyDate'))
+            if candidate_window is None or candidate['type'] != request['type']:
+                return False
+            if [e for e in candidate['elements'] if ElementPath(e.partition('=')[0]).keyword != 'StudyDate'] != others:
+                return False
+            new_start = min(start, candidate_window[0])
+            new_end = max(end, candidate_window[1])
+            if (candidate_window[0] != end + datetime.timedelta(days=1) and
+                candidate_window[1] != start - datetime.timedelta(days=1)):
+                return False
+            if (new_end - new_start).days + 1 > self.max_days:
+                return False
+            expected = self.expected_count(new_start, new_end)
+            return expected is not None and expected <= budget
+
+        while True:
+            candidate = queue.pop_if(adjacent)
+            if candidate is None:
+                break
+            candidate_start, candidate_end = parse_date_range(element_value(candidate, 'StudyDate'))
+            start = min(start, candidate_start)
+            end = max(end, candidate_end)
+            parts.append(candidate)
+
+        if len(parts) == 1:
+            return request
+        merged = replace_element(request, 'StudyDate', format_date_range(start, end))
+        merged['_parts'] = parts
+        return merged
+
+
+class UIDListCoalescer(object):
+    """ UIDListCoalescer class
+    Coalesces requests that only differ by the value of a UID element (typically the rows of an
+    elements_batch_file listing StudyInstanceUIDs) into a single request using UID list matching: up to
+    group_size values are sent as one multi-valued (backslash separated) element. Only the requests at the
+    head of the queue are coalesced, so rows sharing their other elements should be adjacent in the file.
+    The merged request lists the original requests in '_parts' so that each of them is started, completed
+    and resumed on its own. With fallback, the requests of a group the PACS rejected (or that matched
+    nothing, as PACS without list matching do) are queued again and no longer coalesced.
+    """
+
+    def __init__(self, element='StudyInstanceUID', group_size=50, fallback=True):
+        self.element = element
+        self.group_size = group_size
+        self.fallback = fallback
+        # UIDs of the requests that are sent on their own after their group fell back
+        self.excluded = set()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Return a UIDListCoalescer for request.coalesce, or None if it is disabled
+        """
+        coalesce = config['request'].get('coalesce') or {}
+        if not coalesce.get('enabled'):
+            return None
+        element = ElementPath(coalesce.get('element', 'StudyInstanceUID')).keyword
+        if dictionary_VR(element) != 'UI':
+            raise ValueError('Only UID elements can be coalesced: {}'.format(element))
+        return cls(element, int(coalesce.get('group_size', 50)), bool(coalesce.get('fallback', True)))
+
+    def value(self, request):
+        """
+        Return the UID of a request if it can be coalesced, else None
+        """
+        if '_parts' in request:
+            return None
+        value = element_value(request, self.element)
+        if not value or any(c in value for c in '\\*?'):
+            return None
+        with self.lock:
+            return None if value in self.excluded else value
+
+    def others(self, request):
+        return sorted(e for e in request['elements'] if ElementPath(e.partition('=')[0]).keyword != self.element)
+
+    def merge(self, request, queue):
+        """
+        Coalesce the request with the requests at the head of the queue that only differ by their UID.
+        Returns the request unchanged or a merged request whose '_parts' lists the original requests.
+        """
+        if self.value(request) is None:
+            return request
+        others = self.others(request)
+        parts = [request]
+
+        def same_group(candidate):
+            return (candidate['type'] == request['type'] and self.value(candidate) is not None
+                and self.others(candidate) == others)
+
+        while len(parts) < self.group_size:
+            candidate = queue.pop_if(same_group)
+            if candidate is None:
+                break
+            parts.append(candidate)
+
+        if len(parts) == 1:
+            return request
+        merged = replace_element(request, self.element, '\\'.join(self.value(part) for part in parts))
+        merged['_parts'] = parts
+        merged['_coalesced'] = True
+        return merged
+
+    def exclude(self, request):
+        """
+        Stop coalescing the requests of a merged request, e.g. once the PACS rejected the UID list
+        """
+        with self.lock:
+            self.excluded.update(element_value(part, self.element) for part in request['_parts'])
+
+
+class DescriptionFilter(object):
+    """ DescriptionFilter class
+    C-FIND description filter (request.description_filter): a response is saved if its StudyDescription
+    contains one of the study_description strings, or, for SERIES level responses, if its
+    SeriesDescription contains one of the series_description strings (case-insensitive).
+    With pushdown, the filters are also sent to the PACS as wildcard matching keys (*string*) so that it
+    only returns candidate rows, when that does not change the results: on StudyDescription for STUDY
+    level queries, on SeriesDescription for SERIES level queries without study filter, and only for
+    filter strings without wildcard characters. Since the standard wildcard matching of descriptions is
+    case-sensitive, pushdown should only be enabled for PACS matching case-insensitively or filters
+    written in the case of the descriptions. A request is sent per filter string; each request only saves
+    the rows that the requests of the previous strings do not save.
+    With drill_down, SERIES level C-FIND requests are replaced by their STUDY level query first. The
+    series of the studies matching the study filter (all studies without study filter) are then queried
+    with one SERIES level request per study, whose series are saved if they match the series filter (all
+    series without series filter). Unlike the flat filter, a series is only saved if both its study and
+    its description pass.
+    """
+
+    def __init__(self, study_filters=None, series_filters=None, pushdown=False, drill_down=False):
+        self.study_filters = [str(f) for f in study_filters or []]
+        self.series_filters = [str(f) for f in series_filters or []]
+        self.pushdown_enabled = pushdown
+        self.drill_down_enabled = drill_down
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Return a DescriptionFilter for request.description_filter, or None if it is disabled
+        """
+        description_filter = config['request'].get('description_filter') or {}
+        if not description_filter.get('enabled'):
+            return None
+        return cls(description_filter.get('study_description'), description_filter.get('series_description'),
+            pushdown=bool(description_filter.get('pushdown', False)),
+            drill_down=bool(description_filter.get('drill_down', False)))
+
+    def first_match(self, value, filters):
+        """
+        Return the index of the first filter string contained in value, or None
+        """
+        value = str(value).upper()
+        for i, filter_str in enumerate(filters):
+            if filter_str.upper() in value:
+                return i
+        return None
+
+    def pushed(self, request, keyword, filters):
+        """
+        Return the index of the filter string pushed down in the request, or None
+        """
+        value = element_value(request, keyword)
+        for i, filter_str in enumerate(filters):
+            if value == '*{}*'.format(filter_str):
+                return i
+        return None
+
+    def matches(self, rsp_identifier, request, keyword, filters):
+        if not filters or keyword not in rsp_identifier:
+            return False
+        i = self.first_match(rsp_identifier[keyword].value or '', filters)
+        pushed = self.pushed(request, keyword, filters)
+        return i is not None and (pushed is None or i == pushed)
+
+    def keep(self, rsp_identifier, request):
+        """
+        Return True if a C-FIND response of a request passes the filter
+        """
+        level = rsp_identifier.QueryRetrieveLevel if 'QueryRetrieveLevel' in rsp_identifier else None
+        drill_down = request.get('drill_down')
+        if drill_down == 'study':
+            return not self.study_filters or self.matches(rsp_identifier, request, 'StudyDescription', self.study_filters)
+        if drill_down == 'series':
+            return not self.series_filters or self.matches(rsp_identifier, request, 'SeriesDescription', self.series_filters)
+        if self.matches(rsp_identifier, request, 'StudyDescription', self.study_filters):
+            return True
+        return level == 'SERIES' and self.matches(rsp_identifier, request, 'SeriesDescription', self.series_filters)
+
+    def pushdown(self, request):
+        """
+        Return the requests sending the filter strings to the PACS, or [request] if the filter cannot be
+        pushed down
+        """
+        if not self.pushdown_enabled or request['type'].lower() != 'c-find':
+            return [request]
+        level = element_value(request, 'QueryRetrieveLevel')
+        keyword, filters = None, []
+        if level == 'STUDY':
+            keyword, filters = 'StudyDescription', self.study_filters
+        elif level == 'SERIES' and (request.get('drill_down') == 'series' or not self.study_filters):
+            keyword, filters = 'SeriesDescription', self.series_filters
+        safe = filters and all(f and not any(c in f for c in '*?\\') for f in filters)
+        if not safe or element_value(request, keyword) not in (None, '', '*'):
+            return [request]
+        return [set_element(request, keyword, '*{}*'.format(f)) for f in dict.fromkeys(filters)]
+
+    def plan(self, request):
+        """
+        Return the requests to send for a new request: its STUDY level query with drill_down, and the
+        filters pushed down to the PACS
+        """
+        if (self.drill_down_enabled and request['type'].lower() == 'c-find'
+                and element_value(request, 'QueryRetrieveLevel') == 'SERIES'):
+            study_request = request.copy()
+            study_request['elements'] = [e for e in request['elements'] if keyword_of(e) in STUDY_KEYWORDS]
+            study_request['series_elements'] = list(request['elements'])
+            study_request['drill_down'] = 'study'
+            study_request = set_element(study_request, 'QueryRetrieveLevel', 'STUDY')
+            for keyword in ['StudyInstanceUID', 'StudyDescription']:
+                if element_value(study_request, keyword) is None:
+                    study_request['elements'].append(keyword)
+            modality = element_value(request, 'Modality')
+            if modality not in (None, '', '*') and element_value(study_request, 'ModalitiesInStudy') is None:
+                # Studies with a series of the modality
+                study_request['elements'].append('ModalitiesInStudy={}'.format(modality))
+            request = study_request
+        return self.pushdown(request)
+
+    def series_requests(self, request, study):
+        """
+        Return the SERIES level requests of a study that passed the STUDY level query of the drill-down.
+        The study level keys of the original request are only returned, since the study matched them.
+        """
+        elements = []
+        for e in request['series_elements']:
+            keyword = keyword_of(e)
+            if keyword == 'StudyInstanceUID':
+                e = 'StudyInstanceUID={}'.format(study.StudyInstanceUID)
+            elif keyword in STUDY_KEYWORDS and keyword != 'QueryRetrieveLevel':
+                e = e.partition('=')[0]
+            elements.append(e)
+        series_request = {k: v for k, v in request.items() if not k.startswith('_') and k != 'series_elements'}
+        series_request['elements'] = elements
+        series_request['drill_down'] = 'series'
+        series_request = set_element(series_request, 'StudyInstanceUID', study.StudyInstanceUID)
+        return self.pushdown(series_request)
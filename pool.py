@@ -0,0 +1,183 @@
+import time
+import threading
+import collections
+import contextlib
+
+import pynetdicom
+from pynetdicom.association import Association
+
+from metrics import metrics
+
+# pynetdicom releases whose association reactor has the race worked around by requeue_stolen_responses
+#   (the version pinned in requirements.txt). Other releases are left unpatched.
+REACTOR_RACE_VERSIONS = ['2.0.2']
+
+
+def requeue_stolen_responses():
+    """
+    Work around a race in the pynetdicom association reactor. The send_* methods pause the reactor thread
+    of the association before sending a request and waiting for its response, but the reactor can be seen
+    as paused while it is about to read the DIMSE queue: it then takes the response and the sender waits
+    until the DIMSE timeout and aborts the association (for the C-STORE sub-operations of a C-MOVE, the
+    remaining instances are lost). The race is more likely when other threads of the process compete for
+    the GIL, e.g. the SCU and the storage SCP in the same process. Responses read by the reactor while a
+    send_* method is waiting are put back at the head of the queue. Applied once per process, and only to
+    the pynetdicom releases of REACTOR_RACE_VERSIONS since it relies on their internals.
+    """
+    serve_request = Association._serve_request
+    if getattr(serve_request, 'requeues_responses', False) or pynetdicom.__version__ not in REACTOR_RACE_VERSIONS:
+        return
+
+    def _serve_request(self, msg, context_id):
+        if getattr(msg, 'Status', None) is not None and not self._reactor_checkpoint.is_set():
+            # Response to the request of a send_* method waiting on the queue
+            queue = self.dimse.msg_queue
+            with queue.mutex:
+                queue.queue.appendleft((context_id, msg))
+                queue.not_empty.notify()
+            return
+        serve_request(self, msg, context_id)
+
+    _serve_request.requeues_responses = True
+    _serve_request.original = serve_request
+    Association._serve_request = _serve_request
+
+
+class AssociationError(Exception):
+    """Raised when no association could be established with the PACS"""
+
+
+class PooledAssociation(object):
+    """ PooledAssociation class
+    Wraps an established association with the bookkeeping used by the pool
+    """
+
+    def __init__(self, assoc):
+        self.assoc = assoc
+        self.operations = 0
+        self.last_used = time.time()
+
+
+class AssociationPool(object):
+    """ AssociationPool class
+    This class keeps a bounded set of associations with the PACS that are shared by all SCU workers.
+    Idle associations are validated with a C-ECHO before reuse, broken ones are re-established lazily
+    with exponential backoff and associations are recycled after a configurable number of operations.
+    ext_neg and evt_handlers are passed to every association, e.g. the SCP role selection and C-STORE
+    handler used to receive the sub-operations of C-GET requests.
+    """
+
+    def __init__(self, ae, config, ext_neg=None, evt_handlers=None):
+        pool_config = config.get('pool') or {}
+        self.ae = ae
+        self.ext_neg = ext_neg
+        self.evt_handlers = evt_handlers
+        self.pacs = config['pacs']
+        self.max_associations = int(pool_config.get('max_associations', config['request']['threads']))
+        self.max_operations = int(pool_config.get('max_operations', 0))
+        self.echo_after = float(pool_config.get('echo_after', 30))
+        self.retry_attempts = int(pool_config.get('retry_attempts', 10))
+        self.backoff_initial = float(pool_config.get('backoff_initial', 1))
+        self.backoff_max = float(pool_config.get('backoff_max', 60))
+        self.idle = collections.deque()
+        self.slots = threading.BoundedSemaphore(self.max_associations)
+        self.lock = threading.Lock()
+        requeue_stolen_responses()
+
+    def connect(self):
+        """
+        Establish a new association, retrying with exponential backoff
+        """
+        delay = self.backoff_initial
+        for attempt in range(self.retry_attempts):
+            assoc = self.ae.associate(self.pacs['hostname'],
+                self.pacs['port'],
+                ae_title=self.pacs['aet'],
+                max_pdu=16382,
+                ext_neg=self.ext_neg,
+                evt_handlers=self.evt_handlers)
+            if assoc.is_established:
+                return PooledAssociation(assoc)
+            metrics.inc('pydicombatch_association_failures_total')
+            if attempt + 1 < self.retry_attempts:
+                time.sleep(delay)
+                delay = min(delay * 2, self.backoff_max)
+
+        raise AssociationError('Unable to associate with {} after {} attempts'.format(
+            self.pacs['aet'], self.retry_attempts))
+
+    def is_healthy(self, pooled):
+        """
+        Return True if the association can be reused. Associations idle for longer than
+        echo_after seconds are checked with a C-ECHO.
+        """
+        if not pooled.assoc.is_established:
+            return False
+        if time.time() - pooled.last_used < self.echo_after:
+            return True
+        try:
+            status = pooled.assoc.send_c_echo()
+        except Exception:
+            return False
+        return bool(status) and status.Status == 0x0000
+
+    def discard(self, pooled):
+        try:
+            if pooled.assoc.is_established:
+                pooled.assoc.release()
+        except Exception:
+            pooled.assoc.abort()
+
+    def acquire(self):
+        """
+        Return a healthy association, blocking while max_associations are in use
+        """
+        self.slots.acquire()
+        try:
+            while True:
+                with self.lock:
+                    pooled = self.idle.pop() if self.idle else None
+                if pooled is None:
+                    return self.connect()
+                if self.is_healthy(pooled):
+                    return pooled
+                self.discard(pooled)
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def release(self, pooled, healthy=True):
+        """
+        Return an association to the pool, or close it if it is broken or has reached max_operations
+        """
+        pooled.operations += 1
+        pooled.last_used = time.time()
+        recycle = self.max_operations and pooled.operations >= self.max_operations
+        if healthy and not recycle and pooled.assoc.is_established:
+            with self.lock:
+                self.idle.append(pooled)
+        else:
+            self.discard(pooled)
+        self.slots.release()
+
+    @contextlib.contextmanager
+    def association(self):
+        pooled = self.acquire()
+        healthy = True
+        try:
+            yield pooled.assoc
+        except BaseException:
+            healthy = False
+            raise
+        finally:
+            self.release(pooled, healthy)
+
+    def close(self):
+        """
+        Release all idle associations
+        """
+        with self.lock:
+            idle = list(self.idle)
+            self.idle.clear()
+        for pooled in idle:
+            self.discard(pooled)
@@ -0,0 +1,101 @@
+import time
+import threading
+
+from metrics import metrics
+
+
+class RateController(object):
+    """ RateController class
+    AIMD (additive increase, multiplicative decrease) controller shared by the SCU threads. It paces the
+    requests to a request rate and limits the number of concurrent requests. Both limits are increased
+    after every window of successful requests and decreased when a request fails (failure status,
+    association rejected) or is slower than target_latency: seconds per C-FIND request, or per retrieved
+    instance for C-MOVE. Decreases happen at most once per cooldown, since the requests in flight when
+    the PACS slows down usually all report it.
+    """
+
+    def __init__(self, min_rate=0.1, max_rate=10, initial_rate=None, min_concurrency=1, max_concurrency=1,
+            initial_concurrency=None, target_latency=0, increase=0.1, decrease=0.5, window=10, cooldown=5):
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.rate = min(max(initial_rate or min_rate, min_rate), max_rate)
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.concurrency = min(max(initial_concurrency or min_concurrency, min_concurrency), max_concurrency)
+        self.target_latency = target_latency
+        self.increase = increase
+        self.decrease = decrease
+        self.window = window
+        self.cooldown = cooldown
+        self.condition = threading.Condition()
+        self.active = 0
+        self.successes = 0
+        self.next_time = time.time()
+        self.last_decrease = 0
+        self.publish()
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Return a RateController for request.rate_control, or None if it is disabled
+        """
+        rate_control = config['request'].get('rate_control') or {}
+        if not rate_control.get('enabled'):
+            return None
+        threads = int(config['request']['threads'])
+        return cls(min_rate=float(rate_control.get('min_rate', 0.1)),
+            max_rate=float(rate_control.get('max_rate', 10)),
+            initial_rate=rate_control.get('initial_rate') and float(rate_control['initial_rate']),
+            min_concurrency=int(rate_control.get('min_concurrency', 1)),
+            max_concurrency=min(int(rate_control.get('max_concurrency', threads)), threads),
+            initial_concurrency=rate_control.get('initial_concurrency') and int(rate_control['initial_concurrency']),
+            target_latency=float(rate_control.get('target_latency', 0)),
+            increase=float(rate_control.get('increase', 0.1)),
+            decrease=float(rate_control.get('decrease', 0.5)),
+            window=int(rate_control.get('window', 10)),
+            cooldown=float(rate_control.get('cooldown', 5)))
+
+    def publish(self):
+        metrics.set('pydicombatch_rate_limit', round(self.rate, 3))
+        metrics.set('pydicombatch_concurrency_limit', int(self.concurrency))
+
+    def acquire(self):
+        """
+        Wait for a concurrency slot and for the next request time allowed by the rate
+        """
+        with self.condition:
+            while self.active >= int(self.concurrency):
+                self.condition.wait(1)
+            self.active += 1
+            now = time.time()
+            start = max(now, self.next_time)
+            self.next_time = start + 1.0 / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    def record(self, latency, ok):
+        """
+        Record the outcome of a request. latency may be None (e.g. the association was rejected).
+        """
+        with self.condition:
+            slow = latency is not None and self.target_latency and latency > self.target_latency
+            if not ok or slow:
+                self.successes = 0
+                now = time.time()
+                if now - self.last_decrease >= self.cooldown:
+                    self.last_decrease = now
+                    self.rate = max(self.min_rate, self.rate * self.decrease)
+                    self.concurrency = max(self.min_concurrency, self.concurrency * self.decrease)
+            else:
+                self.successes += 1
+                if self.successes >= self.window:
+                    self.successes = 0
+                    self.rate = min(self.max_rate, self.rate + self.increase)
+                    self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+            self.publish()
+            self.condition.notify_all()
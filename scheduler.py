@@ -0,0 +1,225 @@
+import heapq
+import itertools
+import threading
+
+from journal import PENDING, RUNNING
+
+from pynetdicom.apps.common import ElementPath
+
+
+def element_value(request, keyword):
+    """
+    Return the value of an element (keyword=value) of a request or None if absent
+    """
+    for element in request['elements']:
+        key, _, value = element.partition('=')
+        if ElementPath(key).keyword == keyword:
+            return value
+    return None
+
+
+class RequestQueue(object):
+    """ RequestQueue class
+    Thread-safe work queue from which SCU workers pull their next request as soon as they are free.
+    Requests are served in priority order (lowest first), then in insertion order. Because all workers
+    pull from the same queue, an idle worker always takes the next pending request instead of waiting
+    on a fixed partition. Requests can be fed from an iterator while the workers process the first ones.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.heap = []
+        self.counter = itertools.count()
+        self.ranks = itertools.count()
+        self.condition = threading.Condition()
+        self.in_flight = 0
+        self.feeding = 0
+        self.closed = False
+
+    def sort_key(self, request):
+        """
+        Sort key used to order the initial requests according to request.priority
+        """
+        priority = self.config['request'].get('priority') or {}
+        value = element_value(request, priority['element']) if priority.get('element') else None
+        # Requests missing the element are served last
+        return (value is None, value or '')
+
+    def extend(self, requests):
+        """
+        Add a batch of requests. When request.priority is configured the batch is ranked by the
+        value of priority.element (ascending or descending according to priority.order).
+        """
+        priority = self.config['request'].get('priority') or {}
+        requests = list(requests)
+        if priority.get('element'):
+            descending = str(priority.get('order', 'ascending')).lower() == 'descending'
+            present = sorted([r for r in requests if element_value(r, priority['element']) is not None],
+                key=self.sort_key, reverse=descending)
+            missing = [r for r in requests if element_value(r, priority['element']) is None]
+            requests = present + missing
+        with self.condition:
+            # Ranks continue across batches so that fed requests are served in order
+            for request in requests:
+                heapq.heappush(self.heap, (next(self.ranks), next(self.counter), request))
+            self.condition.notify_all()
+
+    def feed(self, requests, batch_size=10000, callback=None):
+        """
+        Add the requests of an iterator batch_size at a time from a background thread. The next batch is
+        only read once fewer than batch_size requests are queued, and until the iterator is exhausted,
+        workers wait for more requests instead of finding the queue empty. callback is called with the
+        number of requests of each batch. With request.priority, the requests are all read at once since
+        they are ranked together.
+        """
+        priority = self.config['request'].get('priority') or {}
+        if priority.get('element'):
+            batch_size = None
+        with self.condition:
+            self.feeding += 1
+
+        def run():
+            try:
+                iterator = iter(requests)
+                while not self.closed:
+                    with self.condition:
+                        while batch_size and len(self.heap) >= batch_size and not self.closed:
+                            self.condition.wait(1)
+                    batch = list(itertools.islice(iterator, batch_size))
+                    if not batch:
+                        break
+                    self.extend(batch)
+                    if callback:
+                        callback(len(batch))
+            except Exception as exc:
+                print('\nError generating requests: {}'.format(exc))
+            finally:
+                with self.condition:
+                    self.feeding -= 1
+                    self.condition.notify_all()
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+    def put(self, request, priority=0):
+        """
+        Add a single request, e.g. a follow-up request created while processing another one
+        """
+        with self.condition:
+            heapq.heappush(self.heap, (priority, next(self.counter), request))
+            self.condition.notify()
+
+    def get(self, timeout=1):
+        """
+        Return the next request, or None once the queue is empty and no request is in flight or being fed.
+        While other workers still process requests, wait since they may add follow-up requests.
+        """
+        with self.condition:
+            while not self.heap:
+                if self.closed or not (self.in_flight or self.feeding):
+                    return None
+                self.condition.wait(timeout)
+            self.in_flight += 1
+            # Wakes up the feeding thread waiting for room
+            self.condition.notify_all()
+            return heapq.heappop(self.heap)[2]
+
+    def pop_if(self, predicate):
+        """
+        Pop and return the request at the head of the queue if predicate(request) is True, else None
+        """
+        with self.condition:
+            if self.heap and predicate(self.heap[0][2]):
+                return heapq.heappop(self.heap)[2]
+            return None
+
+    def task_done(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def close(self):
+        """
+        Stop handing out requests, e.g. when the extraction is interrupted
+        """
+        with self.condition:
+            self.closed = True
+            self.heap = []
+            self.condition.notify_all()
+
+    def __len__(self):
+        with self.condition:
+            return len(self.heap)
+
+
+class LeaseQueue(object):
+    """ LeaseQueue class
+    Work queue backed by the journal, for extractions shared by several worker processes of a host.
+    Requests are claimed with a lease that the worker renews
+    while it is alive, so that the requests of a worker that crashed are claimed again by the others once
+    their lease expires. It has the same interface as RequestQueue.
+    """
+
+    def __init__(self, journal, worker, lease_time=300, poll_interval=5):
+        self.journal = journal
+        self.worker = worker
+        self.lease_time = lease_time
+        self.poll_interval = poll_interval
+        self.condition = threading.Condition()
+        self.in_flight = 0
+        self.closed = False
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.renew, daemon=True)
+        self.thread.start()
+
+    def renew(self):
+        while not self.stop_event.wait(self.lease_time / 3):
+            self.journal.renew(self.worker, self.lease_time)
+
+    def get(self, timeout=None):
+        """
+        Claim the next request, or return None once no request is pending or running. While requests are
+        running (here or in other workers), wait since they may be split or their lease may expire.
+        """
+        while True:
+            with self.condition:
+                if self.closed:
+                    return None
+            request = self.journal.claim(self.worker, self.lease_time)
+            if request is not None:
+                with self.condition:
+                    self.in_flight += 1
+                return request
+            with self.condition:
+                if self.closed or (not self.in_flight and not self.journal.count(RUNNING)):
+                    return None
+                self.condition.wait(self.poll_interval)
+
+    def put(self, request, priority=0):
+        """
+        Return a request to the journal. Follow-up requests are added to the journal by Journal.split,
+        the parts of a merged request are released so that any worker can claim them again.
+        """
+        self.journal.release(request)
+        with self.condition:
+            self.condition.notify_all()
+
+    def pop_if(self, predicate):
+        """
+        Claim and return the next request if predicate(request) is True, else None
+        """
+        return self.journal.claim(self.worker, self.lease_time, predicate)
+
+    def task_done(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def close(self):
+        self.stop_event.set()
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def __len__(self):
+        return self.journal.count(PENDING)
@@ -3,13 +3,23 @@ import sys
 import uuid
 import time
 from queue import Queue
-from threading import Thread
+import threading
+from threading import Thread, Condition
 import tqdm
 from pydicom import dcmread
 from pydicom.dataset import Dataset
 from pynetdicom.apps.common import ElementPath
 import inquirer
 import shutil
+from tempfile import NamedTemporaryFile
+from io import BytesIO
+from pydicom.filewriter import write_file_meta_info
+from anonymizer import Anonymizer
+from transcode import Transcoder
+from catalog import InstanceCatalog
+from archive import ShardedArchive
+from export import SeriesExporter
+from metrics import metrics
 
 from pydicom.uid import (
     ExplicitVRLittleEndian,
@@ -21,7 +31,7 @@ from pydicom.uid import (
 )
 
 from pynetdicom import (
-    AE, evt, QueryRetrievePresentationContexts, AllStoragePresentationContexts
+    AE, evt, QueryRetrievePresentationContexts, AllStoragePresentationContexts, _config, dimse_messages
 )
 from pynetdicom.apps.common import create_dataset
 from pynetdicom._globals import ALL_TRANSFER_SYNTAXES, DEFAULT_MAX_LENGTH
@@ -37,17 +47,164 @@ from pynetdicom.sop_class import (
 )
 
 
+def encoded_dataset(event):
+    """
+    Return the C-STORE request's Data Set encoded in the DICOM File Format without decoding it
+    """
+    if hasattr(event, 'encoded_dataset'):
+        # pynetdicom >= 2.1
+        return event.encoded_dataset(include_meta=True)
+    buffer = BytesIO()
+    buffer.write(b'\x00' * 128)
+    buffer.write(b'DICM')
+    write_file_meta_info(buffer, event.file_meta)
+    buffer.write(event.request.DataSet.getvalue())
+    return buffer.getvalue()
+
+# The umask can only be read by changing it: it is read once, before any thread creates files
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+def association_store_handler():
+    """
+    Return the object whose handle_store receives the C-STORE requests of the association read by the current
+    thread (an SCP, or the StorageListener of the service), or None.
+    """
+    assoc = getattr(threading.current_thread(), 'assoc', None)
+    handler = assoc.get_handlers(evt.EVT_C_STORE) if assoc else None
+    if handler and handler[0]:
+        return getattr(handler[0], '__self__', None)
+    return None
+
+def spooled_file(*args, **kwargs):
+    """
+    Create the file a received data set is written to by pynetdicom (stream_to_disk), in the temporary
+    directory of the SCP the association hands its C-STORE requests to, so that it is renamed and not copied
+    to the output. Called from the thread reading the association.
+    """
+    temp_dir = getattr(association_store_handler(), 'temp_dir', None)
+    if temp_dir and os.path.isdir(temp_dir):
+        kwargs.setdefault('dir', temp_dir)
+    return NamedTemporaryFile(*args, **kwargs)
+
+class StreamToDiskConfig(object):
+    """ StreamToDiskConfig class
+    pynetdicom._config as seen by pynetdicom.dimse_messages while SCPs stream to disk: STORE_RECV_CHUNKED_DATASET
+    is only set for the associations whose C-STORE requests are handled by an SCP with output.stream_to_disk,
+    the other associations of the process (C-FIND jobs, C-GET pools of other SCPs) keep the data sets in memory.
+    """
+    def __getattr__(self, name):
+        return getattr(_config, name)
+
+    @property
+    def STORE_RECV_CHUNKED_DATASET(self):
+        return _config.STORE_RECV_CHUNKED_DATASET or bool(getattr(association_store_handler(), 'stream_to_disk', False))
+
+# SCPs streaming to disk: pynetdicom is patched while there is at least one
+STREAMING_SCPS = set()
+STREAMING_LOCK = threading.Lock()
+
+def enable_stream_to_disk(scp):
+    """
+    Have pynetdicom write the data sets received by the associations of an SCP to disk as their P-DATA arrives
+    """
+    with STREAMING_LOCK:
+        if not STREAMING_SCPS:
+            dimse_messages._config = StreamToDiskConfig()
+            dimse_messages.NamedTemporaryFile = spooled_file
+        STREAMING_SCPS.add(scp)
+
+def disable_stream_to_disk(scp):
+    """
+    Stop streaming the data sets of an SCP to disk, and restore pynetdicom once no SCP streams to disk
+    """
+    with STREAMING_LOCK:
+        STREAMING_SCPS.discard(scp)
+        if not STREAMING_SCPS:
+            dimse_messages._config = _config
+            dimse_messages.NamedTemporaryFile = NamedTemporaryFile
+
+# Transfer syntaxes accepted for received instances
+STORAGE_TRANSFER_SYNTAXES = [ImplicitVRLittleEndian,
+    ExplicitVRLittleEndian,
+    DeflatedExplicitVRLittleEndian,
+    ExplicitVRBigEndian] + PILSupportedCompressedPixelTransferSyntaxes
+
+def create_ae(config):
+    # Create application entity
+    ae = AE(ae_title=config['local']['aet'])
+
+    # Set timeouts
+    ae.acse_timeout = 300
+    ae.dimse_timeout = 300
+    ae.network_timeout = 300
+    ae.maximum_pdu_size = 16384
+
+    for cx in AllStoragePresentationContexts:
+        ae.add_supported_context(cx.abstract_syntax, STORAGE_TRANSFER_SYNTAXES)
+
+    return ae
+
+
 class SCP(object):
     """ SCP class
     This class is used to run a local SCP (server) that handles DIMSE requests (c-store, c-echo)
+    With C-GET, no server is started: the SCU hands the C-STORE sub-operations received on its associations
+    to handle_store. In service mode, the C-STORE requests are handed to handle_store by the listener of
+    the service (see service.StorageListener) and interactive is False: nothing is prompted.
     """
 
-    def __init__(self, config):
+    def __init__(self, config, interactive=True):
         self.config = config
+        self.interactive = interactive
+        self.anonymizer = None
         self.anonymization_enabled = self.check_anon_engine()
-        self.ae = self.create_ae() 
+        # Decompression / recompression runs on a pool of worker processes
+        self.transcoder = Transcoder.from_config(self.config)
+        # Without anonymization, received data sets are written as is without being decoded
+        self.fast_store = not self.anonymization_enabled
+        self.layout_tags = [ElementPath(x).tag for x in self.config['output']['directory_structure'].split('/') if x]
+        self.layout_tags.append(ElementPath(self.config['output']['filename']).tag)
+        # Index of the written instances, also used to acknowledge instances that are already stored
+        self.catalog = InstanceCatalog.from_config(self.config)
+        # Instances are written one file per instance (default), or appended to tar shards
+        self.archive = ShardedArchive.from_config(self.config)
+        self.header_tags = self.layout_tags + (self.catalog.tags() if self.catalog else [])
+        self.header_tags += self.archive.tags() if self.archive else []
+        # Series exported as arrays once the extraction is done
+        self.exporter = SeriesExporter.from_config(self.config)
+        self.header_tags += self.exporter.tags() if self.exporter else []
+        self.duplicate_count = 0
+        self.ae = None
         self.scp = None
+        # Temporary directory to store files prior to post-processing (one per worker process)
+        self.temp_dir = os.path.join(self.config['output']['directory'], self.config['output'].get('tmp_directory', 'tmp'))
+        # Files that could not be post-processed (e.g. not anonymized) are kept outside the output directory
+        self.quarantine_dir = self.config['output'].get('quarantine_directory') or (
+            os.path.normpath(self.config['output']['directory']) + '-quarantine')
+        # Received data sets are written to disk by pynetdicom as their P-DATA arrives, instead of being
+        #   held in memory, so that the memory used per association does not depend on the object size
+        self.stream_to_disk = bool(self.config['output'].get('stream_to_disk', False))
+        if self.stream_to_disk:
+            # Data sets are spooled to the temporary directory of the output (see spooled_file)
+            os.makedirs(self.temp_dir, exist_ok = True)
+            enable_stream_to_disk(self)
+        # Received files are written to the temporary directory and only their path is queued.
+        #   The number and size of files waiting for post-processing is bounded.
+        pipeline = self.config['output'].get('pipeline') or {}
+        self.max_files = int(pipeline.get('max_files', 1000))
+        self.max_bytes = int(pipeline.get('max_bytes', 0))
+        self.policy = pipeline.get('policy', 'block')
+        self.block_timeout = float(pipeline.get('block_timeout', 300))
+        self.resume_fraction = float(pipeline.get('resume_fraction', 0.5))
+        self.pipeline = Condition()
+        self.pending_files = 0
+        self.pending_bytes = 0
+        self.rejected_count = 0
         self.writing_queue = Queue()
+        metrics.gauge('pydicombatch_pipeline_pending_files', lambda : self.pending_files)
+        metrics.gauge('pydicombatch_pipeline_pending_bytes', lambda : self.pending_bytes)
+        metrics.gauge('pydicombatch_transcoding_pending_files', lambda : self.transcoder.pending if self.transcoder else 0)
         self.start_file_writing_workers()
         self.file_count = 0
         self.time_start =  time.time()
@@ -56,10 +213,15 @@ class SCP(object):
         """
         Return True if anonymization is enabled and script / look up table file exist
         """
-        if (self.config['anonymization'] and self.config['anonymization']['enabled']):
+        if (self.config.get('anonymization') and self.config['anonymization']['enabled']):
             # Anonymization enabled
+            # The java engine runs DAT.jar for each file, the python engine runs the anonymizer script in-process
+            #   (compared to DAT.jar by tests/test_anonymizer.py where java is installed)
+            engine = self.config['anonymization'].get('engine', 'java')
             # Ensure that RSNA DICOM Anonymizer is found
-            if not os.path.isfile('./DicomAnonymizerTool/DAT.jar'):
+            if engine == 'java' and not os.path.isfile('./DicomAnonymizerTool/DAT.jar'):
+                if not self.interactive:
+                    raise FileNotFoundError('RSNA DICOM Anonymizer JAR file not found')
                 questions = [
                 inquirer.List('anon_files',
                                 message="RSNA DICOM Anonymizer JAR file not found. Do you still want to proceed?",
@@ -77,6 +239,8 @@ class SCP(object):
             anon_script = self.config['anonymization']['script']
             anon_lut = self.config['anonymization']['lookup_table']
             if not os.path.isfile(anon_script):
+                if not self.interactive:
+                    raise FileNotFoundError('Anonymization script not found: {}'.format(anon_script))
                 questions = [
                 inquirer.List('anon_files',
                                 message="Anonymization script not found. Do you still want to proceed?",
@@ -91,6 +255,8 @@ class SCP(object):
                     return False
             
             if not os.path.isfile(anon_lut):
+                if not self.interactive:
+                    raise FileNotFoundError('Anonymization look up table not found: {}'.format(anon_lut))
                 questions = [
                 inquirer.List('anon_files',
                                 message="Anonymization look up table not found. Do you still want to proceed?",
@@ -101,7 +267,10 @@ class SCP(object):
                 if answers['anon_files'] == 'Exit':
                     sys.exit()
 
-            print('Anonymization ENABLED')    
+            if engine == 'python':
+                self.anonymizer = Anonymizer(anon_script, anon_lut if os.path.isfile(anon_lut) else None)
+
+            print('Anonymization ENABLED ({} engine)'.format(engine))
             return True
         else:
             print('Anonymization DISABLED')
@@ -109,25 +278,7 @@ class SCP(object):
 
 
     def create_ae(self):
-        # Create application entity
-        ae = AE(ae_title=self.config['local']['aet'])
-
-        # Set timeouts
-        ae.acse_timeout = 300
-        ae.dimse_timeout = 300
-        ae.network_timeout = 300
-        ae.maximum_pdu_size = 16384
-
-        transfer_syntax = [ImplicitVRLittleEndian,
-                        ExplicitVRLittleEndian,
-                        DeflatedExplicitVRLittleEndian,
-                        ExplicitVRBigEndian]
-        transfer_syntax += PILSupportedCompressedPixelTransferSyntaxes
-
-        for cx in AllStoragePresentationContexts:
-            ae.add_supported_context(cx.abstract_syntax, transfer_syntax)
-
-        return ae
+        return create_ae(self.config)
     
     def anon_cmd(self, file):
         return 'cd ./DicomAnonymizerTool && java -jar DAT.jar -da {anon_script} -lut {anon_lut} -in {file} -out {file}  >/dev/null 2>&1'.format(
@@ -137,26 +288,263 @@ class SCP(object):
 
     def write_file(self, i, q):
         while True:
-            tmp_filename, tmp_ds = q.get()
-            # Anonymize file if enabled
-            if self.anonymization_enabled:
-                os.system(self.anon_cmd(tmp_filename))
-                ds = dcmread(tmp_filename)
+            item = q.get()
+            if item is None:
+                # Stopped by stop_server
+                q.task_done()
+                return
+            tmp_filename, size, received_uid = item
+            try:
+                # Anonymize file if enabled
+                if self.anonymization_enabled and self.anonymizer:
+                    with metrics.timer('pydicombatch_postprocess_duration_seconds', step='anonymize'):
+                        ds = self.anonymizer.anonymize(dcmread(tmp_filename))
+                        ds.save_as(tmp_filename, write_like_original=False)
+                elif self.anonymization_enabled:
+                    with metrics.timer('pydicombatch_postprocess_duration_seconds', step='anonymize'):
+                        os.system(self.anon_cmd(tmp_filename))
+                    ds = dcmread(tmp_filename, stop_before_pixels=True)
+                else:
+                    ds = dcmread(tmp_filename, stop_before_pixels=True)
+            except Exception as exc:
+                # Files that cannot be processed (e.g. anonymization failed) are quarantined
+                #   instead of being written to the output
+                print('\nPost-processing failed ({}), file moved to quarantine'.format(exc))
+                try:
+                    self.quarantine(tmp_filename)
+                finally:
+                    self.release(size)
+                    q.task_done()
+                continue
+            try:
+                # Move file to desired directory_structure, after transcoding if enabled
+                self.move_to_output(tmp_filename, ds, size, received_uid)
+            except Exception as exc:
+                print('\nUnable to move {} to the output directory: {}'.format(tmp_filename, exc))
+            finally:
+                q.task_done()
+
+    def quarantine(self, filename):
+        # A file that cannot be quarantined either (e.g. disk full) is left in the temporary directory
+        try:
+            os.makedirs(self.quarantine_dir, exist_ok = True)
+            shutil.move(filename, os.path.join(self.quarantine_dir, os.path.basename(filename)))
+        except Exception as exc:
+            print('\nUnable to move {} to quarantine: {}'.format(filename, exc))
+
+    def output_path(self, ds):
+        """
+        Return the path of a data set in the output directory_structure
+        """
+        dir_structure = self.config['output']['directory_structure'].split('/')
+        dir_structure = [str(ds[ElementPath(x).tag].value) for x in dir_structure if x]
+        filename = str(ds[ElementPath(self.config['output']['filename']).tag].value) + '.dcm'
+        filedir = os.path.join(self.config['output']['directory'], *dir_structure)
+        return os.path.join(filedir, filename)
+
+    def is_stored(self, ds):
+        """
+        Return True if the instance described by ds (e.g. a C-FIND response) is already in the output
+        """
+        if self.catalog:
+            return self.catalog.contains(ds.SOPInstanceUID)
+        try:
+            return os.path.isfile(self.output_path(ds))
+        except KeyError:
+            return False
+
+    def move_to_output(self, tmp_filename, ds, size, received_uid):
+        """
+        Move a file to its path in the output directory_structure (or to its archive shard). When transcoding
+        is enabled, the file is handed to the transcoding processes which move it once transcoded.
+        """
+        try:
+            filepath = self.output_path(ds)
+        except Exception:
+            self.release(size)
+            raise
+        if self.transcoder:
+            # With an archive, transcoded in place, then added to the archive
+            try:
+                self.transcoder.submit(tmp_filename, tmp_filename if self.archive else filepath,
+                    lambda result : self.transcoded(ds, received_uid, tmp_filename, filepath, result, size))
+            except Exception:
+                self.release(size)
+                raise
+        elif self.archive:
+            try:
+                shard, offset, file_size = self.archive.add(tmp_filename, filepath, ds)
+            finally:
+                self.release(size)
+            self.file_written(ds, received_uid, (shard, ds.file_meta.TransferSyntaxUID, file_size, offset))
+        else:
+            try:
+                os.makedirs(os.path.dirname(filepath), exist_ok = True)
+                shutil.move(tmp_filename, filepath)
+            finally:
+                self.release(size)
+            self.file_written(ds, received_uid, (filepath, ds.file_meta.TransferSyntaxUID))
+        return filepath
+
+    def transcoded(self, ds, received_uid, tmp_filename, filepath, result, size):
+        """
+        Called once a file is transcoded, with the result of transcode_file, or with None if it could not be
+        read or moved: the file is then quarantined instead of being left in the temporary directory.
+        """
+        try:
+            if result is None and os.path.exists(tmp_filename):
+                self.quarantine(tmp_filename)
+        finally:
+            if self.archive:
+                self.archive_file(ds, received_uid, filepath, result, size)
             else:
-                ds = tmp_ds
-            # Apply decompression if enabled
-            if self.config['output']['decompress']:
-                ds.decompress()
-                ds.save_as(tmp_filename, write_like_original=False)
-            # Move file to desired directory_structure 
-            dir_structure = self.config['output']['directory_structure'].split('/')
-            dir_structure = [str(ds[ElementPath(x).tag].value) for x in dir_structure if x]
-            filename = str(ds[ElementPath(self.config['output']['filename']).tag].value) + '.dcm'
-            filedir = os.path.join(self.config['output']['directory'], *dir_structure)
-            filepath = os.path.join(filedir, filename)
-            os.makedirs(filedir, exist_ok = True)
-            shutil.move(tmp_filename, filepath)
-            q.task_done()
+                self.file_written(ds, received_uid, result, size)
+
+    def archive_file(self, ds, received_uid, filepath, result, size):
+        """
+        Add a transcoded file to the archive. result is (path, transfer syntax), or None if transcoding failed.
+        """
+        if result:
+            try:
+                shard, offset, file_size = self.archive.add(result[0], filepath, ds)
+                result = (shard, result[1], file_size, offset)
+            except Exception as exc:
+                print('\nUnable to add {} to the archive: {}'.format(result[0], exc))
+                result = None
+        self.file_written(ds, received_uid, result, size)
+
+    def file_written(self, ds, received_uid, result, size=None):
+        """
+        Record a file written to the output in the catalog and for the export. result is (path, transfer
+        syntax), or (shard, transfer syntax, size, offset) for archived instances, or None if the file could
+        not be written.
+        """
+        if size is not None:
+            self.release(size)
+        if not result or not (self.catalog or self.exporter):
+            return
+        filepath, transfer_syntax = result[:2]
+        try:
+            file_size, offset = result[2:] if len(result) > 2 else (os.path.getsize(filepath), None)
+            if self.catalog:
+                self.catalog.add(ds, received_uid, filepath, file_size, transfer_syntax, offset)
+            if self.exporter:
+                self.exporter.add(ds, (filepath, offset, file_size))
+        except Exception as exc:
+            print('\nUnable to add {} to the catalog: {}'.format(filepath, exc))
+
+    def admit(self, size):
+        """
+        Reserve room in the post-processing pipeline for a received file. Depending on pipeline.policy,
+        wait for room (up to pipeline.block_timeout) or return False immediately when the pipeline is full.
+        """
+        deadline = time.time() + self.block_timeout
+        with self.pipeline:
+            while self.pending_files and (self.pending_files >= self.max_files or
+                (self.max_bytes and self.pending_bytes + size > self.max_bytes)):
+                remaining = deadline - time.time()
+                if self.policy == 'reject' or remaining <= 0:
+                    self.rejected_count += 1
+                    return False
+                self.pipeline.wait(remaining)
+            self.pending_files += 1
+            self.pending_bytes += size
+            return True
+
+    def release(self, size):
+        with self.pipeline:
+            self.pending_files -= 1
+            self.pending_bytes -= size
+            self.pipeline.notify_all()
+
+    def wait_for_capacity(self):
+        """
+        Wait until the post-processing backlog drops below pipeline.resume_fraction of its limits.
+        Used by the SCU before issuing a C-MOVE.
+        """
+        with self.pipeline:
+            while self.pending_files and (self.pending_files >= self.max_files * self.resume_fraction or
+                (self.max_bytes and self.pending_bytes >= self.max_bytes * self.resume_fraction)):
+                self.pipeline.wait(1)
+
+    def queue_depth(self):
+        """
+        Return the post-processing backlog: files waiting to be written and to be transcoded
+        """
+        with self.pipeline:
+            return {'pending_files': self.pending_files,
+                'pending_bytes': self.pending_bytes,
+                'writing_queue': self.writing_queue.qsize(),
+                'transcoding': self.transcoder.pending if self.transcoder else 0,
+                'rejected': self.rejected_count}
+
+    def store(self, event):
+        """
+        Write a received data set as is to the temporary directory. Without anonymization, only the elements
+        needed for the directory_structure are parsed and the file is moved to the output right away.
+        """
+        received_uid = event.request.AffectedSOPInstanceUID
+        if self.catalog and self.catalog.contains(received_uid):
+            # Already stored, acknowledge without decoding or writing the data set
+            self.duplicate_count += 1
+            metrics.inc('pydicombatch_duplicates_total')
+            return 0x0000
+
+        # The data sets of an SCP streaming to disk are written to disk while they are received
+        try:
+            spooled = event.dataset_path
+        except AttributeError:
+            spooled = None
+        if spooled:
+            source = str(spooled)
+            size = os.path.getsize(source)
+        else:
+            data = encoded_dataset(event)
+            source = BytesIO(data)
+            size = len(data)
+        metrics.inc('pydicombatch_bytes_received_total', size)
+        ds = None
+        if self.fast_store:
+            try:
+                ds = dcmread(source, stop_before_pixels=True, specific_tags=self.header_tags)
+                for tag in self.layout_tags:
+                    ds[tag].value
+            except Exception as exc:
+                # Unable to decode dataset
+                return 0xC210
+
+        if not self.admit(size):
+            # Failed - Out of Resources, the peer may retry later
+            return 0xA700
+
+        filename = os.path.join(self.temp_dir, '{0!s}.dcm'.format(uuid.uuid4()))
+        try:
+            if spooled:
+                # pynetdicom deletes the spooled file after the handler returns, unless it was moved.
+                #   Spooled files are created readable by the owner only, they are given the default permissions
+                shutil.move(source, filename)
+                os.chmod(filename, 0o666 & ~UMASK)
+            else:
+                with open(filename, 'wb') as f:
+                    f.write(data)
+        except IOError:
+            # Failed - Out of Resources - IOError
+            self.release(size)
+            return 0xA700
+
+        self.file_count += 1
+        if ds is None:
+            self.writing_queue.put((filename, size, received_uid))
+            return 0x0000 # Success
+        try:
+            self.move_to_output(filename, ds, size, received_uid)
+            return 0x0000 # Success
+        except IOError:
+            # Failed - Out of Resources - IOError
+            return 0xA700
+        except:
+            # Failed - Out of Resources - Miscellaneous error
+            return 0xA701
 
     def start_file_writing_workers(self):
         self.file_writing_workers = []
@@ -166,34 +554,55 @@ class SCP(object):
             worker.start()
             self.file_writing_workers.append(worker)
 
-    def start_server(self):
-        print('Starting local storage SCP server on port {}'.format(self.config['local']['port']))
+    def start_server(self, listen=True):
         # Create a temporary directory to store files prior to anonymization
-        temp_dir = os.path.join(self.config['output']['directory'],'tmp')
-        os.makedirs(temp_dir, exist_ok = True)
+        os.makedirs(self.temp_dir, exist_ok = True)
+        if self.config['request']['type'].lower() == 'c-get' or not listen:
+            # Instances are received on the C-GET associations (or by the listener of the service)
+            return
+        self.ae = self.create_ae()
+        print('Starting local storage SCP server on port {}'.format(self.config['local']['port']))
         handlers = [(evt.EVT_C_STORE, self.handle_store), (evt.EVT_C_ECHO, self.handle_echo)]
         self.scp = self.ae.start_server(('', self.config['local']['port']), block=False, evt_handlers=handlers)
 
     def stop_server(self):
-        old_qsize = self.writing_queue.qsize()
+        old_qsize = self.pending_files
         pbar = tqdm.tqdm(total=old_qsize, 
             desc='Post-processing ', 
             unit='files')
-        while self.writing_queue.qsize():
-            qsize = self.writing_queue.qsize()
+        while self.pending_files:
+            qsize = self.pending_files
             pbar.update(old_qsize-qsize)
             old_qsize = qsize
             time.sleep(0.1)
-        pbar.update(old_qsize-self.writing_queue.qsize())
+        pbar.update(old_qsize-self.pending_files)
         pbar.close()    
         self.writing_queue.join()
+        for worker in self.file_writing_workers:
+            self.writing_queue.put(None)
+        if self.transcoder:
+            self.transcoder.shutdown()
+        if self.archive:
+            self.archive.close()
+        if self.exporter:
+            if self.catalog:
+                self.catalog.flush()
+            self.exporter.run(self.catalog)
+        if self.catalog:
+            self.catalog.close()
+        if self.duplicate_count:
+            print('{} instances were already stored and were not written again'.format(self.duplicate_count))
+        if self.rejected_count:
+            print('{} C-STORE requests were rejected because the post-processing pipeline was full'.format(self.rejected_count))
         time_elapsed = time. time() - self.time_start
         print('Stopping local storage SCP server: {} files transferred in {:.1f} seconds ({:.2f} files/s)'.format(self.file_count, time_elapsed, self.file_count/time_elapsed))
-        self.scp.shutdown()
-        temp_dir = os.path.join(self.config['output']['directory'],'tmp')
+        if self.scp:
+            self.scp.shutdown()
+        if self.stream_to_disk:
+            disable_stream_to_disk(self)
         # Remove temporary directory if empty
-        if not os.listdir(temp_dir):
-            shutil.rmtree(temp_dir)
+        if not os.listdir(self.temp_dir):
+            shutil.rmtree(self.temp_dir)
 
 
     def handle_echo(self, event):
@@ -234,68 +643,8 @@ class SCP(object):
             ``StorageServiceClass`` implementation for the available statuses
         """
 
-        
-        mode_prefixes = {'CT Image Storage' : 'CT',
-            'Enhanced CT Image Storage' : 'CTE',
-            'MR Image Storage' : 'MR',
-            'Enhanced MR Image Storage' : 'MRE',
-            'Positron Emission Tomography Image Storage' : 'PT',
-            'RT Plan Storage' : 'RP',
-            'RT Structure Set Storage' : 'RS',
-            'Computed Radiography Image Storage' : 'CR',
-            'Ultrasound Image Storage' : 'US',
-            'Enhanced Ultrasound Image Storage' : 'USE',
-            'X-Ray Angiographic Image Storage' : 'XA',
-            'Enhanced XA Image Storage' : 'XAE',
-            'Nuclear Medicine Image Storage' : 'NM',
-            'Secondary Capture Image Storage' : 'SC'
-        }
-
-        ds = event.dataset
-        # Because pydicom uses deferred reads for its decoding, decoding errors
-        #   are hidden until encountered by accessing a faulty element
-        try:
-            sop_class = ds.SOPClassUID
-            sop_instance = ds.SOPInstanceUID
-        except Exception as exc:
-            # Unable to decode dataset
-            return 0xC210
-
-        try:
-            # Get the elements we need
-            mode_prefix = mode_prefixes[sop_class.name]
-        except KeyError:
-            mode_prefix = 'UN'
-
-        filename = os.path.join(self.config['output']['directory'],'tmp/{0!s}.dcm'.format(uuid.uuid4()))
-
-        # Presentation context
-        cx = event.context
-
-        meta = Dataset()
-        meta.MediaStorageSOPClassUID = sop_class
-        meta.MediaStorageSOPInstanceUID = sop_instance
-        
-        meta.TransferSyntaxUID = cx.transfer_syntax
-        
-
-        ds.file_meta = meta
-        ds.is_little_endian = cx.transfer_syntax.is_little_endian
-        ds.is_implicit_VR = cx.transfer_syntax.is_implicit_VR
-
         status_ds = Dataset()
-        
-        try:
-            ds.save_as(filename, write_like_original=False)
-            self.file_count += 1
-            self.writing_queue.put((filename, ds))
-            status_ds.Status = 0x0000 # Success
-        except IOError:
-            # Failed - Out of Resources - IOError
-            status_ds.Status = 0xA700
-        except:
-            # Failed - Out of Resources - Miscellaneous error
-            status_ds.Status = 0xA701
-
-
+        with metrics.timer('pydicombatch_store_duration_seconds'):
+            status_ds.Status = self.store(event)
+        metrics.inc('pydicombatch_instances_received_total', status=hex(status_ds.Status))
         return status_ds
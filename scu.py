@@ -6,30 +6,52 @@ import os.path
 import csv
 import time
 import datetime
-import pytz
 import signal
 import tqdm
 import concurrent.futures
-import numpy as np
 import inquirer
-import ast
 import threading
+import itertools
+import collections
+import functools
 
 from pynetdicom import (
     AE, QueryRetrievePresentationContexts
 )
 
 from pynetdicom.sop_class import (
+    Verification,
     PatientRootQueryRetrieveInformationModelFind,
     StudyRootQueryRetrieveInformationModelFind,
     PatientStudyOnlyQueryRetrieveInformationModelFind,
     PatientRootQueryRetrieveInformationModelMove,
     StudyRootQueryRetrieveInformationModelMove,
-    PatientStudyOnlyQueryRetrieveInformationModelMove
+    PatientStudyOnlyQueryRetrieveInformationModelMove,
+    PatientRootQueryRetrieveInformationModelGet,
+    StudyRootQueryRetrieveInformationModelGet,
+    PatientStudyOnlyQueryRetrieveInformationModelGet
 )
+from pynetdicom import evt, build_role
+import pynetdicom.sop_class
+
+from pool import AssociationPool, AssociationError
+from scheduler import RequestQueue, LeaseQueue, element_value
+from planner import DateRangePlanner, UIDListCoalescer, DescriptionFilter
+from journal import Journal, PENDING, RUNNING, FAILED, CANCELLED
+from sink import ResultWriter, dataset_to_dict
+from scp import STORAGE_TRANSFER_SYNTAXES
+from metrics import metrics, COUNT_BUCKETS
+from ratecontrol import RateController
+from window import ScheduleWindow
 
 continue_extraction = True
 
+# Requests generated from elements_batch_file are added to the journal and to the queue in batches
+REQUEST_BATCH_SIZE = 10000
+
+# Ways of handling a previous extraction without prompting (see load_requests)
+RESUME_MODES = ['new', 'resume', 'retry']
+
 def sigint_handler(signal, frame):
     global continue_extraction
     continue_extraction = False
@@ -39,45 +61,13 @@ def watch_sigint():
     signal.signal(signal.SIGINT, sigint_handler)
 
 
-class hashabledict(dict):
-    def __hash__(self):
-        return hash(tuple(sorted(self.items())))
-
-def dataset_to_csv(ds, filepath, fieldnames):
-    write_dict = {}
-    for key in fieldnames:
-        write_dict[key] = str(ds[key].value)
-
-    dict_to_csv(write_dict, filepath, fieldnames)
-
-def request_from_csv(filepath):
-    if os.path.exists(filepath):
-        with open(filepath, 'r') as csvfile:
-            reader = csv.DictReader(csvfile)
-            rows = []
-            for row in reader:
-                rows.append(hashabledict(row))
-        return rows
-    else:
-        return []
-
-def dict_to_csv(write_dict, filepath, fieldnames):
-    if os.path.exists(filepath):
-        with open(filepath, 'a', newline='', ) as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=sorted(fieldnames), dialect='excel')
-            writer.writerow(write_dict)
-    else:
-        with open(filepath, 'w', newline='') as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=sorted(fieldnames), dialect='excel')
-            writer.writeheader()
-            writer.writerow(write_dict)
-
-def add_element_to_list(element_list, key, value):
-    if [x if ((x.partition('=')[0] == key) or (x == key)) else None for x in element_list]:
-        return [f'{key}={value}' if ((x.partition('=')[0] == key) or (x == key)) else x for x in element_list]
-    else:
-        element_list.append(f'{key}={value}')
-        return element_list
+def element_positions(elements, keys):
+    """
+    Return the (key, index) of the elements (key or key=value) that the columns of a batch file fill in.
+    Columns without a matching element are not added to the requests.
+    """
+    return [(key, i) for key in keys for i, x in enumerate(elements)
+        if x.partition('=')[0] == key or x == key]
 
 def create_dataset(request):
     ds = Dataset()
@@ -89,8 +79,8 @@ def create_dataset(request):
         raise exc
     return ds
 
-def split_date_range(date_range):
-    """Split a date range string (YYYYMMDD-YYYYMMDD) into 5-day intervals"""
+def split_date_range(date_range, days=5):
+    """Split a date range string (YYYYMMDD-YYYYMMDD) into intervals of a number of days"""
     if not date_range or '-' not in date_range:
         return [date_range]
         
@@ -101,10 +91,10 @@ def split_date_range(date_range):
     date_ranges = []
     current_date = start_date
     while current_date <= end_date:
-        # Get the date 5 days from current date
-        next_period = current_date + datetime.timedelta(days=5)
+        # Get the date a period of days from current date
+        next_period = current_date + datetime.timedelta(days=days)
             
-        # Adjust end date to be either end of current 5-day period or final end date
+        # Adjust end date to be either end of current period or final end date
         period_end_date = min(next_period - datetime.timedelta(days=1), end_date)
         
         date_range_str = f"{current_date.strftime('%Y%m%d')}-{period_end_date.strftime('%Y%m%d')}"
@@ -114,81 +104,92 @@ def split_date_range(date_range):
         
     return date_ranges
 
-def create_requests(config):
-    requests = []
-    if 'elements_batch_file' in config['request']:
-        if os.path.exists(config['request']['elements_batch_file']):
-            with open(config['request']['elements_batch_file'], newline='') as csvfile:
+def iter_requests(config):
+    """
+    Yield the requests of an extraction. elements_batch_file is read one row at a time, and each request
+    only holds its own elements on top of the config.request template, which all requests share.
+    """
+    template = config['request']
+    if 'elements_batch_file' in template:
+        if os.path.exists(template['elements_batch_file']):
+            with open(template['elements_batch_file'], newline='') as csvfile:
                 reader = csv.DictReader(csvfile, dialect='excel')
+                positions = element_positions(template['elements'], reader.fieldnames or [])
                 for row in reader:
-                    row_request = config['request'].copy()
-                    for key in row:
-                        row_request['elements'] = add_element_to_list(row_request['elements'], key, row[key])
-                    row_request['elements'] = sorted(row_request['elements'])
-                    requests.append(row_request)
+                    elements = list(template['elements'])
+                    for key, i in positions:
+                        elements[i] = f'{key}={row[key]}'
+                    yield collections.ChainMap({'elements': sorted(elements)}, template)
         else:
-            requests.append(config['request'])
+            yield template
     else:
         # Find StudyDate element and split into weekly intervals if present
         study_date_element = None
-        for element in config['request']['elements']:
+        for element in template['elements']:
             if element.startswith('StudyDate='):
                 study_date_element = element
                 break
                 
         if study_date_element:
             date_range = study_date_element.split('=')[1]
-            date_ranges = split_date_range(date_range)
+            date_split = template.get('date_split') or {}
+            date_ranges = split_date_range(date_range, int(date_split.get('days', 5)))
             
             # Create a request for each weekly interval
             for weekly_range in date_ranges:
-                weekly_request = config['request'].copy()
-                weekly_request['elements'] = weekly_request['elements'].copy()
-                
                 # Replace the StudyDate element with the weekly range
-                weekly_request['elements'] = [
+                yield collections.ChainMap({'elements': [
                     f"StudyDate={weekly_range}" if e.startswith('StudyDate=') else e 
-                    for e in weekly_request['elements']
-                ]
-                requests.append(weekly_request)
+                    for e in template['elements']
+                ]}, template)
         else:
-            requests.append(config['request'])
-
-    filepath_requests = os.path.join(config['output']['directory'], 'requests.whole')
-    filepath_requests_completed = os.path.join(config['output']['directory'], 'requests.completed')
-    filepath_requests_failed = os.path.join(config['output']['directory'], 'requests.failed')
-    if os.path.exists(filepath_requests):
-        os.remove(filepath_requests)
-    if os.path.exists(filepath_requests_completed):
-        os.remove(filepath_requests_completed)
-    if os.path.exists(filepath_requests_failed):
-        os.remove(filepath_requests_failed)
+            yield template
 
-    for request in requests:
-        dict_to_csv(request, filepath_requests, request.keys())
-
-    return requests
+def create_requests(config, journal, batch_size=REQUEST_BATCH_SIZE, resume=False):
+    """
+    Replace the requests of the journal with new requests, or with resume, generate the requests left
+    when a previous generation was interrupted. Returns an iterator over the requests: they are generated
+    and added to the journal batch_size at a time as the iterator is consumed.
+    """
+    generated = journal.generation()[0] if resume else 0
+    if not resume:
+        journal.reset()
+    description_filter = DescriptionFilter.from_config(config)
+
+    def generate(generated):
+        requests = iter_requests(config)
+        if description_filter:
+            # Filters sent to the PACS, and STUDY level queries of the drill-down
+            requests = (planned for request in requests for planned in description_filter.plan(request))
+        batch = []
+        for request in itertools.islice(requests, generated, None):
+            batch.append(request)
+            if len(batch) >= batch_size:
+                generated += len(batch)
+                journal.add(batch, generated)
+                yield from batch
+                batch = []
+        journal.add(batch, generated + len(batch), complete=True)
+        yield from batch
+    return generate(generated)
+
+def resume_generation(config, journal, requests):
+    """
+    Append the requests that were not generated yet when the previous extraction stopped
+    """
+    if journal.generation()[1]:
+        return requests
+    return itertools.chain(requests, create_requests(config, journal, resume=True))
 
-def pending_requests(config):
+def pending_requests(config, journal):
     """
     Returns pending requests to enable resuming
     """
-    filepath_requests = os.path.join(config['output']['directory'], 'requests.whole')
-    filepath_requests_completed = os.path.join(config['output']['directory'], 'requests.completed')
-
-    reqs1 = request_from_csv(filepath_requests)
-    reqs2 = []
-    if os.path.isfile(filepath_requests_completed):
-        reqs2 = request_from_csv(filepath_requests_completed)
-
-    requests = list(set(reqs1) - set(reqs2))
-    for request in requests:
-        request['elements'] = list(sorted(ast.literal_eval(request['elements'])))
-        request['throttle_time'] = float(request['throttle_time'])
-        request['threads'] = int(request['threads'])
+    # Requests that were running when the previous extraction stopped are pending again
+    requests = journal.requests(PENDING, RUNNING)
     
     questions = []
-    if requests:
+    if requests or not journal.generation()[1]:
         questions = [
         inquirer.List('resume',
                         message="A partial extraction was detected. Do you want to resume or overwrite?",
@@ -205,15 +206,15 @@ def pending_requests(config):
 
     answers = inquirer.prompt(questions)
     if answers['resume'] == 'Overwrite':
-        requests = create_requests(config)
+        requests = create_requests(config, journal)
+    elif answers['resume'] == 'Resume':
+        requests = resume_generation(config, journal, requests)
     return requests
 
-def failed_requests(config):
+def failed_requests(config, journal):
     """
     Returns failed requests to enable re-trying
     """
-    filepath_requests_failed = os.path.join(config['output']['directory'], 'requests.failed')
-
     questions = [
     inquirer.List('failed',
                     message="Failed requests from a previous extraction were detected. Do you want to re-try the failed requests?",
@@ -224,147 +225,252 @@ def failed_requests(config):
 
     requests = []
     if answers['failed'] == 'Remove failed requests':
-        requests = pending_requests(config)
+        journal.set_state(FAILED, CANCELLED)
+        requests = pending_requests(config, journal)
     else:
-        reqs1 = request_from_csv(filepath_requests_failed)
-        requests = list(set(reqs1))
-        for request in requests:
-            request['elements'] = list(sorted(ast.literal_eval(request['elements'])))
-            request['throttle_time'] = float(request['throttle_time'])
-            request['threads'] = int(request['threads'])
-    
-    if os.path.exists(filepath_requests_failed):
-        os.remove(filepath_requests_failed)
+        requests = resume_generation(config, journal, journal.requests(FAILED))
+        journal.set_state(FAILED, PENDING)
     
     return requests
 
-def thread_scu_function(config, pbar, pbar_lock, requests):
-    scu = SCU(config)
+def thread_scu_function(config, pool, planner, coalescer, journal, sink, scp, rate, window, queue, pbar, pbar_lock):
+    scu = SCU(config, pool, planner, journal, sink)
+    scu.scp = scp
+    scu.rate = rate
+    scu.window = window
+    scu.coalescer = coalescer
     scu.pbar = pbar
     scu.pbar_lock = pbar_lock  # Pass the shared progress bar lock
-    scu.process_requests_batch(list(requests))
+    scu.process_requests_batch(queue)
     return
 
-def process_request_batch(config):
-
-    requests = []
-    filepath_requests = os.path.join(config['output']['directory'], 'requests.whole')
-    filepath_requests_completed = os.path.join(config['output']['directory'], 'requests.completed')
-    filepath_requests_failed = os.path.join(config['output']['directory'], 'requests.failed')
-
-    if (os.path.isfile(filepath_requests)):
+def load_requests(config, journal, mode=None):
+    """
+    Returns the requests to process: new requests, or the pending / failed requests of a previous extraction.
+    With mode (service jobs), a previous extraction is handled without prompting: 'new' overwrites it,
+    'resume' processes its pending requests and 'retry' its pending and failed requests.
+    """
+    if not journal.count() and journal.import_csv():
+        print('Imported requests of a previous extraction from CSV files into {}'.format(journal.path))
+
+    if journal.count() and mode in RESUME_MODES:
+        if mode == 'new':
+            return create_requests(config, journal)
+        if mode == 'retry':
+            journal.set_state(FAILED, PENDING)
+        return resume_generation(config, journal, journal.requests(PENDING, RUNNING))
+    if journal.count():
         # Previous extraction detected
-        if os.path.isfile(filepath_requests_failed):
+        if journal.count(FAILED):
             # Failed requests detected
-            requests = failed_requests(config)
-        else:
-            # No failed requests detected, return pending requests
-            requests = pending_requests(config)
+            return failed_requests(config, journal)
+        # No failed requests detected, return pending requests
+        return pending_requests(config, journal)
+    # No previous extraction detected
+    return create_requests(config, journal)
+
+def run_threads(config, journal, queue, scp=None, pbar=None, pool=None):
+    """
+    Process the requests of a queue with config.request.threads SCU threads. pool is an association pool
+    kept open by the caller (service mode), by default a pool is created and closed with the threads.
+    """
+    pbar_lock = threading.Lock()  # Create a shared lock for the progress bar
+    shared_pool = pool is not None
+    # Associations are shared by all threads through a single pool
+    if shared_pool:
+        # The C-STORE handler of C-GET associations is bound to the SCP of a single extraction
+        if config['request']['type'].lower() == 'c-get':
+            raise ValueError('C-GET requests cannot use a shared association pool')
+    elif config['request']['type'].lower() == 'c-get':
+        # C-STORE sub-operations are received on the C-GET associations and handed to the SCP pipeline
+        pool = AssociationPool(create_ae(config), config, ext_neg=storage_roles(config),
+            evt_handlers=[(evt.EVT_C_STORE, scp.handle_store)])
     else:
-        # No previous extraction detected
-        requests = create_requests(config)
+        pool = AssociationPool(create_ae(config), config)
+    # C-FIND date windows are adapted to the PACS result limit by a shared planner
+    planner = DateRangePlanner(config)
+    # Batch file rows differing only by a UID are sent as UID list queries
+    coalescer = UIDListCoalescer.from_config(config)
+    # Results are written by a single thread in batches
+    sink = ResultWriter.from_config(config)
+    # Request rate and concurrency adapted to the PACS response (replaces throttle_time)
+    rate = RateController.from_config(config)
+    # Requests are only started if they are expected to complete before the schedule window closes
+    #   (a shared pool is used by the other jobs of the service and is not closed while this one is paused)
+    window = ScheduleWindow(config, journal, None if shared_pool else pool, scp)
+    metrics.gauge('pydicombatch_request_queue_depth', lambda : len(queue))
+    metrics.gauge('pydicombatch_writer_queue_depth', lambda : sink.queue.qsize())
+    delta = config['request'].get('delta') or {}
+    if delta.get('enabled') and scp and scp.anonymization_enabled and not scp.catalog:
+        print('Delta retrieval DISABLED: instances stored with anonymization can only be matched with the PACS through the catalog')
+    fn = lambda : thread_scu_function(config, pool, planner, coalescer, journal, sink, scp, rate, window, queue, pbar, pbar_lock)
+    try:
+        if config['request'].get('engine', 'threads') == 'asyncio' and config['request']['type'].lower() == 'c-find':
+            # Imported here since the asyncio engine extends the SCU class
+            from aioscu import run_async
+            run_async(config, pool, planner, coalescer, journal, sink, scp, rate, window, queue, pbar, pbar_lock)
+        elif config['request']['threads'] > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=config['request']['threads']) as executor:
+                for i in range(config['request']['threads']):
+                    executor.submit(fn)
+        else:
+            fn()
+    except KeyboardInterrupt:
+        queue.close()
+        raise
+    finally:
+        if not shared_pool:
+            pool.close()
+        sink.close()
+
+def process_request_batch(config, scp=None):
+
+    journal = Journal(config['output']['directory'])
+    requests = load_requests(config, journal)
     
     if requests:
         watch_sigint()
-        split_requests = np.array_split(requests, config['request']['threads'])
         print('To stop extraction, press CTRL-C. Extraction can be resumed at a later time.')
-        pbar = tqdm.tqdm(total=len(requests), 
+        pbar = tqdm.tqdm(total=0, 
             desc='Sending {} requests '.format(config['request']['type']), 
             unit='rqst')
-        pbar_lock = threading.Lock()  # Create a shared lock for the progress bar
-        fn = lambda x : thread_scu_function(config, pbar, pbar_lock, x)
-        if config['request']['threads'] > 1:
-            with concurrent.futures.ThreadPoolExecutor(max_workers=config['request']['threads']) as executor:
-                executor.map(fn, split_requests)
-        else:
-            fn(split_requests[0])
+        # Workers pull requests from a shared queue as they free up, while new requests are still generated
+        queue = RequestQueue(config)
+        queue.feed(requests, REQUEST_BATCH_SIZE, lambda count : update_total(pbar, count))
+        run_threads(config, journal, queue, scp, pbar)
         pbar.close()
     else:
         print('No further requests pending')
+    journal.close()
 
+def update_total(pbar, count):
+    pbar.total += count
+    pbar.refresh()
 
-def seconds_until(time_str, tzname):
+def process_worker(config, worker, scp=None):
     """
-    Returns the number of seconds from now until the time in format HH:mm
+    Process requests claimed from the journal shared with other worker processes
     """
-    
-    list_time_str = time_str.split(':')
-    
-
-    h = int(list_time_str[0])
-    m = int(list_time_str[1])
-    tz = pytz.timezone(tzname)
-    now = datetime.datetime.now(tz=tz)
-    return int((datetime.timedelta(hours=24) 
-        - (now - now.replace(hour=h, minute=m, second=0, microsecond=0)))
-        .total_seconds() % (24 * 3600))
+    journal = Journal(config['output']['directory'])
+    watch_sigint()
+    workers = config.get('workers') or {}
+    queue = LeaseQueue(journal, worker, float(workers.get('lease_time', 300)), float(workers.get('poll_interval', 5)))
+    try:
+        run_threads(config, journal, queue, scp)
+    finally:
+        queue.close()
+        journal.close()
+
+
+def create_ae(config):
+    # Create application entity
+    ae = AE(ae_title=config['local']['aet'])
+
+    # Set timeouts
+    ae.acse_timeout = 300
+    ae.dimse_timeout = 300
+    ae.network_timeout = 300
+
+    # Set the Presentation Contexts we are requesting the Find SCP support
+    if config['request']['type'].lower() == 'c-find':
+        ae.requested_contexts = QueryRetrievePresentationContexts
+
+    elif config['request']['type'].lower() == 'c-move':
+        ae.requested_contexts = QueryRetrievePresentationContexts
+
+    elif config['request']['type'].lower() == 'c-get':
+        # The Find models are used to list the instances of a request (delta retrieval)
+        for sop_class in [PatientRootQueryRetrieveInformationModelGet, StudyRootQueryRetrieveInformationModelGet,
+                PatientStudyOnlyQueryRetrieveInformationModelGet]:
+            ae.add_requested_context(sop_class)
+            ae.add_requested_context(FIND_MODELS[sop_class])
+        # Instances are received as C-STORE sub-operations on the C-GET association
+        for sop_class in storage_classes(config):
+            ae.add_requested_context(sop_class, STORAGE_TRANSFER_SYNTAXES)
+
+    # Verification is always requested so that pooled associations can be checked with C-ECHO
+    ae.add_requested_context(Verification)
+
+    return ae
+
+# Storage SOP classes requested for C-GET by default: images of the common modalities, presentation states,
+#   key object selections, structured reports and documents (an association has at most 128 presentation contexts)
+DEFAULT_STORAGE_CLASSES = [
+    'ComputedRadiographyImageStorage', 'DigitalXRayImageStorageForPresentation',
+    'DigitalXRayImageStorageForProcessing', 'DigitalMammographyXRayImageStorageForPresentation',
+    'DigitalMammographyXRayImageStorageForProcessing', 'BreastTomosynthesisImageStorage',
+    'CTImageStorage', 'EnhancedCTImageStorage', 'MRImageStorage', 'EnhancedMRImageStorage',
+    'EnhancedMRColorImageStorage', 'MRSpectroscopyStorage', 'UltrasoundImageStorage',
+    'UltrasoundMultiFrameImageStorage', 'EnhancedUSVolumeStorage', 'XRayAngiographicImageStorage',
+    'EnhancedXAImageStorage', 'XRayRadiofluoroscopicImageStorage', 'EnhancedXRFImageStorage',
+    'XRay3DAngiographicImageStorage', 'NuclearMedicineImageStorage', 'PositronEmissionTomographyImageStorage',
+    'EnhancedPETImageStorage', 'SecondaryCaptureImageStorage', 'MultiFrameGrayscaleByteSecondaryCaptureImageStorage',
+    'MultiFrameGrayscaleWordSecondaryCaptureImageStorage', 'MultiFrameTrueColorSecondaryCaptureImageStorage',
+    'MultiFrameSingleBitSecondaryCaptureImageStorage', 'GrayscaleSoftcopyPresentationStateStorage',
+    'ColorSoftcopyPresentationStateStorage', 'BlendingSoftcopyPresentationStateStorage',
+    'KeyObjectSelectionDocumentStorage', 'BasicTextSRStorage', 'EnhancedSRStorage', 'ComprehensiveSRStorage',
+    'Comprehensive3DSRStorage', 'ExtensibleSRStorage', 'XRayRadiationDoseSRStorage',
+    'RadiopharmaceuticalRadiationDoseSRStorage', 'MammographyCADSRStorage', 'ChestCADSRStorage',
+    'ProcedureLogStorage', 'EncapsulatedPDFStorage', 'EncapsulatedCDAStorage', 'RawDataStorage',
+    'SpatialRegistrationStorage', 'DeformableSpatialRegistrationStorage', 'SegmentationStorage',
+    'VLPhotographicImageStorage', 'VLEndoscopicImageStorage', 'VLMicroscopicImageStorage',
+    'VLWholeSlideMicroscopyImageStorage', 'OphthalmicPhotography8BitImageStorage', 'RTImageStorage',
+    'RTDoseStorage', 'RTStructureSetStorage', 'RTPlanStorage', 'RTIonPlanStorage',
+    'RTBeamsTreatmentRecordStorage', 'TwelveLeadECGWaveformStorage', 'GeneralECGWaveformStorage',
+]
+
+def storage_classes(config):
+    """
+    Return the storage SOP classes requested with the SCP role for C-GET: request.storage_classes
+    (e.g. CTImageStorage), or DEFAULT_STORAGE_CLASSES
+    """
+    keywords = config['request'].get('storage_classes') or DEFAULT_STORAGE_CLASSES
+    return [getattr(pynetdicom.sop_class, keyword) for keyword in keywords]
+
+def storage_roles(config):
+    return [build_role(sop_class, scp_role=True) for sop_class in storage_classes(config)]
+
+# Query model used to list the instances of a C-MOVE / C-GET request before retrieving them
+FIND_MODELS = {
+    PatientRootQueryRetrieveInformationModelMove: PatientRootQueryRetrieveInformationModelFind,
+    StudyRootQueryRetrieveInformationModelMove: StudyRootQueryRetrieveInformationModelFind,
+    PatientStudyOnlyQueryRetrieveInformationModelMove: PatientStudyOnlyQueryRetrieveInformationModelFind,
+    PatientRootQueryRetrieveInformationModelGet: PatientRootQueryRetrieveInformationModelFind,
+    StudyRootQueryRetrieveInformationModelGet: StudyRootQueryRetrieveInformationModelFind,
+    PatientStudyOnlyQueryRetrieveInformationModelGet: PatientStudyOnlyQueryRetrieveInformationModelFind,
+}
 
 class SCU(object):
     """ SCU class
-    This class is used to send batches of DIMSE requests (c-find, c-echo, c-move) to a remote SCP
+    This class is used to send batches of DIMSE requests (c-find, c-echo, c-move, c-get) to a remote SCP
     """
-    def __init__(self, config):
+    def __init__(self, config, pool=None, planner=None, journal=None, sink=None):
         self.config = config
-        self.ae = self.create_ae()
+        self.pool = pool if pool else AssociationPool(self.create_ae(), config)
+        self.planner = planner if planner else DateRangePlanner(config)
+        self.journal = journal if journal else Journal(config['output']['directory'])
+        self.sink = sink if sink else ResultWriter.from_config(config)
+        self.queue = RequestQueue(config)
+        self.association = None
+        self.scp = None
+        self.rate = None
+        self.window = None
+        self.coalescer = None
+        self.description_filter = DescriptionFilter.from_config(config)
         self.query_model = self.create_query_model()
         self.pbar = None
         self.pbar_lock = threading.Lock()  # Add thread lock for progress bar updates
         
     def create_ae(self):
-        # Create application entity
-        ae = AE(ae_title=self.config['local']['aet'])
-
-        # Set timeouts
-        ae.acse_timeout = 300
-        ae.dimse_timeout = 300
-        ae.network_timeout = 300
-
-        # Set the Presentation Contexts we are requesting the Find SCP support
-        if self.config['request']['type'].lower() == 'c-find':
-            ae.requested_contexts = QueryRetrievePresentationContexts
-                
-        elif self.config['request']['type'].lower() == 'c-echo':
-            ae.requested_contexts = [VerificationSOPClass]
-
-        elif self.config['request']['type'].lower() == 'c-move':
-            ae.requested_contexts = QueryRetrievePresentationContexts
-
-        return ae
-
-    def establish_association(self):
-        return self.ae.associate(self.config['pacs']['hostname'], 
-            self.config['pacs']['port'],  
-            ae_title=self.config['pacs']['aet'],
-            max_pdu=16382)
-
-    def wait_until_scheduled_time(self):
-        
-        if 'schedule' in self.config:
-            if self.config['schedule']['enabled']:
-                sec_until_start = seconds_until(self.config['schedule']['start_time'], self.config['schedule']['timezone'])
-                sec_until_end = seconds_until(self.config['schedule']['end_time'], self.config['schedule']['timezone'])
-    
-                if sec_until_end > sec_until_start:
-                    if self.pbar:
-                        self.pbar.set_description('Extraction PAUSED (will resume at {})'.format(self.config['schedule']['start_time']))
-                    time.sleep(sec_until_start)
-                else:
-                    if self.pbar:
-                        self.pbar.set_description('Sending {} requests (will pause at {})'.format(self.config['request']['type'], self.config['schedule']['end_time']))
-                    
-
-    def retry_association(self):
-
-        for i in range(100):
-            if not self.association.is_established:
-                time.sleep(1)
-                print('Re-trying association')
-                self.association = self.establish_association()
-            else:
-                return
-        
-        sys.exit(1)
+        return create_ae(self.config)
 
+    def wait_until_scheduled_time(self, request):
+        """
+        Wait until the request can be completed inside the schedule window. Returns False if the extraction is stopped.
+        """
+        if not self.window:
+            return True
+        return self.window.wait(request, lambda : continue_extraction, self.pbar)
 
     def create_query_model(self):
         request = self.config['request']
@@ -383,26 +489,182 @@ class SCU(object):
                 query_model = PatientStudyOnlyQueryRetrieveInformationModelMove
             else:
                 query_model = PatientRootQueryRetrieveInformationModelMove
+        elif request['type'].lower() == 'c-get':
+            if request['model'] == 'study':
+                query_model = StudyRootQueryRetrieveInformationModelGet
+            elif self.config['request']['model'] == 'psonly':
+                query_model = PatientStudyOnlyQueryRetrieveInformationModelGet
+            else:
+                query_model = PatientRootQueryRetrieveInformationModelGet
         return query_model
 
-    def process_requests_batch(self, requests):
+    def process_requests_batch(self, queue):
         global continue_extraction
 
-        self.association = self.establish_association()
-        for request in requests:
-            if continue_extraction:
-                self.wait_until_scheduled_time()
-                self.process_request(request)
+        self.queue = queue
+        while continue_extraction:
+            request = queue.get()
+            if request is None:
+                break
+            try:
+                if continue_extraction:
+                    request = self.merge(request, queue)
+                    if not self.wait_until_scheduled_time(request):
+                        break
+                    if self.rate:
+                        self.rate.acquire()
+                        try:
+                            self.update_postfix()
+                            self.process_request(request)
+                        finally:
+                            self.rate.release()
+                    else:
+                        self.process_request(request)
+            finally:
+                queue.task_done()
+            if not self.rate:
                 time.sleep(request['throttle_time'])
-        self.association.release()
+
+    def merge(self, request, queue):
+        """
+        Merge the request with the compatible requests at the head of the queue (adjacent date windows,
+        or UIDs sent as a UID list)
+        """
+        request = self.planner.merge(request, queue)
+        if self.coalescer:
+            request = self.coalescer.merge(request, queue)
+        return request
+
+    def is_refused(self, status, completed=0):
+        """
+        Return True if the PACS refused a coalesced request as a whole: refused (out of resources) or
+        identifier error / unable to process status, without any completed sub-operation
+        """
+        if not status or completed:
+            return False
+        return status.Status in [0xA700, 0xA701, 0xA702, 0xA900] or 0xC000 <= status.Status <= 0xCFFF
+
+    def fall_back(self, request):
+        """
+        Queue the requests of a coalesced request again, to be sent on their own
+        """
+        self.coalescer.exclude(request)
+        for part in request['_parts']:
+            self.queue.put(part, priority=-1)
+
+    def update_postfix(self):
+        """
+        Show the rate chosen by the rate controller and the SCP backlog in the progress bar
+        """
+        if not self.pbar:
+            return
+        postfix = {}
+        if self.rate:
+            postfix['rate'] = '{:.2f}/s'.format(self.rate.rate)
+            postfix['concurrency'] = int(self.rate.concurrency)
+        if self.scp:
+            postfix['backlog'] = self.scp.queue_depth()['pending_files']
+        with self.pbar_lock:
+            self.pbar.set_postfix(postfix, refresh=False)
+
+    def record_outcome(self, latency, ok):
+        if self.rate:
+            self.rate.record(latency, ok)
         
     
     def process_request(self, request):
-        if request['type'].lower() == 'c-find':
-            self.send_find(request)
-        if request['type'].lower() == 'c-move':
-            self.send_move(request)
+        for part in request.get('_parts', [request]):
+            self.journal.start(part)
+        time_start = time.time()
+        try:
+            with self.pool.association() as association:
+                self.association = association
+                if request['type'].lower() == 'c-find':
+                    self.send_find(request)
+                if request['type'].lower() in ['c-move', 'c-get']:
+                    self.send_move(request)
+            if self.window:
+                self.window.record((time.time() - time_start) / len(request.get('_parts', [request])))
+        except AssociationError as exc:
+            print('\n{}'.format(exc))
+            self.record_outcome(None, False)
+            for part in request.get('_parts', [request]):
+                self.request_failed(part)
+        finally:
+            self.association = None
         return
+
+    def split_request(self, request, response_count):
+        """
+        Re-issue a C-FIND request whose response count reached the result limit as smaller requests
+        """
+        self.planner.record(request, response_count)
+        if '_parts' in request:
+            # The merged window was denser than expected, query the original windows again
+            if request.get('_coalesced'):
+                self.coalescer.exclude(request)
+            for part in request['_parts']:
+                self.queue.put(part, priority=-1)
+            return
+
+        children = self.planner.bisect(request)
+        if not children:
+            study_date = element_value(request, 'StudyDate')
+            print(f"\nWARNING: Response count ({response_count}) reached the result limit for date range {study_date} and the request cannot be split further. The request is marked as failed.")
+            self.request_failed(request)
+            return
+
+        # Sub-requests replace the request in the journal so that they can be resumed
+        self.journal.split(request, children, response_count)
+        for child in children:
+            self.queue.put(child, priority=-1)
+        if self.pbar:
+            with self.pbar_lock:  # Use lock when updating the progress bar
+                self.pbar.total += len(children)
+                self.pbar.update(1)
+
+    def drill_down(self, request, response_count, studies):
+        """
+        Replace a STUDY level request of the drill-down by the SERIES level requests of the studies that
+        passed the study filter
+        """
+        children = [child for study in studies for child in self.description_filter.series_requests(request, study)]
+        parts = request.get('_parts', [request])
+        # Series requests replace the study requests in the journal so that they can be resumed
+        for i, part in enumerate(parts):
+            self.journal.split(part, children if i == 0 else [], response_count if len(parts) == 1 else None)
+        for child in children:
+            self.queue.put(child, priority=-1)
+        if self.pbar:
+            with self.pbar_lock:
+                self.pbar.total += len(children)
+                self.pbar.update(len(parts))
+
+    def request_completed(self, request, result_count=None):
+        metrics.inc('pydicombatch_requests_total', operation=request['type'].lower(), outcome='completed')
+        if self.pbar:
+            with self.pbar_lock:  # Use lock when updating the progress bar
+                self.pbar.update(1)
+        self.journal.complete(request, result_count)
+
+    def parts_completed(self, parts, result_count=None):
+        """
+        Mark the requests merged into a request as completed. The result count is only recorded for a
+        request that was not merged.
+        """
+        for part in parts:
+            self.request_completed(part, result_count if len(parts) == 1 else None)
+
+    def parts_failed(self, parts):
+        for part in parts:
+            self.request_failed(part)
+
+    def request_failed(self, request):
+        metrics.inc('pydicombatch_requests_total', operation=request['type'].lower(), outcome='failed')
+        if self.pbar:
+            with self.pbar_lock:  # Use lock when updating the progress bar
+                self.pbar.update(1)
+        self.journal.fail(request)
     
     
     def send_find(self, request):
@@ -412,59 +674,170 @@ class SCU(object):
         keywords = [ElementPath(path).keyword for path in request['elements']]
 
         if not self.association.is_established:
-            self.retry_association()
+            for part in request.get('_parts', [request]):
+                self.request_failed(part)
+            return
         
-        if self.association.is_established:
-            responses = self.association.send_c_find(identifier, self.query_model)
-            response_count = 0
-                    
-            for (status, rsp_identifier) in responses:
-                if status and status.Status in [0xFF00, 0xFF01]:
-                    # Status pending
-                    response_count += 1
-                    # Apply description filters if enabled
-                    should_save = True
-                    if 'description_filter' in self.config['request'] and self.config['request']['description_filter']['enabled']:
-                        should_save = False
-                        # Check study description filter
-                        if self.config['request']['description_filter']['study_description'] and 'StudyDescription' in rsp_identifier:
-                            study_desc = str(rsp_identifier.StudyDescription).upper()
-                            for filter_str in self.config['request']['description_filter']['study_description']:
-                                if filter_str.upper() in study_desc:
-                                    should_save = True
-                                    break
-                        
-                        # Check series description filter if at SERIES level
-                        if (not should_save and 
-                            self.config['request']['description_filter']['series_description'] and 
-                            'SeriesDescription' in rsp_identifier and
-                            'QueryRetrieveLevel' in rsp_identifier and
-                            rsp_identifier.QueryRetrieveLevel == 'SERIES'):
-                            series_desc = str(rsp_identifier.SeriesDescription).upper()
-                            for filter_str in self.config['request']['description_filter']['series_description']:
-                                if filter_str.upper() in series_desc:
-                                    should_save = True
-                                    break
-                    
-                    if should_save:
-                        path = os.path.join(self.config['output']['directory'], self.config['output']['database_file'])
-                        dataset_to_csv(rsp_identifier, path, keywords)
-                else:
-                    if self.pbar:
-                        with self.pbar_lock:  # Use lock when updating the progress bar
-                            self.pbar.update(1)
-                    # Status Success, Warning, Cancel, Failure
-                    if status.Status in [0x0000]:
-                        if response_count > 4500:
-                            study_date = next((elem.split('=')[1] for elem in request['elements'] if elem.startswith('StudyDate=')), None)
-                            print(f"\nWARNING: Large response count ({response_count}) for date range {study_date}. Consider using smaller date ranges (Limit is 5000).")
-                        filepath_requests_completed = os.path.join(self.config['output']['directory'], 'requests.completed')
-                        dict_to_csv(request, filepath_requests_completed, request.keys())
-                    else:
-                        filepath_requests_failed = os.path.join(self.config['output']['directory'], 'requests.failed')
-                        dict_to_csv(request, filepath_requests_failed, request.keys())
+        time_start = time.perf_counter()
+        responses = self.association.send_c_find(identifier, self.query_model)
+        response_count = 0
+        # Responses are kept until the request completes so that truncated results are not saved
+        saved_responses = []
                 
-                    
+        for (status, rsp_identifier) in responses:
+            if status and status.Status in [0xFF00, 0xFF01]:
+                # Status pending
+                response_count += 1
+                if self.should_save(rsp_identifier, request):
+                    saved_responses.append(rsp_identifier)
+            else:
+                # Status Success, Warning, Cancel, Failure
+                # An empty status means the association was aborted or timed out
+                self.find_completed(request, status, response_count, saved_responses, keywords,
+                    time.perf_counter() - time_start)
+
+    def should_save(self, rsp_identifier, request):
+        """
+        Return True if a C-FIND response passes the description filters (if enabled)
+        """
+        if not self.description_filter:
+            return True
+        return self.description_filter.keep(rsp_identifier, request)
+
+    def find_completed(self, request, status, response_count, saved_responses, keywords, latency):
+        """
+        Handle the final response of a C-FIND request: split the request if its results were truncated,
+        otherwise write the saved responses and mark the request as completed (or failed)
+        """
+        metrics.observe('pydicombatch_request_duration_seconds', latency, operation='c-find')
+        metrics.observe('pydicombatch_responses_per_request', response_count, COUNT_BUCKETS)
+        self.record_outcome(latency, bool(status) and status.Status in [0x0000])
+        if request.get('_coalesced') and self.coalescer.fallback and (self.is_refused(status) or (
+                status and status.Status in [0x0000] and not response_count)):
+            # The PACS rejected the UID list, or ignored it (no match at all)
+            self.fall_back(request)
+            return
+        if status and status.Status in [0x0000]:
+            if self.planner.is_capped(response_count):
+                self.split_request(request, response_count)
+                metrics.inc('pydicombatch_requests_total', operation='c-find', outcome='split')
+                return
+            if request.get('drill_down') == 'study':
+                self.drill_down(request, response_count, saved_responses)
+                metrics.inc('pydicombatch_requests_total', operation='c-find', outcome='split')
+                return
+            self.planner.record(request, response_count)
+            # The request is marked as completed once its results are written
+            parts = request.get('_parts', [request])
+            rows = [dataset_to_dict(rsp_identifier, keywords) for rsp_identifier in saved_responses]
+            self.sink.write(rows, functools.partial(self.parts_completed, parts, response_count),
+                functools.partial(self.parts_failed, parts))
+        else:
+            for part in request.get('_parts', [request]):
+                self.request_failed(part)
+
+    def delta_enabled(self):
+        delta = self.config['request'].get('delta') or {}
+        return (bool(delta.get('enabled')) and self.scp is not None
+            and (not self.scp.anonymization_enabled or self.scp.catalog is not None))
+
+    def find_children(self, identifier, level, keywords):
+        """
+        C-FIND the SERIES or IMAGE level children of a C-MOVE identifier. Returns None if the query failed.
+        """
+        query = Dataset()
+        for elem in identifier:
+            if elem.keyword in ['PatientID', 'StudyInstanceUID', 'SeriesInstanceUID']:
+                query.add(elem)
+        query.QueryRetrieveLevel = level
+        for keyword in keywords:
+            if keyword not in query:
+                setattr(query, keyword, '')
+
+        results = []
+        for (status, rsp_identifier) in self.association.send_c_find(query, FIND_MODELS[self.query_model]):
+            if status and status.Status in [0xFF00, 0xFF01]:
+                results.append(rsp_identifier)
+            elif status and status.Status in [0x0000]:
+                return results
+            else:
+                return None
+        return None
+
+    def plan_delta(self, identifier):
+        """
+        List the instances of a C-MOVE request with C-FIND and return (expected instance count, C-MOVE
+        identifiers) for the instances that are not in the output yet: whole series when none of their
+        instances are stored, the missing instances otherwise (or the whole series if delta.level is series).
+        Returns None if the instances could not be listed.
+        """
+        delta = self.config['request'].get('delta') or {}
+        # Elements needed to compute the path of an instance in the output
+        layout = [ElementPath(x).keyword for x in self.config['output']['directory_structure'].split('/') if x]
+        layout.append(ElementPath(self.config['output']['filename']).keyword)
+        image_keywords = ['StudyInstanceUID', 'SeriesInstanceUID', 'SOPInstanceUID'] + layout
+
+        level = identifier.QueryRetrieveLevel if 'QueryRetrieveLevel' in identifier else 'STUDY'
+        if level == 'IMAGE':
+            return None
+        if level == 'SERIES':
+            series_list = [identifier]
+        else:
+            series_list = self.find_children(identifier, 'SERIES', ['StudyInstanceUID', 'SeriesInstanceUID'])
+            if series_list is None:
+                return None
+
+        expected = 0
+        identifiers = []
+        for series in series_list:
+            series_identifier = Dataset()
+            if 'PatientID' in identifier:
+                series_identifier.PatientID = identifier.PatientID
+            series_identifier.StudyInstanceUID = series.StudyInstanceUID
+            series_identifier.SeriesInstanceUID = series.SeriesInstanceUID
+            instances = self.find_children(series_identifier, 'IMAGE', image_keywords)
+            if instances is None:
+                return None
+            missing = [ds.SOPInstanceUID for ds in instances if not self.scp.is_stored(ds)]
+            if not missing:
+                continue
+            expected += len(missing) if delta.get('level', 'instance') == 'instance' else len(instances)
+            if len(missing) == len(instances) or delta.get('level', 'instance') == 'series':
+                series_identifier.QueryRetrieveLevel = 'SERIES'
+            else:
+                series_identifier.QueryRetrieveLevel = 'IMAGE'
+                series_identifier.SOPInstanceUID = missing
+            identifiers.append(series_identifier)
+        return expected, identifiers
+
+    def move(self, identifier):
+        """
+        Send a C-MOVE (or C-GET) request and return its final status and number of completed sub-operations
+        """
+        operation = self.config['request']['type'].lower()
+        time_start = time.perf_counter()
+        if operation == 'c-get':
+            responses = self.association.send_c_get(identifier, self.query_model)
+        else:
+            responses = self.association.send_c_move(identifier, self.config['local']['aet'], self.query_model)
+        for (status, rsp_identifier) in responses:
+            if status and status.Status in [0xFF00]:
+                # Status pending
+                continue
+            # Status Success, Warning, Cancel, Failure
+            # An empty status means the association was aborted or timed out
+            latency = time.perf_counter() - time_start
+            metrics.observe('pydicombatch_request_duration_seconds', latency, operation=operation)
+            completed = None
+            if status and 'NumberOfCompletedSuboperations' in status:
+                completed = status.NumberOfCompletedSuboperations
+                metrics.observe('pydicombatch_instances_per_request', completed, COUNT_BUCKETS)
+            # The latency of a C-MOVE / C-GET is compared per retrieved instance
+            # Failed sub-operations (warning status) are not a sign of an overloaded PACS
+            self.record_outcome(latency / completed if completed else None,
+                bool(status) and status.Status in [0x0000, 0xB000])
+            return status, completed
+        return None, None
 
     def send_move(self, request):
         
@@ -473,38 +846,58 @@ class SCU(object):
         keywords = [ElementPath(path).keyword for path in request['elements']]
 
         if not self.association.is_established:
-            self.retry_association()
+            for part in request.get('_parts', [request]):
+                self.request_failed(part)
+            return
         
-        if self.association.is_established:
-            responses = self.association.send_c_move(identifier, self.config['local']['aet'], self.query_model)
-            # print(self.config)
-            # print(self.query_model)
-            try:
-                for (status, rsp_identifier) in responses:
-                    # print(status)
-                    # print(rsp_identifier)
-                    if status and status.Status in [0xFF00]:
-                        # Status pending
-                        pass
-                    else:
-                        # Status Success, Warning, Cancel, Failure
-                        if self.pbar:
-                            with self.pbar_lock:  # Use lock when updating the progress bar
-                                self.pbar.update(1)
-                        identifier.Status = hex(status.Status)
-                        keywords.append('Status')
-                        path = os.path.join(self.config['output']['directory'], self.config['output']['database_file'])
-                        dataset_to_csv(identifier, path, keywords)
-
-                        if status.Status in [0x0000]:
-                            filepath_requests_completed = os.path.join(self.config['output']['directory'], 'requests.completed')
-                            dict_to_csv(request, filepath_requests_completed, request.keys())
-                        else:
-                            filepath_requests_failed = os.path.join(self.config['output']['directory'], 'requests.failed')
-                            dict_to_csv(request, filepath_requests_failed, request.keys())
-            except Exception as e:
-                print(f"Error processing C-MOVE: {str(e)}")
-
-
-
+        if self.scp:
+            # Do not issue more C-MOVE requests while the local SCP post-processing is backlogged
+            self.scp.wait_for_capacity()
+            self.update_postfix()
+
+        try:
+            # Only retrieve the instances that are not stored yet (e.g. by an interrupted extraction)
+            plan = self.plan_delta(identifier) if self.delta_enabled() else None
+            if plan is None:
+                status, received = self.move(identifier)
+            else:
+                expected, identifiers = plan
+                received = 0
+                status = Dataset()
+                status.Status = 0x0000
+                for move_identifier in identifiers:
+                    status, completed = self.move(move_identifier)
+                    received += completed or 0
+                    if not status or status.Status not in [0x0000]:
+                        break
+
+            # A partial transfer is failed even if the PACS reported success
+            success = status and status.Status in [0x0000] and (plan is None or received >= plan[0])
+            if request.get('_coalesced') and self.coalescer.fallback and (self.is_refused(status, received) or (
+                    plan is None and status and status.Status in [0x0000] and not received)):
+                # The PACS rejected the UID list, or ignored it (nothing matched). Other failures, e.g. failed
+                # sub-operations (warning status), fail the requests of the group through the normal path.
+                self.fall_back(request)
+                return
 
+            keywords.append('Status')
+            parts = request.get('_parts', [request])
+            rows = []
+            # One row per request of a coalesced request
+            for part in (parts if request.get('_coalesced') else [request]):
+                part_identifier = create_dataset(part) if part is not request else identifier
+                part_identifier.Status = hex(status.Status) if status else ''
+                rows.append(dataset_to_dict(part_identifier, keywords))
+            # Empty when unknown: without delta retrieval, or for the rows of a coalesced request
+            for row in rows:
+                row['ExpectedInstances'] = str(expected) if plan is not None and len(rows) == 1 else ''
+                row['ReceivedInstances'] = str(received) if received is not None and len(rows) == 1 else ''
+
+            if success:
+                self.sink.write(rows, functools.partial(self.parts_completed, parts, received),
+                    functools.partial(self.parts_failed, parts))
+            else:
+                self.sink.write(rows, functools.partial(self.parts_failed, parts),
+                    functools.partial(self.parts_failed, parts))
+        except Exception as e:
+            print(f"Error processing {request['type'].upper()}: {str(e)}")
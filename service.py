@@ -0,0 +1,480 @@
+import os
+import copy
+import json
+import time
+import signal
+import itertools
+import threading
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import yaml
+from pynetdicom import evt
+
+from common import merge_configs
+from scu import load_requests, run_threads, create_ae, RESUME_MODES, REQUEST_BATCH_SIZE
+from scp import SCP, create_ae as create_storage_ae
+from pool import AssociationPool
+from scheduler import RequestQueue
+from journal import Journal, PENDING, RUNNING, COMPLETED, FAILED, SPLIT, CANCELLED
+from metrics import metrics
+
+# Operations of the jobs accepted by the service
+JOB_OPERATIONS = ['c-find', 'c-move']
+# Settings of its operation section that a job may set, the others (including anonymization) are those of the
+#   operation section of the service config. output only takes a directory, inside service.output_root.
+JOB_SETTINGS = ['elements', 'elements_batch_file', 'output']
+# Job states, besides running, completed, failed and cancelled
+QUEUED = 'queued'
+REQUEST_STATES = [PENDING, RUNNING, COMPLETED, FAILED, SPLIT, CANCELLED]
+
+
+class JobConflictError(Exception):
+    """Raised when a job is submitted for the output directory of a job that is queued or running"""
+
+
+def sigterm_handler(signal, frame):
+    raise KeyboardInterrupt
+
+
+class Job(object):
+    """ Job class
+    C-FIND / C-MOVE extraction submitted to the service, with the merged config of its payload
+    """
+
+    def __init__(self, id, operation, config, mode):
+        self.id = id
+        self.operation = operation
+        self.config = config
+        self.mode = mode
+        self.state = QUEUED
+        self.error = None
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.cancelled = False
+        self.journal = None
+        self.queue = None
+        # Request counts by state, once the job is finished
+        self.requests = {}
+        self.lock = threading.Lock()
+
+    def cancel(self):
+        """
+        Stop handing out requests. Requests being processed are completed, the others stay pending in the
+        journal and are processed by a job submitted later with mode resume.
+        """
+        with self.lock:
+            self.cancelled = True
+            if self.queue:
+                self.queue.close()
+
+    def request_counts(self):
+        with self.lock:
+            if self.journal:
+                return {state: self.journal.count(state) for state in REQUEST_STATES}
+            return dict(self.requests)
+
+    def status(self):
+        return {
+            'id': self.id,
+            'operation': self.operation,
+            'mode': self.mode,
+            'state': self.state,
+            'directory': self.config['output']['directory'],
+            'submitted_at': self.submitted_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'requests': self.request_counts(),
+            'error': self.error,
+        }
+
+
+class StorageListener(object):
+    """ StorageListener class
+    Storage SCP listening on local.port for as long as the service runs. C-STORE requests are handed to the
+    SCP of the C-MOVE job being run, instances received while no C-MOVE job is running are refused.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.target = None
+        self.server = None
+
+    def start(self):
+        print('Starting local storage SCP server on port {}'.format(self.config['local']['port']))
+        handlers = [(evt.EVT_C_STORE, self.handle_store), (evt.EVT_C_ECHO, self.handle_echo)]
+        self.server = create_storage_ae(self.config).start_server(('', self.config['local']['port']),
+            block=False, evt_handlers=handlers)
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server = None
+
+    @property
+    def temp_dir(self):
+        # Data sets streamed to disk are spooled to the temporary directory of the running job (see scp.spooled_file)
+        target = self.target
+        return target.temp_dir if target else None
+
+    @property
+    def stream_to_disk(self):
+        # Only the associations of a job streaming to disk write their data sets to disk (see scp.StreamToDiskConfig)
+        target = self.target
+        return target.stream_to_disk if target else False
+
+    def handle_echo(self, event):
+        return 0x0000
+
+    def handle_store(self, event):
+        target = self.target
+        if target is None:
+            # Failed - Out of Resources, no C-MOVE job is running
+            return 0xA700
+        return target.handle_store(event)
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """ UnixHTTPServer class
+    HTTP server listening on a UNIX socket, so that access to the job API is controlled by file permissions
+    """
+    daemon_threads = True
+
+
+class JobService(object):
+    """ JobService class
+    Long-running extraction service: the association pool with the PACS and the storage SCP are kept open
+    between jobs, and C-FIND / C-MOVE jobs (YAML payloads with the elements and output directory of an
+    operation section of the config file) are submitted through a local HTTP API, on a UNIX socket (by
+    default) or on a TCP port of service.host. At most service.max_jobs jobs are run at a time and pool.max_associations is a limit for all of them. C-MOVE jobs share the
+    storage SCP and are run one at a time, C-FIND jobs are run alongside them.
+    Nothing is prompted: a previous extraction in the output directory of a job is handled according to the
+    mode of the job (see scu.load_requests).
+    """
+
+    def __init__(self, config):
+        self.config = config
+        service = config['common'].get('service') or {}
+        # The job API is served on a UNIX socket, readable by the owner only, unless a TCP port is configured
+        self.host = service.get('host', '127.0.0.1')
+        self.port = int(service.get('port') or 0)
+        self.socket = service.get('socket') or (None if self.port else 'pydicombatch.sock')
+        # Output directories of the jobs are created inside this directory
+        self.output_root = os.path.realpath(service.get('output_root', 'jobs'))
+        self.max_jobs = int(service.get('max_jobs', 2))
+        self.default_mode = service.get('mode', 'resume')
+        if self.default_mode not in RESUME_MODES:
+            raise ValueError('Unknown job mode: {}'.format(self.default_mode))
+        # Settings shared by all the jobs. C-FIND and C-MOVE requests use the same presentation contexts.
+        shared = {
+            'pacs': config['common']['pacs'],
+            'local': config['common']['local'],
+            'pool': config['common'].get('pool') or {},
+            'metrics': config['common'].get('metrics') or {},
+            # pool.max_associations defaults to 8
+            'request': {'type': 'c-move', 'threads': 8},
+        }
+        self.shared_config = shared
+        self.pool = AssociationPool(create_ae(shared), shared)
+        self.listener = StorageListener(shared)
+        self.jobs = {}
+        self.queued = []
+        # C-MOVE job using the storage SCP
+        self.storing = None
+        self.stopping = False
+        self.ids = itertools.count(1)
+        self.condition = threading.Condition()
+        self.runners = []
+        metrics.gauge('pydicombatch_jobs_queued', lambda : len(self.queued))
+
+    def submit(self, payload):
+        """
+        Queue a job and return it. payload is a YAML document with an operation (c-find or c-move, by
+        default the single operation section of the payload), a mode (new, resume or retry) and an operation
+        section with the settings of JOB_SETTINGS. The other settings are those of the service config.
+        """
+        job_config = yaml.safe_load(payload) or {}
+        if not isinstance(job_config, dict):
+            raise ValueError('The job payload must be a mapping')
+        operation = job_config.pop('operation', None)
+        sections = [x for x in JOB_OPERATIONS if x in job_config]
+        if operation is None and len(sections) == 1:
+            operation = sections[0]
+        if operation not in JOB_OPERATIONS:
+            raise ValueError('The job operation must be one of: {}'.format(', '.join(JOB_OPERATIONS)))
+        mode = job_config.pop('mode', self.default_mode)
+        if mode not in RESUME_MODES:
+            raise ValueError('The job mode must be one of: {}'.format(', '.join(RESUME_MODES)))
+        for key in job_config:
+            if key != operation:
+                raise ValueError('{} is a setting of the service'.format(key))
+        settings = job_config.get(operation) or {}
+        if not isinstance(settings, dict):
+            raise ValueError('The {} section of the job payload must be a mapping'.format(operation))
+        for key in settings:
+            if key not in JOB_SETTINGS:
+                raise ValueError('{}.{} is a setting of the service'.format(operation, key))
+        output = settings.get('output') or {}
+        for key in output:
+            if key != 'directory':
+                raise ValueError('{}.output.{} is a setting of the service'.format(operation, key))
+        if not output.get('directory'):
+            raise ValueError('Missing setting in the job payload: {}.output.directory'.format(operation))
+        directory = self.job_directory(output['directory'])
+
+        config = copy.deepcopy(self.config)
+        if operation not in config:
+            raise ValueError('No {} section in the service config'.format(operation))
+        section = config[operation]
+        if 'elements' in settings or 'elements_batch_file' in settings:
+            # The elements of the job replace those of the service, with or without a batch file
+            section.pop('elements_batch_file', None)
+            if 'elements' in settings:
+                section['elements'] = settings['elements']
+            if 'elements_batch_file' in settings:
+                section['elements_batch_file'] = self.job_batch_file(settings['elements_batch_file'])
+        section['output'] = dict(section.get('output') or {}, directory=directory)
+        try:
+            config = merge_configs(config, operation)
+        except KeyError as exc:
+            raise ValueError('Missing setting in the service config: {}'.format(exc))
+
+        with self.condition:
+            if self.stopping:
+                raise JobConflictError('The service is stopping')
+            for other in self.jobs.values():
+                if other.state in [QUEUED, RUNNING] and other.config['output']['directory'] == directory:
+                    raise JobConflictError('Job {} uses the output directory {}'.format(other.id, directory))
+            job = Job(str(next(self.ids)), operation, config, mode)
+            self.jobs[job.id] = job
+            self.queued.append(job)
+            self.condition.notify_all()
+        print('Job {} queued: {} extraction in {}'.format(job.id, operation, directory))
+        return job
+
+    def job_path(self, path, description):
+        """
+        Return a path of a job, relative to service.output_root. Paths outside of output_root (absolute
+        paths, .. or symbolic links) are refused.
+        """
+        path = os.path.realpath(os.path.join(self.output_root, str(path)))
+        if path == self.output_root or os.path.commonpath([path, self.output_root]) != self.output_root:
+            raise ValueError('The {} of a job must be inside {}'.format(description, self.output_root))
+        return path
+
+    def job_directory(self, directory):
+        return self.job_path(directory, 'output directory')
+
+    def job_batch_file(self, batch_file):
+        # The batch file is read by the service: a job cannot read files outside of output_root
+        return self.job_path(batch_file, 'elements_batch_file')
+
+    def cancel(self, job):
+        with self.condition:
+            if job.state == QUEUED:
+                self.queued.remove(job)
+                self.finish(job, CANCELLED)
+        job.cancel()
+
+    def finish(self, job, state):
+        job.state = state
+        job.finished_at = time.time()
+        metrics.inc('pydicombatch_jobs_total', operation=job.operation, state=state)
+        print('Job {} {}'.format(job.id, state))
+
+    def next_job(self):
+        """
+        Return the next queued job that can be run, waiting for one. C-MOVE jobs wait for the storage SCP.
+        Returns None once the service is stopping.
+        """
+        with self.condition:
+            while not self.stopping:
+                for job in self.queued:
+                    if job.operation != 'c-move' or self.storing is None:
+                        self.queued.remove(job)
+                        if job.operation == 'c-move':
+                            self.storing = job
+                        job.state = RUNNING
+                        job.started_at = time.time()
+                        return job
+                self.condition.wait()
+            return None
+
+    def work(self):
+        while True:
+            job = self.next_job()
+            if job is None:
+                return
+            try:
+                self.run(job)
+            finally:
+                with self.condition:
+                    if self.storing is job:
+                        self.storing = None
+                    self.condition.notify_all()
+
+    def run(self, job):
+        journal = Journal(job.config['output']['directory'])
+        with job.lock:
+            job.journal = journal
+        try:
+            self.extract(job, journal)
+            state = CANCELLED if job.cancelled else COMPLETED
+        except Exception as exc:
+            print('\nJob {} failed: {}'.format(job.id, exc))
+            job.error = str(exc)
+            state = FAILED
+        with job.lock:
+            job.requests = {state: journal.count(state) for state in REQUEST_STATES}
+            job.journal = None
+        journal.close()
+        self.finish(job, state)
+
+    def extract(self, job, journal):
+        config = job.config
+        requests = load_requests(config, journal, job.mode)
+        scp = None
+        if job.operation == 'c-move':
+            scp = SCP(config, interactive=False)
+            scp.start_server(listen=False)
+            self.listener.target = scp
+        try:
+            queue = RequestQueue(config)
+            with job.lock:
+                job.queue = queue
+                if job.cancelled:
+                    queue.close()
+            queue.feed(requests, REQUEST_BATCH_SIZE)
+            run_threads(config, journal, queue, scp, pool=self.pool)
+        finally:
+            if scp:
+                # Wait for the received files to be post-processed and written
+                scp.stop_server()
+                self.listener.target = None
+
+    def start(self):
+        metrics.start(self.shared_config)
+        self.listener.start()
+        for i in range(self.max_jobs):
+            runner = threading.Thread(target=self.work, daemon=True)
+            runner.start()
+            self.runners.append(runner)
+
+    def stop(self):
+        """
+        Cancel the queued jobs and stop the running jobs once their requests being processed are done
+        """
+        with self.condition:
+            self.stopping = True
+            for job in self.queued:
+                self.finish(job, CANCELLED)
+            self.queued = []
+            running = [job for job in self.jobs.values() if job.state == RUNNING]
+            self.condition.notify_all()
+        for job in running:
+            job.cancel()
+        for runner in self.runners:
+            runner.join()
+        self.listener.stop()
+        self.pool.close()
+        metrics.stop()
+
+    def create_server(self):
+        """
+        Return the HTTP server of the job API:
+            POST /jobs (YAML payload), GET /jobs, GET /jobs/<id> and DELETE /jobs/<id> (cancel)
+        """
+        service = self
+
+        class JobHandler(BaseHTTPRequestHandler):
+            def send_json(self, status, body):
+                body = json.dumps(body, indent=2).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def find_job(self):
+                path = self.path.rstrip('/')
+                if not path.startswith('/jobs/'):
+                    return None
+                return service.jobs.get(path[len('/jobs/'):])
+
+            def do_GET(self):
+                if self.path.rstrip('/') == '/jobs':
+                    self.send_json(200, [job.status() for job in list(service.jobs.values())])
+                    return
+                job = self.find_job()
+                if job is None:
+                    self.send_error(404)
+                    return
+                self.send_json(200, job.status())
+
+            def do_POST(self):
+                if self.path.rstrip('/') != '/jobs':
+                    self.send_error(404)
+                    return
+                payload = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+                try:
+                    job = service.submit(payload)
+                except JobConflictError as exc:
+                    self.send_json(409, {'error': str(exc)})
+                    return
+                except (ValueError, yaml.YAMLError) as exc:
+                    self.send_json(400, {'error': str(exc)})
+                    return
+                self.send_json(201, job.status())
+
+            def do_DELETE(self):
+                job = self.find_job()
+                if job is None:
+                    self.send_error(404)
+                    return
+                service.cancel(job)
+                self.send_json(200, job.status())
+
+            def log_message(self, format, *args):
+                pass
+
+        if self.socket:
+            # Left over by a service that did not stop cleanly
+            if os.path.exists(self.socket):
+                os.unlink(self.socket)
+            # The socket is only accessible to the user of the service from its creation
+            umask = os.umask(0o177)
+            try:
+                server = UnixHTTPServer(self.socket, JobHandler)
+            finally:
+                os.umask(umask)
+            print('Serving the job API on {}'.format(self.socket))
+        else:
+            server = ThreadingHTTPServer((self.host, self.port), JobHandler)
+            print('Serving the job API on http://{}:{}/jobs'.format(self.host, self.port))
+        return server
+
+    def serve(self):
+        """
+        Run the service until it is interrupted (CTRL-C or SIGTERM)
+        """
+        signal.signal(signal.SIGTERM, sigterm_handler)
+        self.start()
+        server = self.create_server()
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            print('\b\b\r')
+            print('\nStopping the service. Interrupted jobs can be resumed by submitting them again.')
+        finally:
+            server.server_close()
+            if self.socket and os.path.exists(self.socket):
+                os.unlink(self.socket)
+            self.stop()
+
+
+def serve(config_file):
+    with open(config_file) as file:
+        config = yaml.load(file, Loader=yaml.FullLoader)
+    print('Running the extraction service defined in: {}'.format(config_file))
+    JobService(config).serve()
@@ -0,0 +1,212 @@
+import os
+import csv
+import time
+from queue import Queue, Empty
+from threading import Thread
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+
+def dataset_to_dict(ds, fieldnames):
+    return {key: str(ds[key].value) for key in fieldnames}
+
+
+def row_fields(rows):
+    return sorted(set().union(*rows))
+
+
+class CsvBackend(object):
+    """ CsvBackend class
+    Appends rows to a CSV file that is kept open. The header of an existing file is reused, and extended
+    with the fields of new rows that are not in it (e.g. a resumed extraction with new columns).
+    """
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.file = None
+        self.writer = None
+
+    def open(self, fieldnames):
+        self.file = open(self.filepath, 'a', newline='')
+        self.writer = csv.DictWriter(self.file, fieldnames=fieldnames, dialect='excel')
+
+    def extend_header(self, fieldnames):
+        """
+        Rewrite the file with columns added at the end of the header. The rows already written get empty
+        values for the new columns.
+        """
+        temp_path = self.filepath + '.tmp'
+        with open(self.filepath, 'r', newline='') as src, open(temp_path, 'w', newline='') as dst:
+            reader = csv.reader(src, dialect='excel')
+            writer = csv.writer(dst, dialect='excel')
+            next(reader, None)
+            writer.writerow(fieldnames)
+            for row in reader:
+                writer.writerow(row + [''] * (len(fieldnames) - len(row)))
+        os.replace(temp_path, self.filepath)
+
+    def write(self, rows):
+        fields = row_fields(rows)
+        if self.writer is None:
+            fieldnames = None
+            if os.path.exists(self.filepath) and os.path.getsize(self.filepath):
+                with open(self.filepath, 'r', newline='') as csvfile:
+                    fieldnames = next(csv.reader(csvfile), None)
+            if not fieldnames:
+                self.open(fields)
+                self.writer.writeheader()
+            else:
+                self.open(fieldnames)
+        missing = [field for field in fields if field not in self.writer.fieldnames]
+        if missing:
+            fieldnames = self.writer.fieldnames + missing
+            self.file.close()
+            self.extend_header(fieldnames)
+            self.open(fieldnames)
+        self.writer.writerows(rows)
+        self.file.flush()
+
+    def close(self):
+        if self.file:
+            self.file.close()
+
+
+class ArrowBackend(object):
+    """ ArrowBackend class
+    Writes rows as string columns to a Parquet file or an Arrow IPC file. These formats cannot be
+    appended to, so an existing file (e.g. from a resumed extraction) is kept and the rows are written
+    to a new file next to it. Rows with fields that are not in the schema of the file are also written
+    to a new file, with the fields of both.
+    """
+
+    def __init__(self, filepath, format):
+        if pa is None:
+            raise ImportError('pyarrow is required to write the database in {} format'.format(format))
+        self.format = format
+        self.stem, self.ext = os.path.splitext(filepath)
+        self.filepath = filepath
+        if os.path.exists(filepath):
+            self.filepath = self.new_path()
+        self.schema = None
+        self.writer = None
+
+    def new_path(self):
+        stem = '{}-{}'.format(self.stem, time.strftime('%Y%m%d%H%M%S'))
+        filepath = stem + self.ext
+        for i in range(1, 1000):
+            if not os.path.exists(filepath):
+                break
+            filepath = '{}-{}{}'.format(stem, i, self.ext)
+        return filepath
+
+    def write(self, rows):
+        fields = row_fields(rows)
+        if self.writer is not None and any(field not in self.schema.names for field in fields):
+            fields = sorted(set(fields) | set(self.schema.names))
+            self.writer.close()
+            self.writer = None
+            self.filepath = self.new_path()
+        if self.writer is None:
+            self.schema = pa.schema([(key, pa.string()) for key in fields])
+            if self.format == 'parquet':
+                self.writer = pq.ParquetWriter(self.filepath, self.schema)
+            else:
+                self.writer = pa.ipc.new_file(self.filepath, self.schema)
+        columns = {name: [row.get(name) for row in rows] for name in self.schema.names}
+        batch = pa.RecordBatch.from_pydict(columns, schema=self.schema)
+        if self.format == 'parquet':
+            self.writer.write_batch(batch)
+        else:
+            self.writer.write(batch)
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
+
+
+class ResultWriter(object):
+    """ ResultWriter class
+    Single writer thread for the C-FIND / C-MOVE result database. Rows are queued by the SCU workers,
+    buffered and written in batches once batch_size rows are pending or flush_interval seconds have
+    passed. A callback given with the rows is called once they are written, e.g. to mark the request
+    as completed in the journal, and errback if they could not be written, e.g. to mark it as failed.
+    """
+
+    def __init__(self, filepath, format='csv', batch_size=1000, flush_interval=1.0):
+        self.filepath = filepath
+        self.format = format.lower()
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        if self.format == 'csv':
+            self.backend = CsvBackend(filepath)
+        elif self.format in ['parquet', 'arrow']:
+            self.backend = ArrowBackend(filepath, self.format)
+        else:
+            raise ValueError('Unknown database format: {}'.format(format))
+        self.queue = Queue()
+        self.rows = []
+        self.callbacks = []
+        self.error = None
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    @classmethod
+    def from_config(cls, config):
+        output = config['output']
+        return cls(os.path.join(output['directory'], output['database_file']),
+            format=output.get('database_format', 'csv'),
+            batch_size=int(output.get('database_batch_size', 1000)),
+            flush_interval=float(output.get('database_flush_interval', 1.0)))
+
+    def write(self, rows, callback=None, errback=None):
+        self.queue.put((rows, callback, errback))
+
+    def flush(self):
+        failed = False
+        if self.rows:
+            try:
+                self.backend.write(self.rows)
+            except Exception as exc:
+                # Rows that cannot be written must not be reported as completed
+                self.error = exc
+                failed = True
+                print('\nError writing results to {}: {}'.format(self.filepath, exc))
+        for callback, errback in self.callbacks:
+            if failed and errback:
+                errback()
+            elif not failed and callback:
+                callback()
+        self.rows = []
+        self.callbacks = []
+
+    def run(self):
+        last_flush = time.time()
+        stop = False
+        while not stop:
+            try:
+                item = self.queue.get(timeout=self.flush_interval)
+                if item is None:
+                    stop = True
+                else:
+                    rows, callback, errback = item
+                    self.rows.extend(rows)
+                    if callback or errback:
+                        self.callbacks.append((callback, errback))
+            except Empty:
+                pass
+            if stop or len(self.rows) >= self.batch_size or time.time() - last_flush >= self.flush_interval:
+                self.flush()
+                last_flush = time.time()
+        self.backend.close()
+
+    def close(self):
+        """
+        Write all pending rows and stop the writer thread
+        """
+        self.queue.put(None)
+        self.thread.join()
@@ -0,0 +1,40 @@
+import os
+import sys
+import socket
+
+import pytest
+
+# The modules of the project are at the top level of the repository
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture
+def free_port():
+    """
+    Return a function returning a TCP port that is free on the loopback interface
+    """
+    def port():
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            return s.getsockname()[1]
+    return port
+
+
+@pytest.fixture
+def mock_pacs(free_port):
+    """
+    Return a function starting a mock PACS (benchmarks/mock_pacs.py) in this process, stopped after the test
+    """
+    sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+    from mock_pacs import MockPACS
+    servers = []
+
+    def start(config=None):
+        pacs = MockPACS({'port': free_port(), **(config or {})})
+        pacs.start()
+        servers.append(pacs)
+        return pacs
+    yield start
+    for pacs in servers:
+        pacs.stop()
@@ -0,0 +1,126 @@
+import os
+import shutil
+import datetime
+import subprocess
+
+import pytest
+from pydicom import dcmread
+from pydicom.data import get_testdata_file
+
+from anonymizer import Anonymizer, hash_uid, hash_string, md5_decimal
+
+TOOL_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'DicomAnonymizerTool')
+SCRIPT = os.path.join(TOOL_DIR, 'dicom-anonymizer.script')
+LOOKUP_TABLE = os.path.join(TOOL_DIR, 'lookup-table.properties')
+# UIDROOT of the shipped script
+UID_ROOT = '9999'
+
+
+@pytest.fixture(scope='module')
+def anonymizer():
+    return Anonymizer(SCRIPT, LOOKUP_TABLE)
+
+
+@pytest.mark.parametrize('filename', ['CT_small.dcm', 'MR_small.dcm'])
+def test_uids_are_hashed(anonymizer, filename):
+    original = dcmread(get_testdata_file(filename))
+    ds = anonymizer.anonymize(dcmread(get_testdata_file(filename)))
+    for keyword in ['SOPInstanceUID', 'StudyInstanceUID', 'SeriesInstanceUID']:
+        uid = str(getattr(ds, keyword))
+        assert uid == hash_uid(UID_ROOT, str(getattr(original, keyword)))
+        assert uid.startswith(UID_ROOT + '.')
+        assert len(uid) <= 64
+    assert ds.file_meta.MediaStorageSOPInstanceUID == ds.SOPInstanceUID
+    # Class UIDs are kept
+    assert ds.SOPClassUID == original.SOPClassUID
+
+
+def test_uids_are_hashed_consistently(anonymizer):
+    first = anonymizer.anonymize(dcmread(get_testdata_file('CT_small.dcm')))
+    second = Anonymizer(SCRIPT, LOOKUP_TABLE).anonymize(dcmread(get_testdata_file('CT_small.dcm')))
+    assert first.StudyInstanceUID == second.StudyInstanceUID
+    assert first.SOPInstanceUID == second.SOPInstanceUID
+
+
+@pytest.mark.parametrize('filename', ['CT_small.dcm', 'MR_small.dcm'])
+def test_patient_identity_is_removed(anonymizer, filename):
+    original = dcmread(get_testdata_file(filename))
+    ds = anonymizer.anonymize(dcmread(get_testdata_file(filename)))
+    assert str(ds.PatientID) == hash_string(str(original.PatientID), 10)
+    assert str(ds.PatientName) == hash_string(str(original.PatientID), 10)
+    assert str(original.PatientID) not in str(ds.PatientID)
+    assert str(original.PatientName) != str(ds.PatientName)
+    assert ds.PatientIdentityRemoved == 'YES'
+    assert 'DeidentificationMethod' in ds
+
+
+def test_private_groups_are_removed(anonymizer):
+    original = dcmread(get_testdata_file('CT_small.dcm'))
+    assert any(elem.tag.is_private for elem in original)
+    ds = anonymizer.anonymize(dcmread(get_testdata_file('CT_small.dcm')))
+    assert not any(elem.tag.is_private for elem in ds)
+
+
+def test_anonymized_dataset_can_be_written(anonymizer, tmp_path):
+    ds = anonymizer.anonymize(dcmread(get_testdata_file('CT_small.dcm')))
+    ds.save_as(str(tmp_path / 'anonymized.dcm'), write_like_original=False)
+    written = dcmread(str(tmp_path / 'anonymized.dcm'))
+    assert written.PatientIdentityRemoved == 'YES'
+    assert written.SOPInstanceUID == ds.SOPInstanceUID
+
+
+def test_dates_are_offset_by_the_hash_of_the_patient_id(anonymizer):
+    original = dcmread(get_testdata_file('CT_small.dcm'))
+    ds = anonymizer.anonymize(dcmread(get_testdata_file('CT_small.dcm')))
+    # DAT.jar: last 4 digits of the hash of PatientID, modulo 10 years of 365 days
+    offset = int(md5_decimal(str(original.PatientID))[-4:]) % 3650
+    expected = datetime.datetime.strptime(original.StudyDate, '%Y%m%d') - datetime.timedelta(days=offset)
+    assert ds.StudyDate == expected.strftime('%Y%m%d')
+
+
+# Parity with DAT.jar: one script per supported function (and the shipped script), applied by both engines
+#   to the same files. @date and @time are not compared as they depend on the time of the run.
+PARITY_SCRIPTS = {
+    'shipped': None,
+    'keep_remove_empty': ['00100010:@keep()', '00100020:@remove()', '00100030:@empty()'],
+    'require_always_append': ['00100040:@require()', '00120062:@always()YES', '00120063:@append(){DAT}'],
+    'param_if': ['00100010:@param(@SITENAME)', '00100020:@if(this,exists){@empty()}{@remove()}'],
+    'hash': ['00080050:@hash(this,16)', '00100020:@hash(this)'],
+    'hashuid': ['00080018:@hashuid(@UIDROOT,this)', '0020000d:@hashuid(@UIDROOT,this)'],
+    'hashname_hashptid': ['00100010:@hashname(this,6,2)', '00100020:@hashptid(@SITEID,PatientID)'],
+    'hashdate_incrementdate': ['00080020:@hashdate(this,PatientID)', '00100030:@incrementdate(this,@DATEINC)'],
+    'initials_contents': ['00100010:@initials(this)', '00081030:@contents(this)'],
+    'lookup': ['00100020:@lookup(this,ptid,keep)'],
+}
+
+
+def write_script(path, lines):
+    with open(SCRIPT, encoding='utf-8') as f:
+        params = [line for line in f if line.strip().startswith('<p ')]
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('<script>\n' + ''.join(params))
+        for line in lines:
+            tag, _, script = line.partition(':')
+            f.write(' <e en="T" t="{}">{}</e>\n'.format(tag, script.replace('&', '&amp;').replace('<', '&lt;')))
+        f.write('</script>\n')
+
+
+def comparable(ds):
+    return {elem.tag: (elem.VR, elem.value) for elem in ds if elem.VR != 'SQ' and not elem.tag.is_private}
+
+
+@pytest.mark.skipif(shutil.which('java') is None or not os.path.isfile(os.path.join(TOOL_DIR, 'DAT.jar')),
+    reason='java and DAT.jar are required for the parity tests')
+@pytest.mark.parametrize('name', list(PARITY_SCRIPTS))
+@pytest.mark.parametrize('filename', ['CT_small.dcm', 'MR_small.dcm', 'JPEG2000.dcm'])
+def test_output_matches_dat_jar(tmp_path, name, filename):
+    script = SCRIPT
+    if PARITY_SCRIPTS[name]:
+        script = str(tmp_path / 'parity.script')
+        write_script(script, PARITY_SCRIPTS[name])
+    java_file = str(tmp_path / 'java.dcm')
+    shutil.copy(get_testdata_file(filename), java_file)
+    subprocess.run(['java', '-jar', 'DAT.jar', '-da', script, '-lut', LOOKUP_TABLE, '-in', java_file,
+        '-out', java_file], cwd=TOOL_DIR, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    python = Anonymizer(script, LOOKUP_TABLE).anonymize(dcmread(get_testdata_file(filename)))
+    assert comparable(python) == comparable(dcmread(java_file))
@@ -0,0 +1,132 @@
+import os
+import csv
+import time
+import sqlite3
+import multiprocessing
+
+import pytest
+
+from common import merge_configs
+from coordinator import worker_config, coordinate
+from journal import Journal, COMPLETED
+from scheduler import LeaseQueue
+
+
+def work(directory, worker):
+    """
+    Worker process: complete the requests claimed from the journal and list them in <worker>.txt
+    """
+    journal = Journal(directory)
+    queue = LeaseQueue(journal, worker, lease_time=30, poll_interval=0.1)
+    processed = []
+    while True:
+        request = queue.get()
+        if request is None:
+            break
+        processed.append(request['elements'][0])
+        journal.complete(request, 1)
+        queue.task_done()
+    queue.close()
+    journal.close()
+    with open(os.path.join(directory, '{}.txt'.format(worker)), 'w') as f:
+        f.write('\n'.join(processed))
+
+
+def run_workers(directory, count):
+    context = multiprocessing.get_context('spawn')
+    processes = [context.Process(target=work, args=(directory, 'worker-{}'.format(i))) for i in range(count)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(60)
+        assert process.exitcode == 0
+    processed = []
+    for i in range(count):
+        with open(os.path.join(directory, 'worker-{}.txt'.format(i))) as f:
+            processed += [line for line in f.read().split('\n') if line]
+    return processed
+
+
+def test_requests_are_processed_once_by_several_workers(tmp_path):
+    journal = Journal(str(tmp_path))
+    journal.add([{'elements': ['StudyInstanceUID=1.2.{}'.format(i)]} for i in range(200)])
+    processed = run_workers(str(tmp_path), 3)
+    assert sorted(processed) == sorted('StudyInstanceUID=1.2.{}'.format(i) for i in range(200))
+    assert journal.count(COMPLETED) == 200
+    journal.close()
+
+
+def test_requests_of_a_crashed_worker_are_reclaimed(tmp_path):
+    journal = Journal(str(tmp_path))
+    journal.add([{'elements': ['StudyInstanceUID=1.2.{}'.format(i)]} for i in range(20)])
+    # Claimed by a worker that stopped without completing or renewing them
+    for _ in range(2):
+        journal.claim('crashed', 0.5)
+    time.sleep(0.6)
+    processed = run_workers(str(tmp_path), 2)
+    assert sorted(processed) == sorted('StudyInstanceUID=1.2.{}'.format(i) for i in range(20))
+    assert journal.count(COMPLETED) == 20
+    journal.close()
+
+
+def move_config(directory, pacs_port, workers):
+    return merge_configs({
+        'common': {
+            'pacs': {'hostname': '127.0.0.1', 'port': pacs_port, 'aet': 'MOCKPACS'},
+            'local': {'aet': 'TEST', 'port': 0},
+            'schedule': {'enabled': False},
+            'output': {'directory': directory, 'database_file': 'database.csv'},
+            'workers': {'lease_time': 30, 'poll_interval': 0.2, 'local': workers},
+        },
+        'c-move': {
+            'threads': 2,
+            'throttle_time': 0,
+            'model': 'study',
+            'elements': ['QueryRetrieveLevel=STUDY', 'StudyInstanceUID'],
+            'elements_batch_file': os.path.join(directory, 'studies.csv'),
+            'output': {'directory_structure': 'StudyInstanceUID/SeriesInstanceUID', 'filename': 'SOPInstanceUID'},
+        },
+    }, 'c-move')
+
+
+def test_move_workers_need_their_own_ae_title(tmp_path):
+    config = move_config(str(tmp_path), 11112, [{'aet': 'WORKER0', 'port': 4000}])
+    assert worker_config(config, 0)['local']['aet'] == 'WORKER0'
+    with pytest.raises(ValueError):
+        worker_config(config, 1)
+    config = move_config(str(tmp_path), 11112, [{'aet': 'WORKER', 'port': 4000}, {'aet': 'WORKER', 'port': 4001}])
+    with pytest.raises(ValueError):
+        worker_config(config, 1)
+    with pytest.raises(ValueError):
+        coordinate(config, 2)
+    assert not os.path.exists(os.path.join(str(tmp_path), 'requests.db'))
+
+
+def test_coordinate_move(tmp_path, mock_pacs, free_port):
+    workers = [{'aet': 'WORKER{}'.format(i), 'port': free_port()} for i in range(2)]
+    pacs = mock_pacs({
+        'catalog': {'patients': 6, 'studies_per_patient': 1, 'series_per_study': 2, 'instances_per_series': 3},
+        'destinations': {x['aet']: ['127.0.0.1', x['port']] for x in workers},
+    })
+    directory = str(tmp_path / 'output')
+    os.makedirs(directory)
+    with open(os.path.join(directory, 'studies.csv'), 'w', newline='') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=['StudyInstanceUID'])
+        writer.writeheader()
+        for study in pacs.catalog.studies:
+            writer.writerow({'StudyInstanceUID': study['StudyInstanceUID']})
+    coordinate(move_config(directory, int(pacs.config['port']), workers), 2)
+
+    files = [name for _, _, names in os.walk(directory) for name in names if name.endswith('.dcm')]
+    assert len(files) == pacs.catalog.instance_count()
+    connection = sqlite3.connect(os.path.join(directory, 'requests.db'))
+    states = connection.execute('SELECT state FROM requests').fetchall()
+    connection.close()
+    assert states == [(COMPLETED,)] * len(pacs.catalog.studies)
+    # The sub-operations of a request are received by the storage SCP of the worker that sent it
+    rows = []
+    for worker in range(2):
+        with open(os.path.join(directory, 'database-{}.csv'.format(worker)), newline='') as csvfile:
+            rows += list(csv.DictReader(csvfile))
+    assert sorted(row['StudyInstanceUID'] for row in rows) == sorted(x['StudyInstanceUID'] for x in pacs.catalog.studies)
+    assert all(row['ReceivedInstances'] == '6' for row in rows)
@@ -0,0 +1,69 @@
+import os
+
+import numpy as np
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+from export import export_series
+
+# CT Image Storage
+CT_IMAGE = '1.2.840.10008.5.1.4.1.1.2'
+STUDY_UID = generate_uid()
+SERIES_UID = generate_uid()
+
+
+def write_ct(path, number, slope=1, intercept=-1024, decodable=True):
+    """
+    Write a 4x4 CT slice, with truncated pixel data if not decodable
+    """
+    ds = Dataset()
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.MediaStorageSOPClassUID = CT_IMAGE
+    ds.file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds.SOPClassUID = CT_IMAGE
+    ds.SOPInstanceUID = ds.file_meta.MediaStorageSOPInstanceUID
+    ds.StudyInstanceUID = STUDY_UID
+    ds.SeriesInstanceUID = SERIES_UID
+    ds.Modality = 'CT'
+    ds.InstanceNumber = number
+    ds.Rows = 4
+    ds.Columns = 4
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.BitsAllocated = 16
+    ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.PixelRepresentation = 0
+    ds.RescaleSlope = slope
+    ds.RescaleIntercept = intercept
+    pixels = np.full((4, 4), number, dtype=np.uint16).tobytes()
+    ds.PixelData = pixels if decodable else pixels[:8]
+    ds.save_as(path, write_like_original=False)
+    return (path, None, os.path.getsize(path))
+
+
+def test_array_is_trimmed_to_the_exported_frames(tmp_path):
+    locations = [write_ct(str(tmp_path / '{}.dcm'.format(i)), i, decodable=i != 2) for i in range(1, 4)]
+    row = export_series(str(tmp_path / 'export'), 'npy', 'float32', locations)
+    array = np.load(str(tmp_path / 'export' / row['Path']))
+    assert array.shape == (2, 4, 4)
+    assert row['Shape'] == '2x4x4'
+    assert row['ExportedFrames'] == '2'
+    assert row['SkippedInstances'] == '1'
+    assert (array[:, 0, 0] == [1 - 1024, 3 - 1024]).all()
+    assert (row['RescaleSlope'], row['RescaleIntercept']) == ('1.0', '-1024.0')
+
+
+def test_no_row_when_nothing_is_exported(tmp_path):
+    locations = [write_ct(str(tmp_path / '{}.dcm'.format(i)), i, decodable=False) for i in range(1, 3)]
+    assert export_series(str(tmp_path / 'export'), 'npy', 'float32', locations) is None
+    assert os.listdir(str(tmp_path / 'export' / STUDY_UID)) == []
+
+
+def test_rescale_is_only_reported_when_it_is_the_same_for_the_series(tmp_path):
+    locations = [write_ct(str(tmp_path / '{}.dcm'.format(i)), i, slope=i) for i in range(1, 3)]
+    row = export_series(str(tmp_path / 'export'), 'npy', 'float32', locations)
+    assert (row['RescaleSlope'], row['RescaleIntercept']) == ('', '')
+    array = np.load(str(tmp_path / 'export' / row['Path']))
+    assert (array[:, 0, 0] == [1 * 1 - 1024, 2 * 2 - 1024]).all()
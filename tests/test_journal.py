@@ -0,0 +1,168 @@
+import csv
+import time
+import itertools
+import collections
+
+from journal import Journal, request_key, PENDING, RUNNING, COMPLETED, FAILED, SPLIT
+from scu import load_requests, create_requests
+
+
+def make_requests(count):
+    return [{'elements': ['QueryRetrieveLevel=STUDY', 'StudyInstanceUID=1.2.{}'.format(i)]} for i in range(count)]
+
+
+def test_requests_are_claimed_once(tmp_path):
+    journal = Journal(str(tmp_path))
+    journal.add(make_requests(3))
+    claimed = [journal.claim('a', 60), journal.claim('b', 60), journal.claim('a', 60)]
+    assert claimed == make_requests(3)
+    assert journal.claim('b', 60) is None
+    assert journal.count(RUNNING) == 3
+
+
+def test_claim_with_predicate(tmp_path):
+    journal = Journal(str(tmp_path))
+    journal.add(make_requests(2))
+    assert journal.claim('a', 60, lambda request: False) is None
+    assert journal.count(PENDING) == 2
+    assert journal.claim('a', 60, lambda request: True) == make_requests(1)[0]
+
+
+def test_expired_lease_is_claimed_again(tmp_path):
+    journal = Journal(str(tmp_path))
+    journal.add(make_requests(1))
+    request = journal.claim('crashed', 0.05)
+    assert journal.claim('alive', 60) is None
+    time.sleep(0.1)
+    assert journal.claim('alive', 60) == request
+    # The new lease is held by the other worker
+    assert journal.claim('crashed', 60) is None
+
+
+def test_renewed_lease_is_kept(tmp_path):
+    journal = Journal(str(tmp_path))
+    journal.add(make_requests(1))
+    journal.claim('a', 0.2)
+    time.sleep(0.1)
+    journal.renew('a', 60)
+    time.sleep(0.2)
+    assert journal.claim('b', 60) is None
+
+
+def test_released_request_can_be_claimed(tmp_path):
+    journal = Journal(str(tmp_path))
+    journal.add(make_requests(1))
+    request = journal.claim('a', 60)
+    journal.release(request)
+    assert journal.count(PENDING) == 1
+    assert journal.claim('b', 60) == request
+    assert journal.complete(request)
+    assert journal.count(COMPLETED) == 1
+
+
+def test_request_key_is_stable():
+    template = {'elements': ['QueryRetrieveLevel=STUDY', 'StudyInstanceUID'], 'model': 'STUDY'}
+    request = {'elements': ['QueryRetrieveLevel=STUDY', 'StudyInstanceUID=1.2'], 'model': 'STUDY'}
+    # Same key for a batch file request on top of its template, and whatever the order of the keys
+    assert request_key(collections.ChainMap({'elements': request['elements']}, template)) == request_key(request)
+    assert request_key(dict(reversed(list(request.items())))) == request_key(request)
+    # Private keys are left out
+    assert request_key(dict(request, _parts=[1, 2])) == request_key(request)
+    assert request_key(dict(request, model='PATIENT')) != request_key(request)
+
+
+def test_request_states(tmp_path):
+    journal = Journal(str(tmp_path))
+    requests = make_requests(3)
+    journal.add(requests)
+    # Requests already in the journal are ignored
+    journal.add(requests)
+    assert journal.count() == 3
+    assert journal.start(requests[0]) and journal.start(requests[1])
+    assert journal.complete(requests[0], 12)
+    assert journal.fail(requests[1])
+    assert journal.requests(PENDING) == [requests[2]]
+    assert journal.requests(COMPLETED) == [requests[0]]
+    assert journal.requests(FAILED) == [requests[1]]
+    # A completed request is not completed or failed again
+    assert not journal.complete(requests[0]) and not journal.fail(requests[0])
+    # A failed request is started again
+    assert journal.start(requests[1])
+    assert journal.count(RUNNING) == 1
+    assert len(journal.durations()) == 1
+
+
+def test_split_request_is_replaced_by_its_children(tmp_path):
+    journal = Journal(str(tmp_path))
+    request, = make_requests(1)
+    journal.add([request])
+    journal.start(request)
+    children = [{'elements': request['elements'] + ['StudyDate={}'.format(date)]} for date in ['20200101', '20200102']]
+    journal.split(request, children, 500)
+    assert journal.requests(SPLIT) == [request]
+    assert journal.requests(PENDING) == children
+    assert not journal.complete(request)
+
+
+def batch_config(tmp_path, rows):
+    batch_file = str(tmp_path / 'batch.csv')
+    with open(batch_file, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(['StudyInstanceUID'])
+        for i in range(rows):
+            writer.writerow(['1.2.{}'.format(i)])
+    return {'request': {'type': 'c-find', 'elements': ['QueryRetrieveLevel=STUDY', 'StudyInstanceUID'],
+        'elements_batch_file': batch_file}}
+
+
+def test_interrupted_generation_is_resumed(tmp_path):
+    config = batch_config(tmp_path, 5)
+    journal = Journal(str(tmp_path / 'journal'))
+    # Stopped while the second batch of requests was processed
+    processed = list(itertools.islice(create_requests(config, journal, batch_size=2), 3))
+    assert journal.generation() == (4, False)
+    for request in processed:
+        journal.complete(request)
+    requests = [dict(request) for request in load_requests(config, journal, 'resume')]
+    # The pending request of the second batch, then the requests that were not generated
+    assert [request['elements'][1] for request in requests] == ['StudyInstanceUID=1.2.3', 'StudyInstanceUID=1.2.4']
+    assert journal.generation() == (5, True)
+    assert journal.count() == 5
+
+
+def test_load_requests_modes(tmp_path):
+    config = batch_config(tmp_path, 3)
+    journal = Journal(str(tmp_path / 'journal'))
+    first, second, third = list(create_requests(config, journal))
+    journal.complete(first)
+    journal.fail(second)
+    journal.start(third)
+    # Requests running when the extraction stopped are pending again
+    assert load_requests(config, journal, 'resume') == [third]
+    assert journal.count(FAILED) == 1
+    assert load_requests(config, journal, 'retry') == [second, third]
+    assert journal.count(FAILED) == 0
+    requests = list(load_requests(config, journal, 'new'))
+    assert [request_key(request) for request in requests] == [request_key(x) for x in [first, second, third]]
+    assert journal.count(PENDING) == 3
+
+
+def test_csv_journal_is_imported(tmp_path):
+    fieldnames = ['elements', 'model']
+    requests = [{'elements': ['StudyInstanceUID=1.2.{}'.format(i), 'QueryRetrieveLevel=STUDY'], 'model': 'STUDY'}
+        for i in range(3)]
+    for filename, rows in [('requests.whole', requests), ('requests.completed', requests[:1]),
+            ('requests.failed', requests[1:2])]:
+        with open(str(tmp_path / filename), 'w', newline='') as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+            writer.writeheader()
+            writer.writerows(rows)
+    journal = Journal(str(tmp_path))
+    assert journal.import_csv()
+    # Elements are sorted, as they were when resuming from the CSV files
+    imported = [dict(request, elements=sorted(request['elements'])) for request in requests]
+    assert journal.requests(COMPLETED) == imported[:1]
+    assert journal.requests(FAILED) == imported[1:2]
+    assert journal.requests(PENDING) == imported[2:]
+    assert journal.generation() == (3, True)
+    assert not Journal(str(tmp_path / 'empty')).import_csv()
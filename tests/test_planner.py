@@ -0,0 +1,133 @@
+from planner import DateRangePlanner, parse_date_range
+from scheduler import RequestQueue, element_value
+from journal import Journal, PENDING, FAILED, SPLIT
+from scu import SCU, create_ae
+from pool import AssociationPool
+from sink import ResultWriter
+
+
+def planner_config(**date_split):
+    return {'request': {'type': 'c-find', 'model': 'study', 'threads': 1,
+        'date_split': {'result_limit': 100, 'target_fill': 0.5, **date_split}}}
+
+
+def make_request(study_date, *elements):
+    return {'type': 'c-find', 'elements': ['QueryRetrieveLevel=STUDY', 'StudyDate={}'.format(study_date)] + list(elements)}
+
+
+def dates(requests):
+    return [element_value(request, 'StudyDate') for request in requests]
+
+
+def test_bisect_date_range():
+    planner = DateRangePlanner(planner_config())
+    assert dates(planner.bisect(make_request('20200101-20200110'))) == ['20200101-20200105', '20200106-20200110']
+    assert dates(planner.bisect(make_request('20200101-20200102'))) == ['20200101-20200101', '20200102-20200102']
+
+
+def test_bisect_single_day_on_study_time():
+    planner = DateRangePlanner(planner_config())
+    children = planner.bisect(make_request('20200101', 'StudyTime=*'))
+    assert dates(children) == ['20200101', '20200101']
+    assert [element_value(x, 'StudyTime') for x in children] == ['000000-115959', '120000-235959']
+    children = planner.bisect(children[0])
+    assert [element_value(x, 'StudyTime') for x in children] == ['000000-055959', '060000-115959']
+
+
+def test_single_day_cannot_be_split_further():
+    planner = DateRangePlanner(planner_config())
+    # No StudyTime element, or a StudyTime window shorter than a minute
+    assert planner.bisect(make_request('20200101')) == []
+    assert planner.bisect(make_request('20200101', 'StudyTime=100000-100030')) == []
+    # Open date range
+    assert planner.bisect(make_request('20200101-')) == []
+
+
+def queue_of(config, requests):
+    queue = RequestQueue(config)
+    for request in requests:
+        queue.put(request)
+    return queue
+
+
+def test_sparse_windows_are_merged():
+    config = planner_config()
+    planner = DateRangePlanner(config)
+    request = make_request('20200101-20200110')
+    queue = queue_of(config, [make_request('20200111-20200120'), make_request('20200121-20200130'),
+        make_request('20200201-20200210')])
+    # Nothing is known about the density of the windows
+    assert planner.merge(request, queue) is request
+    # 1 response per day: 50 days fit in target_fill * result_limit
+    planner.record(make_request('20191201-20191210'), 10)
+    merged = planner.merge(request, queue)
+    assert dates([merged]) == ['20200101-20200130']
+    assert merged['_parts'] == [request, make_request('20200111-20200120'), make_request('20200121-20200130')]
+    # The window of 20200201 is not adjacent
+    assert dates([queue.pop_if(lambda x: True)]) == ['20200201-20200210']
+
+
+def test_dense_windows_are_not_merged():
+    config = planner_config(max_days=15)
+    planner = DateRangePlanner(config)
+    request = make_request('20200101-20200110')
+    # Above max_days
+    planner.record(make_request('20200101-20200110'), 0)
+    assert planner.merge(request, queue_of(config, [make_request('20200111-20200120')])) is request
+    # 4 responses per day, 40 expected for 10 days and 80 for 20 days
+    planner = DateRangePlanner(planner_config())
+    planner.record(make_request('20200101-20200110'), 40)
+    assert planner.merge(request, queue_of(config, [make_request('20200111-20200120')])) is request
+    # Requests with other elements or a StudyTime window are not merged
+    planner.record(make_request('20200101-20200110'), 0)
+    assert planner.merge(request, queue_of(config, [make_request('20200111-20200120', 'PatientID=1')])) is request
+    timed = make_request('20200101-20200110', 'StudyTime=080000-120000')
+    assert planner.merge(timed, queue_of(config, [make_request('20200111-20200120')])) is timed
+
+
+def create_scu(tmp_path):
+    config = planner_config()
+    config.update({'pacs': {'hostname': '127.0.0.1', 'port': 11112, 'aet': 'PACS'},
+        'local': {'aet': 'TEST', 'port': 0},
+        'output': {'directory': str(tmp_path), 'database_file': 'database.csv'}})
+    return SCU(config, AssociationPool(create_ae(config), config), DateRangePlanner(config),
+        Journal(str(tmp_path)), ResultWriter.from_config(config))
+
+
+def test_split_request(tmp_path):
+    scu = create_scu(tmp_path)
+    try:
+        request = make_request('20200101-20200110')
+        scu.journal.add([request])
+        scu.split_request(request, 100)
+        assert scu.journal.requests(SPLIT) == [request]
+        children = [scu.queue.pop_if(lambda x: True) for i in range(2)]
+        assert dates(children) == ['20200101-20200105', '20200106-20200110']
+        assert scu.journal.requests(PENDING) == children
+        # The capped window is used for the density of its neighbours
+        assert scu.planner.expected_count(*parse_date_range('20200111-20200120')) == 100
+    finally:
+        scu.sink.close()
+
+
+def test_split_request_that_cannot_be_split_fails(tmp_path):
+    scu = create_scu(tmp_path)
+    try:
+        request = make_request('20200101')
+        scu.journal.add([request])
+        scu.split_request(request, 100)
+        assert scu.journal.requests(FAILED) == [request]
+        assert scu.queue.pop_if(lambda x: True) is None
+    finally:
+        scu.sink.close()
+
+
+def test_split_merged_request_queues_its_parts(tmp_path):
+    scu = create_scu(tmp_path)
+    try:
+        parts = [make_request('20200101-20200110'), make_request('20200111-20200120')]
+        merged = dict(make_request('20200101-20200120'), _parts=parts)
+        scu.split_request(merged, 100)
+        assert [scu.queue.pop_if(lambda x: True) for i in range(3)] == parts + [None]
+    finally:
+        scu.sink.close()
@@ -0,0 +1,159 @@
+import time
+import threading
+
+import pynetdicom
+import pytest
+from pynetdicom import AE
+from pynetdicom.association import Association
+from pynetdicom.dimse_primitives import C_ECHO
+from pynetdicom.sop_class import Verification
+
+from pool import AssociationPool, AssociationError, requeue_stolen_responses, REACTOR_RACE_VERSIONS
+
+
+def associate(pacs):
+    ae = AE(ae_title='TEST')
+    ae.add_requested_context(Verification)
+    ae.dimse_timeout = 5
+    assoc = ae.associate('127.0.0.1', int(pacs.config['port']), ae_title='MOCKPACS')
+    assert assoc.is_established
+    return assoc
+
+
+def create_pool(port, **pool):
+    ae = AE(ae_title='TEST')
+    ae.add_requested_context(Verification)
+    config = {'pacs': {'hostname': '127.0.0.1', 'port': port, 'aet': 'MOCKPACS'}, 'request': {'threads': 2},
+        'pool': pool}
+    return AssociationPool(ae, config)
+
+
+def count_echoes(pooled):
+    echoes = []
+    send_c_echo = pooled.assoc.send_c_echo
+
+    def counted():
+        echoes.append(time.time())
+        return send_c_echo()
+    pooled.assoc.send_c_echo = counted
+    return echoes
+
+
+def steal_echo_response(assoc, serve_request):
+    """
+    Reproduce the reactor race: while the reactor is paused for a C-ECHO request, the reactor takes the
+    response off the DIMSE queue and serves it, as it does when it is seen as paused too early
+    """
+    assoc._reactor_checkpoint.clear()
+    while not assoc._is_paused:
+        time.sleep(0.0001)
+    request = C_ECHO()
+    request.MessageID = 1
+    request.AffectedSOPClassUID = Verification
+    context_id = assoc._get_valid_context(Verification, '', 'scu').context_id
+    assoc.dimse.send_msg(request, context_id)
+    deadline = time.time() + 5
+    while assoc.dimse.msg_queue.empty() and time.time() < deadline:
+        time.sleep(0.001)
+    context_id, response = assoc.dimse.get_msg(block=False)
+    assert response is not None
+    serve_request(assoc, response, context_id)
+    return response
+
+
+@pytest.mark.skipif(pynetdicom.__version__ not in REACTOR_RACE_VERSIONS, reason='pynetdicom is not patched')
+def test_response_taken_by_the_reactor_is_requeued(mock_pacs):
+    requeue_stolen_responses()
+    pacs = mock_pacs()
+    assoc = associate(pacs)
+    try:
+        # Without the work-around the response is dropped and the sender times out
+        response = steal_echo_response(assoc, Association._serve_request.original)
+        assert assoc.dimse.msg_queue.empty()
+        response = steal_echo_response(assoc, Association._serve_request)
+        assert assoc.dimse.get_msg(block=False)[1] is response
+        assert response.Status == 0x0000
+    finally:
+        assoc._reactor_checkpoint.set()
+        assoc.release()
+
+
+def test_associations_are_reused_within_the_slots(mock_pacs):
+    pacs = mock_pacs()
+    pool = create_pool(int(pacs.config['port']), max_associations=2)
+    try:
+        first, second = pool.acquire(), pool.acquire()
+        assert first.assoc is not second.assoc
+        acquired = []
+        waiting = threading.Thread(target=lambda : acquired.append(pool.acquire()))
+        waiting.start()
+        # Both slots are in use
+        waiting.join(0.3)
+        assert not acquired
+        pool.release(first)
+        waiting.join(5)
+        assert acquired == [first]
+        pool.release(second)
+        pool.release(first)
+        # The most recently released association is reused
+        with pool.association() as assoc:
+            assert assoc is first.assoc
+        assert len(pool.idle) == 2
+    finally:
+        pool.close()
+    assert not first.assoc.is_established and not second.assoc.is_established
+
+
+def test_idle_association_is_checked_with_an_echo(mock_pacs):
+    pacs = mock_pacs()
+    pool = create_pool(int(pacs.config['port']), echo_after=0.2)
+    try:
+        pooled = pool.acquire()
+        echoes = count_echoes(pooled)
+        pool.release(pooled)
+        assert pool.acquire() is pooled
+        assert not echoes
+        pool.release(pooled)
+        time.sleep(0.3)
+        assert pool.acquire() is pooled
+        assert len(echoes) == 1
+        # An association that failed its check is replaced
+        pooled.assoc.send_c_echo = lambda : None
+        pool.release(pooled)
+        time.sleep(0.3)
+        replaced = pool.acquire()
+        assert replaced is not pooled and replaced.assoc.is_established
+        assert not pooled.assoc.is_established
+        pool.release(replaced)
+    finally:
+        pool.close()
+
+
+def test_association_is_recycled_after_max_operations(mock_pacs):
+    pacs = mock_pacs()
+    pool = create_pool(int(pacs.config['port']), max_operations=2)
+    try:
+        pooled = pool.acquire()
+        pool.release(pooled)
+        assert pool.acquire() is pooled
+        pool.release(pooled)
+        assert not pooled.assoc.is_established and not pool.idle
+        recycled = pool.acquire()
+        assert recycled is not pooled and recycled.operations == 0
+        # A broken association is not returned to the pool
+        pool.release(recycled, healthy=False)
+        assert not recycled.assoc.is_established and not pool.idle
+    finally:
+        pool.close()
+
+
+def test_association_error_after_backoff(free_port):
+    # Nothing listens on the port
+    pool = create_pool(free_port(), max_associations=1, retry_attempts=3, backoff_initial=0.1, backoff_max=0.15)
+    start = time.time()
+    with pytest.raises(AssociationError):
+        pool.acquire()
+    # Waited 0.1 then 0.15 seconds between the attempts
+    assert time.time() - start >= 0.25
+    # The slot is released
+    assert pool.slots.acquire(blocking=False)
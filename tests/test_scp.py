@@ -0,0 +1,98 @@
+import os
+
+from pydicom.dataset import Dataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+from pynetdicom import AE, _config, dimse_messages
+from pynetdicom.sop_class import SecondaryCaptureImageStorage
+
+from scp import SCP
+
+
+def scp_config(directory, **output):
+    return {
+        'local': {'aet': 'TEST', 'port': 0},
+        'request': {'type': 'c-move', 'threads': 2},
+        'output': {'directory': directory, 'directory_structure': 'StudyInstanceUID', 'filename': 'SOPInstanceUID',
+            **output},
+    }
+
+
+def queue_file(scp, path, data=b'not a DICOM file'):
+    with open(path, 'wb') as f:
+        f.write(data)
+    assert scp.admit(len(data))
+    scp.writing_queue.put((path, len(data), None))
+
+
+def test_unreadable_file_is_quarantined(tmp_path):
+    scp = SCP(scp_config(str(tmp_path / 'output')))
+    os.makedirs(scp.temp_dir)
+    queue_file(scp, os.path.join(scp.temp_dir, 'received'))
+    scp.stop_server()
+    assert os.listdir(str(tmp_path / 'output-quarantine')) == ['received']
+    assert (scp.pending_files, scp.pending_bytes) == (0, 0)
+
+
+def test_pipeline_is_released_when_quarantine_fails(tmp_path):
+    # The quarantine directory cannot be created
+    (tmp_path / 'quarantine').write_text('')
+    scp = SCP(scp_config(str(tmp_path / 'output'), quarantine_directory=str(tmp_path / 'quarantine' / 'files')))
+    os.makedirs(scp.temp_dir)
+    for i in range(3):
+        queue_file(scp, os.path.join(scp.temp_dir, 'received-{}'.format(i)))
+    # Returns once the files are processed, with the writer threads still running
+    scp.stop_server()
+    assert (scp.pending_files, scp.pending_bytes) == (0, 0)
+    assert sorted(os.listdir(scp.temp_dir)) == ['received-0', 'received-1', 'received-2']
+
+
+def send_instance(port):
+    ds = Dataset()
+    ds.SOPClassUID = SecondaryCaptureImageStorage
+    ds.SOPInstanceUID = generate_uid()
+    ds.StudyInstanceUID = generate_uid()
+    ds.file_meta = Dataset()
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ae = AE()
+    ae.add_requested_context(SecondaryCaptureImageStorage, ExplicitVRLittleEndian)
+    assoc = ae.associate('127.0.0.1', port)
+    assert assoc.is_established
+    status = assoc.send_c_store(ds)
+    assoc.release()
+    assert status.Status == 0x0000
+    return ds.SOPInstanceUID
+
+
+def test_stream_to_disk_is_scoped_to_the_scp(tmp_path, free_port):
+    original = dimse_messages.NamedTemporaryFile
+    spooled = {}
+    scps = {}
+    for name, stream in (('streaming', True), ('in-memory', False)):
+        config = scp_config(str(tmp_path / name), stream_to_disk=stream)
+        config['local']['port'] = free_port()
+        scp = SCP(config)
+        store = scp.store
+
+        def recorded_store(event, name=name, store=store):
+            try:
+                spooled[name] = event.dataset_path
+            except AttributeError:
+                spooled[name] = None
+            return store(event)
+        scp.store = recorded_store
+        scp.start_server()
+        scps[name] = scp
+    uids = {}
+    try:
+        for name, scp in scps.items():
+            uids[name] = send_instance(scp.config['local']['port'])
+    finally:
+        scps['in-memory'].stop_server()
+        # The other SCP still streams to disk
+        assert dimse_messages.NamedTemporaryFile is not original
+        scps['streaming'].stop_server()
+    assert spooled['streaming'] and not spooled['in-memory']
+    for name, uid in uids.items():
+        assert [f for _, _, files in os.walk(str(tmp_path / name)) for f in files] == [uid + '.dcm']
+    assert dimse_messages.NamedTemporaryFile is original
+    assert dimse_messages._config is _config and not _config.STORE_RECV_CHUNKED_DATASET
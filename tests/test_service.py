@@ -0,0 +1,44 @@
+import os
+import stat
+
+import pytest
+
+from service import JobService
+
+
+def service_config(tmp_path, **service):
+    section = {'hostname': '127.0.0.1', 'port': 11112, 'aet': 'PACS'}
+    return {
+        'common': {
+            'pacs': section,
+            'local': {'aet': 'TEST', 'port': 0},
+            'schedule': {'enabled': False},
+            'service': {'output_root': str(tmp_path / 'jobs'), **service},
+        },
+        'c-find': {'threads': 2, 'elements': {'StudyInstanceUID': ''}, 'output': {'directory': 'unused'}},
+    }
+
+
+def test_batch_file_must_be_inside_output_root(tmp_path):
+    service = JobService(service_config(tmp_path))
+    (tmp_path / 'secret.csv').write_text('StudyInstanceUID\n1.2.3\n')
+    for batch_file in [str(tmp_path / 'secret.csv'), '../secret.csv']:
+        with pytest.raises(ValueError, match='elements_batch_file'):
+            service.submit('c-find: {{elements_batch_file: {}, output: {{directory: job}}}}'.format(batch_file))
+    assert not service.jobs
+    job = service.submit('c-find: {elements_batch_file: batches/job.csv, output: {directory: job}}')
+    assert job.config['request']['elements_batch_file'] == str(tmp_path / 'jobs' / 'batches' / 'job.csv')
+
+
+def test_socket_is_only_accessible_to_the_owner(tmp_path):
+    socket = str(tmp_path / 'api.sock')
+    service = JobService(service_config(tmp_path, socket=socket))
+    umask = os.umask(0o022)
+    try:
+        server = service.create_server()
+        assert stat.S_IMODE(os.stat(socket).st_mode) == 0o600
+        server.server_close()
+        # The umask of the process is restored
+        assert os.umask(0o022) == 0o022
+    finally:
+        os.umask(umask)
@@ -0,0 +1,54 @@
+import csv
+import glob
+
+import pytest
+
+from sink import ResultWriter, pa
+
+
+def read_csv(path):
+    with open(path, newline='') as csvfile:
+        return list(csv.DictReader(csvfile))
+
+
+def test_csv_header_is_extended_for_resumed_extraction(tmp_path):
+    path = str(tmp_path / 'database.csv')
+    writer = ResultWriter(path)
+    writer.write([{'StudyInstanceUID': '1.1', 'Status': '0x0'}])
+    writer.close()
+
+    # Resumed extraction writing rows with new fields to the existing file
+    writer = ResultWriter(path)
+    writer.write([{'StudyInstanceUID': '1.2', 'Status': '0x0', 'ExpectedInstances': '10', 'ReceivedInstances': '9'}])
+    writer.close()
+
+    rows = read_csv(path)
+    assert [row['StudyInstanceUID'] for row in rows] == ['1.1', '1.2']
+    assert rows[0]['ExpectedInstances'] == ''
+    assert rows[1]['ExpectedInstances'] == '10'
+    assert rows[1]['ReceivedInstances'] == '9'
+
+
+def test_csv_header_is_extended_when_first_rows_lack_fields(tmp_path):
+    path = str(tmp_path / 'database.csv')
+    writer = ResultWriter(path, batch_size=1)
+    writer.write([{'StudyInstanceUID': '1.1'}])
+    writer.write([{'StudyInstanceUID': '1.2', 'ReceivedInstances': '5'}])
+    writer.close()
+    rows = read_csv(path)
+    assert rows[-1]['ReceivedInstances'] == '5'
+    assert len(rows) == 2
+
+
+@pytest.mark.skipif(pa is None, reason='pyarrow is not installed')
+def test_parquet_rows_with_new_fields_are_written_to_a_new_file(tmp_path):
+    import pyarrow.parquet as pq
+    path = str(tmp_path / 'database.parquet')
+    writer = ResultWriter(path, format='parquet', batch_size=1)
+    writer.write([{'StudyInstanceUID': '1.1'}])
+    writer.write([{'StudyInstanceUID': '1.2', 'ReceivedInstances': '5'}])
+    writer.close()
+    tables = [pq.read_table(f) for f in sorted(glob.glob(str(tmp_path / 'database*.parquet')))]
+    rows = [row for table in tables for row in table.to_pylist()]
+    assert {row['StudyInstanceUID'] for row in rows} == {'1.1', '1.2'}
+    assert {'StudyInstanceUID': '1.2', 'ReceivedInstances': '5'} in rows
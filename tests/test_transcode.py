@@ -0,0 +1,68 @@
+import os
+
+import pytest
+from pydicom import dcmread
+from pydicom.data import get_testdata_file
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.encaps import encapsulate
+from pydicom.uid import ExplicitVRLittleEndian, RLELossless, generate_uid
+
+from transcode import transcode_file
+
+# Basic Text SR Storage
+BASIC_TEXT_SR = '1.2.840.10008.5.1.4.1.1.88.11'
+
+
+def write_sr(path):
+    """
+    Write a structured report, an instance without pixel data
+    """
+    ds = Dataset()
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.MediaStorageSOPClassUID = BASIC_TEXT_SR
+    ds.file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds.SOPClassUID = BASIC_TEXT_SR
+    ds.SOPInstanceUID = ds.file_meta.MediaStorageSOPInstanceUID
+    ds.Modality = 'SR'
+    ds.PatientID = 'SR-1'
+    ds.save_as(path, write_like_original=False)
+    return ds
+
+
+@pytest.mark.parametrize('mode', ['rle', 'decompress'])
+def test_instance_without_pixel_data_is_moved(tmp_path, mode):
+    src = str(tmp_path / 'received.dcm')
+    dest = str(tmp_path / 'output' / 'sr.dcm')
+    original = write_sr(src)
+    assert transcode_file(mode, src, dest) == (dest, ExplicitVRLittleEndian)
+    assert not os.path.exists(src)
+    ds = dcmread(dest)
+    assert ds.SOPInstanceUID == original.SOPInstanceUID
+    assert ds.file_meta.TransferSyntaxUID == ExplicitVRLittleEndian
+
+
+def test_undecodable_pixel_data_is_moved_as_received(tmp_path):
+    src = str(tmp_path / 'received.dcm')
+    dest = str(tmp_path / 'output' / 'mr.dcm')
+    ds = dcmread(get_testdata_file('MR_small_RLE.dcm'))
+    # Not a valid RLE segment header
+    ds.PixelData = encapsulate([b'\x00' * 64])
+    ds.save_as(src)
+    with open(src, 'rb') as f:
+        received = f.read()
+    assert transcode_file('decompress', src, dest) == (dest, RLELossless)
+    assert not os.path.exists(src)
+    assert not os.path.exists(src + '.transcoded')
+    with open(dest, 'rb') as f:
+        assert f.read() == received
+
+
+def test_image_is_compressed(tmp_path):
+    src = str(tmp_path / 'received.dcm')
+    dest = str(tmp_path / 'output' / 'ct.dcm')
+    original = dcmread(get_testdata_file('CT_small.dcm'))
+    original.save_as(src)
+    assert transcode_file('rle', src, dest) == (dest, RLELossless)
+    ds = dcmread(dest)
+    assert (ds.pixel_array == original.pixel_array).all()
@@ -0,0 +1,112 @@
+import os
+import shutil
+import time
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from pydicom import dcmread
+from pydicom.uid import RLELossless
+
+from metrics import metrics
+
+
+def transcode_dataset(mode, ds):
+    """
+    Transcode a data set in place. Returns True if it was changed.
+    """
+    transfer_syntax = ds.file_meta.TransferSyntaxUID
+    if mode == 'decompress' and transfer_syntax.is_compressed:
+        ds.decompress()
+        return True
+    if mode == 'rle' and transfer_syntax != RLELossless:
+        if transfer_syntax.is_compressed:
+            ds.decompress()
+        ds.compress(RLELossless)
+        return True
+    return False
+
+def transcode_file(mode, src, dest):
+    """
+    Transcode a DICOM file and move it to its destination. Runs in a worker process.
+    Returns the destination and the transfer syntax of the file. Instances without pixel data (e.g. SR, KO,
+    PR) and files whose pixel data cannot be decoded or encoded are moved as received.
+    """
+    ds = dcmread(src)
+    transfer_syntax = ds.file_meta.TransferSyntaxUID
+    if 'PixelData' in ds:
+        transcoded = src + '.transcoded'
+        try:
+            if transcode_dataset(mode, ds):
+                # The received file is only replaced once the transcoded file is written
+                ds.save_as(transcoded, write_like_original=False)
+                os.replace(transcoded, src)
+                transfer_syntax = ds.file_meta.TransferSyntaxUID
+        except Exception as exc:
+            print('\nTranscoding failed for {}, stored as received: {}'.format(src, exc))
+            if os.path.exists(transcoded):
+                os.remove(transcoded)
+    os.makedirs(os.path.dirname(dest), exist_ok = True)
+    shutil.move(src, dest)
+    return dest, str(transfer_syntax)
+
+
+class Transcoder(object):
+    """ Transcoder class
+    Decompresses (to a native transfer syntax) or losslessly recompresses (RLE) received files on a pool
+    of worker processes, so that the CPU-bound codecs do not compete with the receiving threads for the GIL.
+    Only file paths are handed to the workers.
+    """
+
+    def __init__(self, mode, workers=None):
+        self.mode = mode
+        # Workers are started with spawn since the SCP threads are already running
+        self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+        self.lock = threading.Lock()
+        self.pending = 0
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Return a Transcoder for output.transcode (or output.decompress), or None if transcoding is disabled
+        """
+        transcode = config['output'].get('transcode') or {}
+        mode = str(transcode.get('mode', 'none')).lower()
+        if mode == 'none' and config['output'].get('decompress'):
+            mode = 'decompress'
+        if mode == 'none':
+            return None
+        if mode not in ['decompress', 'rle']:
+            raise ValueError('Unknown transcoding mode: {}'.format(mode))
+        return cls(mode, transcode.get('workers'))
+
+    def submit(self, src, dest, callback=None):
+        """
+        Queue a file for transcoding. The callback is called once the file is transcoded with the result of
+        transcode_file, or with None if transcoding failed.
+        """
+        with self.lock:
+            self.pending += 1
+        time_start = time.perf_counter()
+        try:
+            future = self.executor.submit(transcode_file, self.mode, src, dest)
+        except Exception:
+            with self.lock:
+                self.pending -= 1
+            raise
+        future.add_done_callback(lambda f : self.done(f, src, callback, time_start))
+        return future
+
+    def done(self, future, src, callback, time_start):
+        with self.lock:
+            self.pending -= 1
+        # Includes the time spent waiting for a worker process
+        metrics.observe('pydicombatch_postprocess_duration_seconds', time.perf_counter() - time_start, step='transcode')
+        if callback:
+            callback(None if future.exception() else future.result())
+        if future.exception():
+            # The file is quarantined by the callback
+            print('\nTranscoding failed for {}: {}'.format(src, future.exception()))
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,125 @@
+import time
+import datetime
+import threading
+import collections
+
+import pytz
+
+from metrics import metrics
+
+
+def seconds_until(time_str, tzname):
+    """
+    Returns the number of seconds from now until the time in format HH:mm
+    """
+    h, m = [int(x) for x in time_str.split(':')[:2]]
+    tz = pytz.timezone(tzname)
+    now = datetime.datetime.now(tz=tz)
+    return int((datetime.timedelta(hours=24)
+        - (now - now.replace(hour=h, minute=m, second=0, microsecond=0)))
+        .total_seconds() % (24 * 3600))
+
+
+class ScheduleWindow(object):
+    """ ScheduleWindow class
+    Keeps the extraction inside the schedule window (schedule.start_time - schedule.end_time). The duration
+    of a request is estimated from the durations of the completed requests (journal history, then the
+    requests of this run). A request is only started if its estimate, plus a safety margin, ends before
+    the window closes; otherwise the thread waits for the window to reopen. While the extraction is paused
+    the idle pooled associations are released (they are re-established on the first request of the next
+    window) and the catalog is flushed. The pool is None when it is shared with other jobs of the service.
+    """
+
+    def __init__(self, config, journal=None, pool=None, scp=None):
+        schedule = config.get('schedule') or {}
+        self.operation = config['request']['type']
+        self.enabled = bool(schedule.get('enabled'))
+        self.start_time = schedule.get('start_time')
+        self.end_time = schedule.get('end_time')
+        self.timezone = schedule.get('timezone', 'UTC')
+        self.drain = bool(schedule.get('drain', True))
+        self.safety_margin = float(schedule.get('safety_margin', 60))
+        self.quantile = float(schedule.get('duration_quantile', 0.9))
+        self.default_duration = float(schedule.get('default_duration', 0))
+        self.poll_interval = float(schedule.get('poll_interval', 30))
+        self.pool = pool
+        self.scp = scp
+        self.lock = threading.Lock()
+        self.paused = False
+        self.durations = collections.deque(maxlen=int(schedule.get('history', 200)))
+        if self.enabled and self.drain and journal:
+            self.durations.extend(journal.durations(self.durations.maxlen))
+
+    def seconds_left(self):
+        """
+        Return the number of seconds until the window closes, or 0 outside the window
+        """
+        sec_until_start = seconds_until(self.start_time, self.timezone)
+        sec_until_end = seconds_until(self.end_time, self.timezone)
+        return 0 if sec_until_end > sec_until_start else sec_until_end
+
+    def estimate(self, request):
+        """
+        Return the estimated duration of a request in seconds. Merged requests count as many requests.
+        """
+        with self.lock:
+            durations = sorted(self.durations)
+        if not durations:
+            estimate = self.default_duration
+        else:
+            estimate = durations[min(len(durations) - 1, int(self.quantile * len(durations)))]
+        return estimate * len(request.get('_parts', [request]))
+
+    def record(self, duration):
+        with self.lock:
+            self.durations.append(duration)
+
+    def window_length(self):
+        length = seconds_until(self.end_time, self.timezone) - seconds_until(self.start_time, self.timezone)
+        return length % (24 * 3600) or 24 * 3600
+
+    def can_start(self, request):
+        seconds_left = self.seconds_left()
+        if not self.drain:
+            return seconds_left > 0
+        # Requests longer than the whole window are started when the window opens
+        required = min(self.estimate(request) + self.safety_margin, self.window_length() - self.poll_interval)
+        return seconds_left > max(required, 0)
+
+    def pause(self):
+        """
+        Release the idle associations and checkpoint the catalog while the extraction is paused
+        """
+        with self.lock:
+            first = not self.paused
+            self.paused = True
+        metrics.set('pydicombatch_schedule_paused', 1)
+        if self.pool:
+            self.pool.close()
+        if first and self.scp and self.scp.catalog:
+            self.scp.catalog.flush()
+
+    def resume(self):
+        with self.lock:
+            self.paused = False
+        metrics.set('pydicombatch_schedule_paused', 0)
+
+    def wait(self, request, running=lambda : True, pbar=None):
+        """
+        Wait until the request can be started inside the window. Returns False if running() turned False.
+        """
+        if not self.enabled:
+            return True
+        while running() and not self.can_start(request):
+            self.pause()
+            if pbar:
+                pbar.set_description('Extraction PAUSED (will resume at {})'.format(self.start_time))
+            # Wake up regularly to release the associations returned by requests still running
+            time.sleep(max(1, min(self.poll_interval, seconds_until(self.start_time, self.timezone) or 1)))
+        if not running():
+            return False
+        if self.paused:
+            self.resume()
+        if pbar:
+            pbar.set_description('Sending {} requests (will pause at {})'.format(self.operation, self.end_time))
+        return True